@@ -0,0 +1,295 @@
+"""Batch background removal from the command line.
+
+Runs the auto-detect pipeline (or a seed/tolerance recipe) over a
+directory or glob of images, spread across a process pool:
+
+    python batch.py photos/ -o cutouts/
+    python batch.py "shots/**/*.jpg" -o out/ --seed 10,10 --tolerance 25 --bg 255,255,255
+    python batch.py scans/ -o out/ --tiled -j 2     # 100+ MP images in bounded memory
+    python batch.py photos/ -o out/ --timings --trace trace.jsonl   # where the time goes
+    python batch.py photos/ -o out/ --preset webp --crop   # small files cut to the subject
+    python batch.py photos/ -o out/ --save-selections      # keep each mask as a .bgsel file
+    python batch.py edited/ -o out2/ --selections out/     # reuse them instead of selecting again
+
+Files whose output already exists are skipped, so an interrupted run can
+simply be restarted. Outputs are written to a temporary name and renamed
+into place, so a killed worker never leaves a truncated file behind.
+"""
+import argparse
+import glob
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+
+import cache
+import colorspace
+import engine
+import export
+import instrument
+import maskfile
+import tiled
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tif", ".tiff", ".webp")
+
+
+def parse_point(text):
+    """Parse an "x,y" command-line value"""
+    x, y = (int(v) for v in text.split(","))
+    return x, y
+
+
+def parse_color(text):
+    """Parse an "r,g,b" command-line value"""
+    color = tuple(int(v) for v in text.split(","))
+    if len(color) != 3:
+        raise argparse.ArgumentTypeError(f"expected r,g,b, got {text!r}")
+    return color
+
+
+def collect_inputs(source):
+    """Image files in a directory (recursively) or matching a glob"""
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, "**", "*"), recursive=True)
+        root = source
+    else:
+        paths = glob.glob(source, recursive=True)
+        root = os.path.commonpath([os.path.dirname(p) or "." for p in paths]) if paths else "."
+    files = sorted(p for p in paths if os.path.isfile(p) and p.lower().endswith(IMAGE_EXTENSIONS))
+    return files, root
+
+
+def output_path(src, root, output_dir, extension):
+    """Mirror src's position under root into output_dir with a new extension"""
+    relative = os.path.splitext(os.path.relpath(src, root))[0]
+    return os.path.join(output_dir, relative + extension)
+
+
+def on_timeout(signum, frame):
+    raise TimeoutError("timed out")
+
+
+def init_worker(cache_dir=None, timings=False, trace=None):
+    """Process pool initializer: shared cache directory and instrumentation
+
+    Without a cache directory the worker's cache is turned off: each file
+    is seen once, so it would only cost hashing and memory.
+    """
+    if cache_dir:
+        cache.configure(cache.MEMORY_BUDGET, cache_dir)
+    else:
+        cache.configure(0)
+    if timings or trace:
+        instrument.enable(trace)
+
+
+def process_file(src, dst, recipe, timeout, strip_wise=False, profile_path=None, preset=None, selection_src=None,
+                 selection_dst=None):
+    """Worker: run the recipe on one file and write it with an export preset
+
+    A selection file at selection_src (see maskfile.py) is used instead of
+    the recipe's selection; the selection is saved to selection_dst.
+
+    Returns a result dict instead of raising so one bad file never takes
+    the batch down; it includes the export report (see export.save).
+    With strip_wise the image is never fully in memory, and encoding is
+    interleaved with processing, so only the output bytes are reported.
+    With instrumentation on, the dict carries the file's stage timings;
+    profile_path gets a cProfile dump of the file's processing.
+    """
+    started = time.perf_counter()
+    result = {"src": src, "dst": dst, "ok": False, "megapixels": 0.0}
+    instrument.reset()
+    partial = dst + ".partial" + os.path.splitext(dst)[1]
+    partials = [partial] + ([selection_dst + ".partial"] if selection_dst else [])
+
+    # SIGALRM interrupts the worker itself; platforms without it run unbounded
+    use_alarm = timeout and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, on_timeout)
+        signal.alarm(timeout)
+    try:
+        os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+        if profile_path:
+            os.makedirs(os.path.dirname(profile_path) or ".", exist_ok=True)
+        with instrument.profile(profile_path, memory=True) if profile_path else nullcontext():
+            if strip_wise:
+                width, height = tiled.remove_background(src, partial, preset=preset, **recipe)
+                result["export"] = {"preset": export.preset_for(dst, preset), "bytes": os.path.getsize(partial),
+                                    "seconds": None}
+            else:
+                image = engine.load_image(src)
+                width, height = image.size
+                if selection_src:
+                    mask = maskfile.load(selection_src).mask_for(image.size)
+                else:
+                    mask = engine.recipe_mask(image, recipe["seeds"], recipe["tolerance"], recipe["metric"])
+                if selection_dst:
+                    os.makedirs(os.path.dirname(selection_dst) or ".", exist_ok=True)
+                    result["selection_bytes"] = maskfile.save(partials[1], mask, image)
+                result["export"] = export.save(engine.remove_background(image, mask=mask, **recipe), partial,
+                                               preset)
+        result["megapixels"] = width * height / 1e6
+        os.replace(partial, dst)
+        if selection_dst:
+            os.replace(partials[1], selection_dst)
+        result["ok"] = True
+    except Exception as e:
+        if use_alarm:
+            signal.alarm(0)
+        result["error"] = f"{type(e).__name__}: {e}"
+        # Leave nothing half written behind in the output tree
+        for path in partials:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+
+    result["seconds"] = time.perf_counter() - started
+    if instrument.enabled or profile_path:
+        result["timings"] = instrument.snapshot()
+    return result
+
+
+def print_summary(results, skipped, elapsed):
+    """Print throughput and failures for a finished run"""
+    done = [r for r in results if r["ok"]]
+    failed = [r for r in results if not r["ok"]]
+    megapixels = sum(r["megapixels"] for r in done)
+
+    print()
+    print(f"Processed: {len(done):,}  Failed: {len(failed):,}  Skipped (already done): {skipped:,}")
+    if elapsed > 0:
+        print(f"Elapsed: {elapsed:.1f}s  Throughput: {len(done) / elapsed:.2f} images/s, {megapixels / elapsed:.1f} MP/s")
+    if done:
+        print(f"Mean time per image: {sum(r['seconds'] for r in done) / len(done):.2f}s")
+    for r in failed:
+        print(f"  FAILED {r['src']}: {r['error']}")
+
+    presets = {}
+    for r in done:
+        presets.setdefault(r["export"]["preset"], []).append(r["export"])
+    if presets:
+        print("Output per preset:")
+    for preset, reports in sorted(presets.items()):
+        size = sum(report["bytes"] for report in reports)
+        line = (f"  {preset}: {len(reports):,} files, {export.format_bytes(size)}, "
+                f"mean {export.format_bytes(size / len(reports))}")
+        seconds = [report["seconds"] for report in reports if report["seconds"] is not None]
+        if seconds:
+            line += f", mean encode {instrument.format_seconds(sum(seconds) / len(seconds))}"
+        print(line)
+
+    stored = [r["selection_bytes"] for r in done if "selection_bytes" in r]
+    if stored:
+        print(f"Selections saved: {len(stored):,}, {export.format_bytes(sum(stored))} "
+              f"(mean {export.format_bytes(sum(stored) / len(stored))})")
+
+    timed = [r["timings"] for r in results if "timings" in r]
+    if timed:
+        total = {"stages": {}, "counters": {}}
+        for timings in timed:
+            instrument.merge(total, timings)
+        print()
+        print("Time per stage, all workers:")
+        print("\n".join("  " + line for line in instrument.summary(total).splitlines()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Remove backgrounds from many images at once.")
+    parser.add_argument("source", help="directory (searched recursively) or glob pattern")
+    parser.add_argument("-o", "--output", required=True, help="directory for the results")
+    parser.add_argument("--seed", type=parse_point, action="append", dest="seeds",
+                        help="x,y magic wand seed (repeatable); default is auto-detect")
+    parser.add_argument("--tolerance", type=int, help="color tolerance for the seeds or auto-detect")
+    parser.add_argument("--metric", choices=colorspace.METRICS, default=colorspace.DEFAULT_METRIC,
+                        help="color distance for the seeds' tolerance")
+    parser.add_argument("--feather", type=int, default=0, help="soften the cut-out edge by this many pixels")
+    parser.add_argument("--matte", action="store_true",
+                        help="soft alpha matting along the cut-out edge (hair, fur, blur)")
+    parser.add_argument("--bg", type=parse_color, help="r,g,b background color; default keeps transparency")
+    parser.add_argument("--format", choices=["png", "jpg", "webp"],
+                        help="output format; default PNG when transparent or --tiled, JPEG with --bg, "
+                             "or --preset's")
+    parser.add_argument("--preset", choices=export.PRESETS,
+                        help="export preset, e.g. png-fast to trade size for speed or webp-lossless")
+    parser.add_argument("--crop", action="store_true", help="crop each result to the subject")
+    parser.add_argument("--save-selections", action="store_true",
+                        help="also write each selection as a compact .bgsel file next to its result")
+    parser.add_argument("--selections", metavar="DIR",
+                        help="use the .bgsel files saved under DIR for matching inputs instead of selecting")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--timeout", type=int, default=300, help="seconds allowed per file (0 = no limit)")
+    parser.add_argument("--tiled", action="store_true",
+                        help="process in strips so memory stays flat for very large images (PNG output only)")
+    parser.add_argument("--overwrite", action="store_true", help="reprocess files whose output exists")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="keep selection masks here so duplicate images and re-runs skip the work")
+    parser.add_argument("--timings", action="store_true", help="print the time spent in each pipeline stage")
+    parser.add_argument("--trace", metavar="FILE", help="append a JSON line per pipeline stage run to FILE")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="write a cProfile dump per image to DIR (and report peak traced memory)")
+    args = parser.parse_args(argv)
+
+    if args.format and args.preset and export.preset_for("." + args.format, args.preset) != args.preset:
+        parser.error(f"--preset {args.preset} does not write {args.format} files")
+    for option, used in (("--crop", args.crop), ("--save-selections", args.save_selections),
+                         ("--selections", args.selections)):
+        if used and args.tiled:
+            parser.error(f"{option} is not supported with --tiled")
+    if args.format:
+        extension = "." + args.format
+    elif args.preset:
+        extension = export.extension(args.preset)
+    else:
+        extension = ".jpg" if args.bg and not args.tiled else ".png"
+    if args.tiled and extension != ".png":
+        parser.error("--tiled only writes PNG files")
+    recipe = {"seeds": args.seeds, "tolerance": args.tolerance, "bg_color": args.bg, "feather": args.feather,
+              "matte": args.matte, "metric": args.metric}
+    if args.crop:
+        recipe["crop"] = True
+
+    files, root = collect_inputs(args.source)
+    tasks = []
+    skipped = 0
+    for src in files:
+        dst = output_path(src, root, args.output, extension)
+        if not args.overwrite and os.path.exists(dst):
+            skipped += 1
+        else:
+            profile_path = output_path(src, root, args.profile, ".prof") if args.profile else None
+            selection_src = output_path(src, root, args.selections, maskfile.EXTENSION) if args.selections else None
+            if selection_src and not os.path.exists(selection_src):
+                selection_src = None
+            selection_dst = output_path(src, root, args.output, maskfile.EXTENSION) if args.save_selections else None
+            tasks.append((src, dst, profile_path, selection_src, selection_dst))
+
+    print(f"Found {len(files):,} images, {len(tasks):,} to process with {args.workers} workers")
+
+    results = []
+    started = time.perf_counter()
+    initargs = (args.cache, args.timings, os.path.abspath(args.trace) if args.trace else None)
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=initargs) as pool:
+        futures = [pool.submit(process_file, src, dst, recipe, args.timeout, args.tiled, profile_path, args.preset,
+                               selection_src, selection_dst)
+                   for src, dst, profile_path, selection_src, selection_dst in tasks]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if not result["ok"]:
+                print(f"FAILED {result['src']}: {result['error']}", file=sys.stderr)
+            if len(results) % 100 == 0 or len(results) == len(tasks):
+                print(f"[{len(results):,}/{len(tasks):,}] {time.perf_counter() - started:.1f}s")
+
+    print_summary(results, skipped, time.perf_counter() - started)
+    return 1 if any(not r["ok"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
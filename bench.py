@@ -0,0 +1,202 @@
+"""Benchmarks for the selection and compositing paths.
+
+Generates synthetic scenes (solid, gradient and noisy backgrounds, each
+with a centered subject) at several sizes and times every engine
+operation on them. Each case runs in a fresh process so peak RSS is
+per-operation, and a separate tracemalloc pass records Python-visible
+allocations (including NumPy buffers) without skewing the timings. The
+result cache is cleared before every run, so each one does the work
+instead of finding an earlier result.
+
+    python bench.py                          # default sizes, JSON to stdout
+    python bench.py --sizes 0.3 2 -o new.json
+    python bench.py --compare old.json -o new.json   # exit 1 on regressions
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import PIL
+from PIL import Image, ImageDraw
+
+import cache
+import engine
+import masks
+from overlay import SelectionOverlay
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_SIZES = (0.3, 2, 12, 24, 50)
+SCENES = ("solid", "gradient", "noise")
+CANVAS_SIZE = (800, 700)
+ASPECT = 1.5
+
+
+class Scene:
+    """A synthetic image with a known subject mask"""
+
+    def __init__(self, kind, megapixels, seed=0):
+        height = int((megapixels * 1e6 / ASPECT) ** 0.5)
+        width = int(height * ASPECT)
+        rng = np.random.default_rng(seed)
+
+        if kind == "solid":
+            background = np.empty((height, width, 3), dtype=np.uint8)
+            background[:] = (235, 235, 230)
+        elif kind == "gradient":
+            ramp = np.linspace(60, 230, width, dtype=np.float32)
+            background = np.empty((height, width, 3), dtype=np.uint8)
+            background[:] = np.stack([ramp, ramp * 0.8 + 20, 250 - ramp * 0.5], axis=1).astype(np.uint8)
+        elif kind == "noise":
+            background = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        else:
+            raise ValueError(f"Unknown scene: {kind}")
+
+        # A centered elliptical subject covering about a quarter of the frame
+        self.mask = Image.new("L", (width, height), 0)
+        ImageDraw.Draw(self.mask).ellipse((width * 0.25, height * 0.2, width * 0.75, height * 0.8), fill=255)
+        self.image = Image.fromarray(background)
+        subject = Image.new("RGB", (width, height), (180, 40, 40))
+        if kind == "noise":
+            subject = Image.fromarray(np.clip(rng.normal(110, 25, (height, width, 3)), 0, 255).astype(np.uint8))
+        self.image.paste(subject, mask=self.mask)
+
+        self.kind = kind
+        self.size = (width, height)
+
+
+def render_overlay(scene):
+    """Full overlay redraw, as visualize_selection does for a new selection"""
+    scale = min(CANVAS_SIZE[0] / scene.size[0], CANVAS_SIZE[1] / scene.size[1])
+    display_size = (int(scene.size[0] * scale), int(scene.size[1] * scale))
+    overlay = SelectionOverlay(scene.size, display_size, (0, 255, 0, 120))
+    return [overlay.tile(key) for key in overlay.update(scene.mask)]
+
+
+OPERATIONS = {
+    "flood_fill": lambda scene: engine.mask_from_seed(scene.image, 5, 5, engine.MAGIC_WAND_TOLERANCE),
+    "auto_detect": lambda scene: engine.auto_detect(scene.image),
+    "edge_mask": lambda scene: engine.edge_mask(scene.image),
+    "apply_mask": lambda scene: engine.apply_mask(scene.image, scene.mask),
+    "composite": lambda scene: engine.composite(scene.image, scene.mask, (255, 255, 255)),
+    "invert": lambda scene: masks.invert(scene.mask),
+    "overlay": render_overlay,
+}
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_case(kind, megapixels, operation, repeats):
+    """Benchmark one operation on one scene (runs in a fresh process)"""
+    scene = Scene(kind, megapixels)
+    run = OPERATIONS[operation]
+    rss_before = peak_rss_mb()
+
+    timings = []
+    for _ in range(repeats):
+        cache.default.clear()
+        started = time.perf_counter()
+        run(scene)
+        timings.append(time.perf_counter() - started)
+    rss_after = peak_rss_mb()
+
+    cache.default.clear()
+    tracemalloc.start()
+    run(scene)
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "scene": kind,
+        "megapixels": megapixels,
+        "width": scene.size[0],
+        "height": scene.size[1],
+        "operation": operation,
+        "repeats": repeats,
+        "seconds_min": min(timings),
+        "seconds_median": statistics.median(timings),
+        "peak_rss_mb": rss_after,
+        "rss_growth_mb": rss_after - rss_before if rss_after is not None else None,
+        "alloc_peak_mb": alloc_peak / (1024 * 1024),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Cases whose median time grew by more than threshold times"""
+    previous = {(r["scene"], r["megapixels"], r["operation"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["scene"], result["megapixels"], result["operation"]))
+        if old and old["seconds_median"] > 0:
+            ratio = result["seconds_median"] / old["seconds_median"]
+            if ratio > threshold:
+                regressions.append((result, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark selection and compositing operations.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=DEFAULT_SIZES, help="scene sizes in megapixels")
+    parser.add_argument("--scenes", nargs="+", choices=SCENES, default=SCENES)
+    parser.add_argument("--operations", nargs="+", choices=sorted(OPERATIONS), default=list(OPERATIONS))
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per case")
+    parser.add_argument("-o", "--output", help="write JSON results here instead of stdout")
+    parser.add_argument("--compare", help="baseline JSON from an earlier run")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown ratio that counts as a regression")
+    args = parser.parse_args(argv)
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for megapixels in args.sizes:
+        for kind in args.scenes:
+            for operation in args.operations:
+                with context.Pool(1) as pool:
+                    result = pool.apply(run_case, (kind, megapixels, operation, args.repeats))
+                results.append(result)
+                print(f"{kind:>8} {megapixels:>5g} MP  {operation:<12} "
+                      f"{result['seconds_median'] * 1000:10.1f} ms  "
+                      f"alloc {result['alloc_peak_mb']:8.1f} MB", file=sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for result, ratio in regressions:
+            print(f"REGRESSION {result['scene']} {result['megapixels']:g} MP {result['operation']}: "
+                  f"{ratio:.2f}x slower", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,283 @@
+"""Content-addressed cache for masks and derived images.
+
+Results are keyed by a hash of the input image's pixels and the
+parameters that produced them, so clicking the same seed twice, re-running
+auto-detect after a reset, or meeting a duplicate file in a batch finds
+the earlier result instead of recomputing it. A derived image (contrast
+copy, edge map, pyramid level) takes its key from its parent's key and
+the operation, so only images that come from outside are ever hashed, and
+each of those once.
+
+Entries are evicted least recently used first once their total size
+passes the byte budget. With a directory, results stored with persist
+(selection masks, which are small once compressed) are also written there
+as PNG or .npy files under a budget of their own, so they survive
+restarts and are shared between batch workers. Bulky intermediates such
+as contrast copies stay in memory.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+import instrument
+
+MEMORY_BUDGET = 256 * 1024 * 1024
+DISK_BUDGET = 2 * 1024 * 1024 * 1024
+HASH_ROWS = 256
+DISK_MODES = ("1", "L", "LA", "RGB", "RGBA", "I;16")
+
+# id(image) -> (weak reference, key), so each image object is hashed once
+_image_keys = {}
+_image_keys_lock = threading.Lock()
+
+
+def remember(image, key):
+    """Record the key of an image whose content is already known"""
+    image_id = id(image)
+
+    def forget(_, image_id=image_id):
+        with _image_keys_lock:
+            entry = _image_keys.get(image_id)
+            if entry is not None and entry[0]() is None:
+                del _image_keys[image_id]
+
+    with _image_keys_lock:
+        _image_keys[image_id] = (weakref.ref(image, forget), key)
+
+
+def image_key(image):
+    """Hex digest of an image's mode, size and pixels
+
+    Images are treated as immutable once keyed, as everywhere in this
+    code: operations return new images instead of drawing into old ones.
+    """
+    with _image_keys_lock:
+        entry = _image_keys.get(id(image))
+    if entry is not None and entry[0]() is image:
+        return entry[1]
+
+    digest = hashlib.sha1(f"{image.mode} {image.size}".encode(), usedforsecurity=False)
+    # A few rows at a time, so hashing never holds a second full copy
+    for top in range(0, image.height, HASH_ROWS):
+        digest.update(image.crop((0, top, image.width, min(top + HASH_ROWS, image.height))).tobytes())
+    key = digest.hexdigest()
+    remember(image, key)
+    return key
+
+
+def result_key(name, image, params=()):
+    """Key of the result of operation name with params on image"""
+    return hashlib.sha1(f"{name} {image_key(image)} {params!r}".encode(), usedforsecurity=False).hexdigest()
+
+
+def nbytes(value):
+    """Approximate memory held by a cached value"""
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands()) * (4 if value.mode in ("I", "F") else 1)
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(item) for item in value)
+    return getattr(value, "nbytes", 0)
+
+
+class DiskTier:
+    """Cached images and arrays as files in a directory, evicted by age"""
+
+    def __init__(self, directory, budget=DISK_BUDGET):
+        self.directory = directory
+        self.budget = budget
+        # Guards the bookkeeping only; files are read and written outside it
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Oldest first, as left by earlier runs
+        files = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.name.endswith((".png", ".npy")):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        self.files = OrderedDict((name, size) for _, name, size in sorted(files))
+        self.total = sum(self.files.values())
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, key):
+        for name in (key + ".png", key + ".npy"):
+            with self.lock:
+                known = name in self.files
+            # Other processes may have added files since the directory was read
+            if not known and not os.path.exists(self.path(name)):
+                continue
+            try:
+                if name.endswith(".npy"):
+                    value = np.load(self.path(name))
+                else:
+                    value = Image.open(self.path(name))
+                    value.load()
+                os.utime(self.path(name))
+                size = os.path.getsize(self.path(name))
+            except (OSError, ValueError):
+                # Removed or half-written by another process: treat as a miss
+                self.drop(name)
+                return None
+            with self.lock:
+                if name not in self.files:
+                    self.files[name] = size
+                    self.total += size
+                self.files.move_to_end(name)
+            return value
+        return None
+
+    def put(self, key, value):
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            name = key + ".npy"
+        elif isinstance(value, Image.Image) and value.mode in DISK_MODES:
+            name = key + ".png"
+        else:
+            return
+        with self.lock:
+            known = name in self.files
+        if known or os.path.exists(self.path(name)):
+            return
+
+        # Write then rename, so other processes never read a partial file
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".partial")
+        try:
+            with os.fdopen(handle, "wb") as file:
+                if name.endswith(".npy"):
+                    np.save(file, value)
+                else:
+                    value.save(file, "PNG", compress_level=1)
+            os.replace(temporary, self.path(name))
+            size = os.path.getsize(self.path(name))
+        except OSError:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return
+        evicted = []
+        with self.lock:
+            if name not in self.files:
+                self.files[name] = size
+                self.total += size
+            while self.total > self.budget and len(self.files) > 1:
+                oldest, oldest_size = self.files.popitem(last=False)
+                self.total -= oldest_size
+                evicted.append(oldest)
+        for oldest in evicted:
+            self.remove(oldest)
+
+    def drop(self, name):
+        with self.lock:
+            self.total -= self.files.pop(name, 0)
+        self.remove(name)
+
+    def remove(self, name):
+        try:
+            os.remove(self.path(name))
+        except OSError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            names = list(self.files)
+        for name in names:
+            self.drop(name)
+
+
+class ResultCache:
+    """LRU cache of computed results under a byte budget
+
+    Safe to use from worker threads. directory adds the on-disk tier.
+    """
+
+    def __init__(self, budget=MEMORY_BUDGET, directory=None, disk_budget=DISK_BUDGET):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.disk = DiskTier(directory, disk_budget) if directory else None
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        """Cached value for key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if entry is not None:
+            instrument.count("cache hits")
+            return entry[0]
+
+        # Read outside the lock, so one slow disk read never holds up other threads
+        value = self.disk.get(key) if self.disk else None
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is None:
+            instrument.count("cache misses")
+            return None
+        instrument.count("cache hits")
+        self.put(key, value)
+        return value
+
+    def put(self, key, value, persist=False):
+        """Store value under key, evicting the least recently used entries
+
+        With persist the value also goes to the disk tier, if there is one.
+        """
+        size = nbytes(value)
+        if isinstance(value, Image.Image):
+            remember(value, key)
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            if size <= self.budget:
+                self.entries[key] = (value, size)
+                self.nbytes += size
+                while self.nbytes > self.budget:
+                    _, (_, evicted) = self.entries.popitem(last=False)
+                    self.nbytes -= evicted
+        if persist and self.disk:
+            self.disk.put(key, value)
+
+    def cached(self, name, image, params, compute, persist=False):
+        """Result of compute() for operation name with params on image
+
+        Computed on the first call and looked up on later ones with the
+        same image content and params. A cache with no budget and no
+        directory is off: compute() runs without hashing the image.
+        """
+        if self.budget <= 0 and self.disk is None:
+            return compute()
+        key = result_key(name, image, params)
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value, persist)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+        if self.disk:
+            self.disk.clear()
+
+
+# The cache the engine and the GUI share; configure() replaces it
+default = ResultCache()
+
+
+def configure(budget=MEMORY_BUDGET, directory=None, disk_budget=DISK_BUDGET):
+    """Replace the shared cache, e.g. to add a directory for the disk tier"""
+    global default
+    default = ResultCache(budget, directory, disk_budget)
+    return default
@@ -0,0 +1,395 @@
+"""Headless background removal engine.
+
+Everything here takes and returns PIL images and holds no GUI state, so
+it can run on render workers or under a profiler without a display.
+Selection masks are "L" images where 255 marks pixels to keep and 0 marks
+background. main.py's SmartBackgroundRemover is a thin client over this.
+"""
+import io
+import math
+
+import numpy as np
+from PIL import ExifTags, Image, ImageChops, ImageDraw, ImageFilter, ImageEnhance
+
+import cache
+import colorspace
+import fill
+import instrument
+import matting
+import morphology
+
+MAGIC_WAND_TOLERANCE = 30
+# Largest tolerance the app's sensitivity slider offers
+MAX_TOLERANCE = 100
+AUTO_DETECT_TOLERANCE = 40
+EDGE_THRESHOLD = 50
+JPEG_BACKGROUND = (255, 255, 255)
+JPEG_QUALITY = 95
+JPEG_THUMBNAIL_OFFSET = 0x0201
+JPEG_THUMBNAIL_LENGTH = 0x0202
+
+
+def load_image(filename):
+    """Open and decode an image file"""
+    image = Image.open(filename)
+    with instrument.stage("decode"):
+        image.load()
+    return image
+
+
+def open_image(filename):
+    """Open an image file without decoding its pixels yet
+
+    Size and mode are known at once; the pixels are decoded by load(), or
+    by the first operation that needs them.
+    """
+    return Image.open(filename)
+
+
+def exif_thumbnail(image):
+    """The JPEG thumbnail embedded in an image's EXIF data, or None"""
+    try:
+        thumbnail_tags = image.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset, length = thumbnail_tags[JPEG_THUMBNAIL_OFFSET], thumbnail_tags[JPEG_THUMBNAIL_LENGTH]
+        # Offsets count from the TIFF header, which follows the "Exif\0\0" marker
+        data = image.info["exif"][6 + offset:6 + offset + length]
+        thumbnail = Image.open(io.BytesIO(data))
+        thumbnail.load()
+        return thumbnail
+    except (KeyError, OSError, ValueError, SyntaxError):
+        return None
+
+
+@instrument.timed("decode")
+def load_preview(filename, box):
+    """Quickly decode a reduced copy of a JPEG that still fills box
+
+    An embedded EXIF thumbnail is used when it is big enough and has the
+    image's aspect ratio. Otherwise DCT scaling (Image.draft) decodes at
+    1/2, 1/4 or 1/8 resolution for a fraction of a full decode. Returns
+    None when no reduced decode is possible: other formats, images that
+    already fit box, or ones only slightly larger than it.
+    """
+    image = Image.open(filename)
+    if image.format != "JPEG":
+        image.close()
+        return None
+
+    scale = min(box[0] / image.width, box[1] / image.height, 1.0)
+    needed = (math.ceil(image.width * scale), math.ceil(image.height * scale))
+    if needed == image.size:
+        image.close()
+        return None
+
+    thumbnail = exif_thumbnail(image)
+    if (thumbnail and thumbnail.width >= needed[0] and thumbnail.height >= needed[1]
+            and abs(thumbnail.width / thumbnail.height - image.width / image.height) < 0.01):
+        image.close()
+        return thumbnail
+
+    full_size = image.size
+    # draft() also succeeds when it can only decode at full size
+    if image.draft("RGB", needed) is None or image.size == full_size:
+        image.close()
+        return None
+    image.load()
+    return image
+
+
+def mask_from_seed(image, x, y, tolerance, target_color=None, metric=colorspace.DEFAULT_METRIC):
+    """Magic wand: select the region around (x, y) within tolerance
+
+    metric is the color distance to use, one of colorspace.METRICS.
+    """
+    return cache.default.cached(
+        "wand", image, (x, y, tolerance, target_color, metric),
+        lambda: fill.to_mask_image(fill.flood_fill(image, x, y, tolerance, target_color, metric)), persist=True)
+
+
+def wand_distance(image, x, y, target_color=None, limit=None, metric=colorspace.DEFAULT_METRIC):
+    """Tolerance map for the magic wand at (x, y), see fill.bottleneck_distance
+
+    mask_from_seed(image, x, y, t, target_color, metric) is this map <= t.
+    """
+    return cache.default.cached("wand distance", image, (x, y, target_color, limit, metric),
+                                lambda: fill.bottleneck_distance(image, x, y, target_color, limit, metric))
+
+
+def as_rgb(image):
+    """image itself if it is RGB, else an RGB copy (kept in the cache)"""
+    if image.mode == "RGB":
+        return image
+    return cache.default.cached("rgb", image, (), lambda: image.convert("RGB"))
+
+
+def enhance_contrast(image, factor):
+    """image with contrast scaled by factor"""
+    return cache.default.cached("contrast", image, (factor,), lambda: ImageEnhance.Contrast(image).enhance(factor))
+
+
+def center_seed_points(size):
+    """Seed points around the center, where the main object usually sits"""
+    width, height = size
+    center_x, center_y = width // 2, height // 2
+    return [
+        (center_x, center_y),
+        (center_x - width//6, center_y),
+        (center_x + width//6, center_y),
+        (center_x, center_y - height//6),
+        (center_x, center_y + height//6)
+    ]
+
+
+def grid_seed_points(size, columns=5, rows=None, margin=1/6):
+    """Seed points on an evenly spaced grid, margin (a fraction) in from each side"""
+    width, height = size
+    rows = rows or columns
+    xs = [int(width * (margin + (1 - 2 * margin) * (i + 0.5) / columns)) for i in range(columns)]
+    ys = [int(height * (margin + (1 - 2 * margin) * (j + 0.5) / rows)) for j in range(rows)]
+    return [(x, y) for y in ys for x in xs]
+
+
+def mask_from_seeds(image, seeds, tolerance, metric=colorspace.DEFAULT_METRIC, progress=None):
+    """Magic wand at every (x, y) of seeds at once, each with its own color
+
+    Same as the union of mask_from_seed over the seeds, but the work the
+    seeds have in common is done once (see fill.flood_fill_many).
+    """
+    seeds = tuple(seeds)
+    return cache.default.cached(
+        "wand seeds", image, (seeds, tolerance, metric),
+        lambda: fill.to_mask_image(fill.flood_fill_many(image, seeds, tolerance, metric=metric, progress=progress)),
+        persist=True)
+
+
+def auto_detect(image, tolerance=AUTO_DETECT_TOLERANCE, seed_points=None, progress=None):
+    """Automatically detect the main object in the image
+
+    seed_points defaults to center_seed_points; any number of points
+    works, such as grid_seed_points. progress, if given, is called with
+    the fraction done.
+    """
+    if seed_points is None:
+        seed_points = center_seed_points(image.size)
+    return cache.default.cached("auto_detect", image, (tolerance, seed_points),
+                                lambda: detect_main_object(image, tolerance, seed_points, progress), persist=True)
+
+
+def detect_main_object(image, tolerance, seed_points, progress=None):
+    """Uncached auto_detect"""
+    # Enhance contrast to help with detection
+    img = enhance_contrast(as_rgb(image), 2.0)
+
+    # Select the regions similar to each seed point's color, all together
+    mask = fill.to_mask_image(fill.flood_fill_many(img, seed_points, tolerance, progress=progress))
+
+    # Clean up the mask
+    return mask.filter(ImageFilter.MedianFilter(size=5))
+
+
+def edge_mask(image, threshold=EDGE_THRESHOLD, radius=2, progress=None):
+    """Select the objects enclosed by strong edges
+
+    Edges above threshold are thickened by radius pixels so small gaps
+    close, then every region they enclose is filled in. All steps are
+    whole-array operations, linear in the pixel count. progress, if given,
+    is called with the fraction done between stages.
+    """
+    return cache.default.cached("edge_mask", image, (threshold, radius),
+                                lambda: enclosed_by_edges(image, threshold, radius, progress), persist=True)
+
+
+def edge_map(image):
+    """Contrast-enhanced grayscale edge strength of an image"""
+    def compute():
+        # Apply strong edge detection
+        edges = as_rgb(image).filter(ImageFilter.FIND_EDGES)
+        edges = edges.filter(ImageFilter.SMOOTH_MORE)
+
+        # Convert to grayscale and enhance
+        return ImageEnhance.Contrast(edges.convert("L")).enhance(3.0)
+    return cache.default.cached("edge_map", image, (), compute)
+
+
+def enclosed_by_edges(image, threshold, radius, progress=None):
+    """Uncached edge_mask"""
+    gray = edge_map(image)
+    if progress:
+        progress(0.3)
+
+    # The filters copy the outermost pixels unfiltered and smear them inwards;
+    # that band is not an edge and would otherwise enclose the whole image
+    strong = np.asarray(gray) > threshold
+    strong[:3] = strong[-3:] = False
+    strong[:, :3] = strong[:, -3:] = False
+
+    # Close gaps with a separable dilation, then fill enclosed regions
+    outline = morphology.dilate(strong, radius)
+    if progress:
+        progress(0.5)
+    mask = fill.to_mask_image(morphology.fill_holes(outline))
+    if progress:
+        progress(0.9)
+
+    # Clean up the mask
+    return mask.filter(ImageFilter.MedianFilter(size=3))
+
+
+def polygon_mask(size, points):
+    """Mask with the polygon through points (image coordinates) selected"""
+    mask = Image.new("L", size, 0)
+    ImageDraw.Draw(mask).polygon(points, fill=255)
+    return mask
+
+
+def paint_stroke(draw, points, radius, value=255):
+    """Draw a round brush of radius along points with an ImageDraw
+
+    Painting a stroke's points in pieces gives the same pixels as painting
+    them at once, so strokes can be drawn incrementally and replayed.
+    """
+    width = max(1, round(2 * radius))
+    for start, end in zip(points[:1] + points[:-1], points):
+        if start != end:
+            draw.line([start, end], fill=value, width=width)
+        x, y = end
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=value)
+
+
+def stroke_mask(size, points, radius):
+    """Mask with a brush stroke of radius along points (image coordinates) selected"""
+    mask = Image.new("L", size, 0)
+    paint_stroke(ImageDraw.Draw(mask), list(points), radius)
+    return mask
+
+
+def has_alpha(image):
+    """True for images with an alpha channel or a transparent palette entry"""
+    return "A" in image.getbands() or "transparency" in image.info
+
+
+def color_image(image):
+    """image as RGB, or as RGBA if it has any transparency (LA, PA, P with tRNS)"""
+    mode = "RGBA" if has_alpha(image) else "RGB"
+    return image if image.mode == mode else image.convert(mode)
+
+
+def coverage(mask, feather=0):
+    """Alpha coverage for a mask: 255 where selected, softened by feather
+
+    feather is a blur radius in pixels; 0 keeps hard edges.
+    """
+    hard = mask.point(lambda v: 255 if v else 0)
+    return hard.filter(ImageFilter.GaussianBlur(feather)) if feather else hard
+
+
+def soft_coverage(image, mask, feather=0, progress=None):
+    """Matted alpha for a mask, with the colors to use under it
+
+    Unlike coverage, edges get fractional alpha that follows the image
+    (see matting.py) and edge colors lose the background they picked up.
+    Returns the "L" alpha and an RGB image of colors. progress, if given,
+    is called with the fraction of the edge done.
+    """
+    alpha, colors = matting.refine(image, mask, progress=progress)
+    return (alpha.filter(ImageFilter.GaussianBlur(feather)) if feather else alpha), colors
+
+
+@instrument.timed("composite")
+def apply_mask(image, mask, feather=0, matte=False, progress=None):
+    """Make unselected pixels transparent
+
+    Selected pixels keep their existing alpha, scaled by the (optionally
+    feathered) coverage. With matte the coverage is soft_coverage instead,
+    reporting to progress. Returns the RGBA result with the number of pixels removed and kept.
+    """
+    source = color_image(image)
+    if matte:
+        alpha, result = soft_coverage(source, mask, feather, progress)
+    else:
+        alpha = coverage(mask, feather)
+        result = source.copy() if source is image else source
+    if source.mode == "RGBA":
+        alpha = ImageChops.multiply(source.getchannel("A"), alpha)
+    result.putalpha(alpha)
+
+    pixels_removed = mask.histogram()[0]
+    return result, pixels_removed, mask.width * mask.height - pixels_removed
+
+
+def flatten(image, color):
+    """Composite a transparent image onto a solid background color"""
+    if image.mode != "RGBA":
+        return image
+    background = Image.new("RGB", image.size, color)
+    background.paste(image, mask=image.getchannel("A"))
+    return background
+
+
+def composite(image, mask, bg_color=None, feather=0, matte=False, progress=None):
+    """Apply a mask and flatten onto bg_color in one pass
+
+    Equivalent to flatten(apply_mask(...)) but skips the intermediate RGBA
+    image when a background color is given. Returns the result with the
+    number of pixels removed and kept.
+    """
+    if not bg_color:
+        return apply_mask(image, mask, feather, matte, progress)
+
+    with instrument.stage("composite"):
+        source = color_image(image)
+        if matte:
+            alpha, colors = soft_coverage(source, mask, feather, progress)
+        else:
+            alpha = coverage(mask, feather)
+            colors = source
+        if source.mode == "RGBA":
+            alpha = ImageChops.multiply(source.getchannel("A"), alpha)
+        result = Image.new("RGB", image.size, bg_color)
+        result.paste(colors, mask=alpha)
+
+    pixels_removed = mask.histogram()[0]
+    return result, pixels_removed, mask.width * mask.height - pixels_removed
+
+
+@instrument.timed("encode")
+def export(image, filename):
+    """Save an image, flattening transparency for formats without alpha"""
+    if filename.lower().endswith(('.jpg', '.jpeg')) and has_alpha(image):
+        flatten(color_image(image), JPEG_BACKGROUND).save(filename, quality=JPEG_QUALITY)
+    else:
+        image.save(filename)
+
+
+def recipe_mask(image, seeds=None, tolerance=None, metric=colorspace.DEFAULT_METRIC):
+    """The selection mask of a recipe: seeds' magic wand regions, or auto-detect"""
+    if seeds:
+        return mask_from_seeds(image, seeds, MAGIC_WAND_TOLERANCE if tolerance is None else tolerance, metric)
+    return auto_detect(image, AUTO_DETECT_TOLERANCE if tolerance is None else tolerance)
+
+
+def remove_background(image, seeds=None, tolerance=None, bg_color=None, feather=0, matte=False,
+                      metric=colorspace.DEFAULT_METRIC, crop=False, mask=None):
+    """Run a full selection recipe and remove everything that is not selected
+
+    Without seeds the main object is auto-detected. With seeds, the magic
+    wand regions around each (x, y) seed are combined instead. With
+    bg_color the result is flattened onto that color, otherwise it stays
+    transparent. feather softens the cut-out edge by that many pixels, and
+    matte gives it soft alpha that follows the image (see matting.py).
+    metric is the seeds' color distance (see colorspace.py). With crop the
+    result is cut to the bounding box of what is kept. A given mask (such
+    as a stored selection, see maskfile.py) replaces the selection step.
+    """
+    if mask is None:
+        mask = recipe_mask(image, seeds, tolerance, metric)
+
+    if crop:
+        # Box from the cut-out's alpha, so feathered and matted edges stay inside
+        result, _, _ = apply_mask(image, mask, feather, matte)
+        box = result.getchannel("A").getbbox()
+        if box:
+            result = result.crop(box)
+        return flatten(result, bg_color) if bg_color else result
+    result, _, _ = composite(image, mask, bg_color, feather, matte)
+    return result
@@ -0,0 +1,154 @@
+"""Saving results: format presets, cropping and background encoding.
+
+A preset is an output format plus its Pillow save options:
+
+- png-fast: PNG at zlib level 1, several times quicker to write, larger
+- png: PNG at the default level 6
+- png-small: PNG with optimize (level 9 and the best filter)
+- jpeg: optimized, progressive JPEG; transparency is flattened
+- webp: lossy WebP that keeps transparency
+- webp-lossless: lossless WebP, with transparency
+
+Every save reports its preset, output bytes and encode seconds, so the
+app and the batch summary can show what each format costs. Exporter runs
+saves on background threads (Pillow's encoders release the GIL while
+compressing), so the caller never waits for compression.
+"""
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import engine
+import instrument
+
+PRESETS = {
+    "png-fast": ("PNG", {"compress_level": 1}),
+    "png": ("PNG", {"compress_level": 6}),
+    "png-small": ("PNG", {"optimize": True}),
+    "jpeg": ("JPEG", {"quality": engine.JPEG_QUALITY, "optimize": True, "progressive": True}),
+    "webp": ("WEBP", {"quality": 90, "method": 4}),
+    "webp-lossless": ("WEBP", {"lossless": True, "quality": 80, "method": 4}),
+}
+# Preset used for each extension unless another one of the same format is asked for
+EXTENSION_PRESETS = {".png": "png", ".jpg": "jpeg", ".jpeg": "jpeg", ".webp": "webp"}
+EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp"}
+CONTENT_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+EXPORT_WORKERS = 2
+
+
+def preset_for(filename, preset=None):
+    """Name of the preset to save filename with, or None for Pillow's defaults
+
+    filename may also be just an extension, such as ".jpg". preset is used
+    when its format matches the extension; otherwise the extension decides,
+    so a file's contents always match its name.
+    """
+    suffix = os.path.splitext(filename)[1] or os.path.basename(filename)
+    default = EXTENSION_PRESETS.get(suffix.lower())
+    if preset is None:
+        return default
+    if preset not in PRESETS:
+        raise ValueError(f"Unknown export preset: {preset}")
+    if default is not None and PRESETS[preset][0] != PRESETS[default][0]:
+        return default
+    return preset
+
+
+def extension(preset):
+    """File extension for a preset's format"""
+    return EXTENSIONS[PRESETS[preset][0]]
+
+
+def alpha_box(image):
+    """Bounding box of the pixels that are not fully transparent
+
+    None for images without alpha or with nothing visible.
+    """
+    if not engine.has_alpha(image):
+        return None
+    return engine.color_image(image).getchannel("A").getbbox()
+
+
+def prepare(image, image_format):
+    """image in a mode that image_format can store"""
+    if image_format != "JPEG":
+        return image
+    if engine.has_alpha(image):
+        image = engine.color_image(image)
+        if image.getchannel("A").getextrema() == (255, 255):
+            return image.convert("RGB")
+        return engine.flatten(image, engine.JPEG_BACKGROUND)
+    if image.mode not in ("RGB", "L", "CMYK"):
+        return image.convert("RGB")
+    return image
+
+
+@instrument.timed("encode")
+def write(image, target, preset):
+    """Encode image with a preset name to target, a file name or binary file"""
+    image_format, options = PRESETS[preset]
+    prepare(image, image_format).save(target, image_format, **options)
+
+
+def save(image, filename, preset=None, crop=None):
+    """Save image to filename with a preset (see preset_for)
+
+    crop is a box to cut out first, such as alpha_box of the cut-out.
+    Returns a report: preset, format, size, bytes written and seconds.
+    """
+    if crop:
+        image = image.crop(crop)
+    preset = preset_for(filename, preset)
+    started = time.perf_counter()
+    if preset is None:
+        engine.export(image, filename)
+    else:
+        write(image, filename, preset)
+    suffix = os.path.splitext(filename)[1].lower()
+    return {"preset": preset or suffix.lstrip("."),
+            "format": PRESETS[preset][0] if preset else Image.registered_extensions().get(suffix),
+            "size": image.size, "bytes": os.path.getsize(filename), "seconds": time.perf_counter() - started}
+
+
+def encode(image, preset, crop=None):
+    """File bytes of image with a preset, and the report save() would give"""
+    if crop:
+        image = image.crop(crop)
+    started = time.perf_counter()
+    buffer = io.BytesIO()
+    write(image, buffer, preset)
+    data = buffer.getvalue()
+    return data, {"preset": preset, "format": PRESETS[preset][0], "size": image.size, "bytes": len(data),
+                  "seconds": time.perf_counter() - started}
+
+
+def format_bytes(size):
+    if size < 1024:
+        return f"{size:.0f} bytes"
+    return f"{size / (1024 * 1024):.1f} MB" if size >= 100 * 1024 else f"{size / 1024:.0f} KB"
+
+
+def describe(report):
+    """A report as short text, e.g. "png: 1.2 MB in 340ms" """
+    return f"{report['preset']}: {format_bytes(report['bytes'])} in {instrument.format_seconds(report['seconds'])}"
+
+
+class Exporter:
+    """Saves images on background threads
+
+    submit() returns at once with a Future for save()'s report. Images
+    are never changed after they are made, so the caller can carry on
+    with the same image while it is being written.
+    """
+
+    def __init__(self, workers=EXPORT_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export")
+
+    def submit(self, image, filename, preset=None, crop=None):
+        return self.pool.submit(save, image, filename, preset, crop)
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
@@ -0,0 +1,306 @@
+"""Array-based flood fill used by the magic wand and auto-detect tools.
+
+Instead of visiting pixels one by one, the fill works on whole arrays:
+a tolerance mask of squared color distances is computed in one pass, the
+mask is split into horizontal runs, runs that touch across rows are joined
+into connected components, and the component under the seed is painted
+back into a boolean bitmap.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import colorspace
+import instrument
+
+# Distinct seed colors from which flood_fill_many reduces an image to its palette
+PALETTE_MIN_COLORS = 8
+
+
+def as_rgb_array(image):
+    """Return an (height, width, 3) uint8 view of an image's RGB channels"""
+    if isinstance(image, np.ndarray):
+        return image[..., :3] if image.ndim == 3 else np.dstack([image] * 3)
+    if image.mode == "RGBA":
+        return np.asarray(image)[..., :3]
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray(image)
+
+
+def image_size(image):
+    """(width, height) of a PIL image or a pixel array"""
+    return (image.shape[1], image.shape[0]) if isinstance(image, np.ndarray) else image.size
+
+
+def color_distance_sq(pixels, target_color, metric=colorspace.DEFAULT_METRIC):
+    """Squared distance from every uint8 RGB(A) pixel to target_color
+
+    metric is one of colorspace.METRICS; the default is Euclidean RGB.
+    """
+    return colorspace.distance_sq(colorspace.convert(pixels, metric), colorspace.convert_color(target_color, metric),
+                                  metric)
+
+
+def tolerance_mask(pixels, target_color, tolerance, metric=colorspace.DEFAULT_METRIC):
+    """Boolean map of pixels within tolerance of target_color"""
+    return color_distance_sq(pixels, target_color, metric) <= tolerance * tolerance
+
+
+def find_runs(allowed):
+    """Split a boolean map into horizontal runs (rows, starts, exclusive ends)"""
+    height, width = allowed.shape
+    padded = np.zeros((height, width + 2), dtype=bool)
+    padded[:, 1:-1] = allowed
+    # Changes alternate start, end within each row, so one scan finds both
+    changes = np.flatnonzero(padded[:, 1:] != padded[:, :-1])
+    rows, columns = np.divmod(changes, width + 1)
+    return rows[::2], columns[::2], columns[1::2]
+
+
+def link_runs(rows, starts, ends, width):
+    """Return index pairs of runs that touch between neighbouring rows"""
+    # Global keys keep runs of different rows apart in one sorted sequence
+    stride = width + 1
+    start_keys = rows * stride + starts
+    end_keys = rows * stride + ends
+
+    # For each run, the runs of the row above that overlap it
+    above = (rows - 1) * stride
+    first = np.searchsorted(end_keys, above + starts, side="right")
+    last = np.searchsorted(start_keys, above + ends, side="left")
+    counts = np.maximum(last - first, 0)
+
+    lower = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    upper = np.repeat(first, counts) + offsets
+    return upper, lower
+
+
+def label_runs(count, upper, lower):
+    """Assign each run the smallest run index of its connected component"""
+    parent = np.arange(count)
+    while True:
+        root_a, root_b = parent[upper], parent[lower]
+        if np.array_equal(root_a, root_b):
+            return parent
+        # Hook the larger root under the smaller one, then compress paths
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+
+def label_components(allowed):
+    """Label 4-connected components of a boolean map (0 = not allowed)"""
+    height, width = allowed.shape
+    rows, starts, ends = find_runs(allowed)
+    upper, lower = link_runs(rows, starts, ends, width)
+    run_labels = label_runs(len(rows), upper, lower)
+
+    # Allowed pixels in row-major order are exactly the runs laid end to end
+    labels = np.zeros(height * width, dtype=np.int32)
+    labels[allowed.ravel()] = np.repeat(run_labels + 1, ends - starts)
+    return labels.reshape(height, width)
+
+
+def connected_region(allowed, x, y):
+    """Boolean map of the 4-connected region of allowed that contains (x, y)"""
+    return connected_regions(allowed, [(x, y)])
+
+
+def connected_regions(allowed, points):
+    """Boolean map of the 4-connected regions of allowed that contain any of points
+
+    The map is labelled once however many points there are.
+    """
+    height, width = allowed.shape
+    region = np.zeros((height, width), dtype=bool)
+    points = [(x, y) for x, y in points if 0 <= x < width and 0 <= y < height and allowed[y, x]]
+    if not points:
+        return region
+
+    rows, starts, ends = find_runs(allowed)
+    upper, lower = link_runs(rows, starts, ends, width)
+    run_labels = label_runs(len(rows), upper, lower)
+
+    seed_keys = [y * (width + 1) + x for x, y in points]
+    seed_runs = np.searchsorted(rows * (width + 1) + starts, seed_keys, side="right") - 1
+    selected = np.isin(run_labels, run_labels[seed_runs])
+    region.ravel()[allowed.ravel()] = np.repeat(selected, ends - starts)
+    return region
+
+
+@instrument.timed("fill")
+def flood_fill(image, x, y, tolerance, target_color=None, metric=colorspace.DEFAULT_METRIC):
+    """Select the region around (x, y) whose colors are within tolerance
+
+    target_color defaults to the color under the seed, which matches the
+    magic wand behaviour. Returns a boolean map the size of the image,
+    empty if (x, y) is outside it.
+    """
+    width, height = image_size(image)
+    if not (0 <= x < width and 0 <= y < height):
+        return np.zeros((height, width), dtype=bool)
+    return connected_region(colorspace.distance_map(image, x, y, target_color, metric) <= tolerance * tolerance, x, y)
+
+
+@instrument.timed("fill")
+def flood_fill_many(image, seeds, tolerance, target_colors=None, metric=colorspace.DEFAULT_METRIC, workers=None,
+                    progress=None):
+    """Union of flood_fill(image, x, y, tolerance, ...) over many (x, y) seeds
+
+    Seeds with the same target color share one tolerance map and one
+    labelling. With many distinct colors the image is first reduced to its
+    palette (cached, see colorspace.Palette), so each color's tolerance
+    map is a lookup instead of a pass over every pixel. The colors are
+    filled on a pool of worker threads; numpy releases the GIL in the
+    heavy array loops, so large images use several cores. target_colors,
+    if given, has one color (or None for the seed's own) per seed. Seeds
+    outside the image are ignored. progress, if given, is called with the
+    fraction done.
+    """
+    pixels = image if isinstance(image, np.ndarray) else colorspace.as_array(image)
+    height, width = pixels.shape[:2]
+    groups = {}
+    for number, (x, y) in enumerate(seeds):
+        if not (0 <= x < width and 0 <= y < height):
+            continue
+        color = None if target_colors is None else target_colors[number]
+        key = tuple(int(v) for v in (pixels[y, x] if color is None else color))
+        groups.setdefault(key, []).append((x, y))
+    region = np.zeros((height, width), dtype=bool)
+    if not groups:
+        return region
+
+    limit = tolerance * tolerance
+    # Building the palette only pays off over several colors, except for the
+    # metrics that would build it for a single click anyway
+    use_palette = not isinstance(image, np.ndarray) and (metric != "rgb" or len(groups) >= PALETTE_MIN_COLORS)
+    palette = colorspace.palette(image, metric) if use_palette else None
+    converted = colorspace.convert(pixels, metric) if palette is None else None
+
+    def fill_group(item):
+        color, points = item
+        target = colorspace.convert_color(color, metric)
+        if palette is not None:
+            allowed = palette.within(target, limit)
+        else:
+            allowed = colorspace.distance_sq(converted, target, metric) <= limit
+        return connected_regions(allowed, points)
+
+    workers = min(len(groups), workers or os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for done, part in enumerate(pool.map(fill_group, groups.items())):
+            if progress:
+                progress(done / len(groups))
+            region |= part
+    return region
+
+
+def find_roots(parent, nodes):
+    """Roots of nodes in a union-find forest, pointing nodes straight at them"""
+    roots = parent[nodes]
+    while True:
+        above = parent[roots]
+        if np.array_equal(above, roots):
+            break
+        roots = above
+    parent[nodes] = roots
+    return roots
+
+
+def neighbour_pairs(pixels, width, size):
+    """(pixel, neighbour) index pairs of flat pixels and their 4-neighbours"""
+    columns = pixels % width
+    pairs = [(pixels[columns > 0], -1), (pixels[columns < width - 1], 1),
+             (pixels[pixels >= width], -width), (pixels[pixels < size - width], width)]
+    return (np.concatenate([near for near, _ in pairs]),
+            np.concatenate([near + offset for near, offset in pairs]))
+
+
+@instrument.timed("fill distance")
+def bottleneck_distance(image, x, y, target_color=None, limit=None, metric=colorspace.DEFAULT_METRIC):
+    """Smallest tolerance at which each pixel joins the fill from (x, y)
+
+    flood_fill(image, x, y, t, target_color, metric) selects exactly the pixels
+    where this map is <= t, for every t, so changing the tolerance is a
+    threshold instead of a new fill. A pixel's value is the minimum over
+    paths from the seed of the largest color distance along the path.
+    Pixels are added one integer tolerance level at a time (a few hundred
+    at most) and joined to their neighbours in a union-find forest; a set
+    that joins the seed's set at level t gets the value t, so the cost is
+    close to linear in the area whatever the shape of the region. Pixels
+    that only join above limit get limit + 1. Returns uint16.
+    """
+    # Smallest integer tolerance t with distance <= t * t
+    levels = np.ceil(np.sqrt(colorspace.distance_map(image, x, y, target_color, metric))).astype(np.int32)
+    beyond = (int(levels.max()) if limit is None else limit) + 1
+    levels = np.minimum(levels, beyond)
+    result = np.full(levels.shape, beyond, dtype=np.uint16)
+
+    # Only the component reachable within limit can get a value; work in its box
+    reachable = connected_region(levels < beyond, x, y)
+    if not reachable.any():
+        return result
+    rows, columns = np.flatnonzero(reachable.any(axis=1)), np.flatnonzero(reachable.any(axis=0))
+    box = (slice(rows[0], rows[-1] + 1), slice(columns[0], columns[-1] + 1))
+    levels = np.where(reachable, levels, beyond)[box]
+    height, width = levels.shape
+    size = height * width
+    seed = (y - rows[0]) * width + (x - columns[0])
+    # Nothing joins below the seed's own level
+    seed_level = int(levels.flat[seed])
+    flat = np.maximum(levels.ravel(), seed_level).astype(np.uint16)
+    order = np.argsort(flat, kind="stable")
+    starts = np.searchsorted(flat[order], np.arange(seed_level, beyond + 1))
+
+    # parent is compressed as it is searched; hook keeps each set's first parent
+    parent = np.arange(size)
+    hook = parent.copy()
+    slot = np.zeros(size, dtype=np.intp)
+    joined = np.full(size, beyond, dtype=np.uint16)
+    for level in range(seed_level, beyond):
+        added = order[starts[level - seed_level]:starts[level - seed_level + 1]]
+        if len(added) == 0:
+            continue
+        pixels, neighbours = neighbour_pairs(added, width, size)
+        # Neighbours already added, each pair of newly added pixels once
+        inside = (flat[neighbours] < level) | ((flat[neighbours] == level) & (neighbours < pixels))
+        pixels, neighbours = pixels[inside], neighbours[inside]
+        seed_root = find_roots(parent, [seed])[0] if level > seed_level else -1
+
+        # Join the sets this level touches as a small labelling problem of their
+        # roots, numbered through slot without sorting
+        touched = np.concatenate((added, find_roots(parent, pixels), find_roots(parent, neighbours)))
+        slot[touched] = np.arange(len(touched))
+        roots = touched[slot[touched] == np.arange(len(touched))]
+        slot[roots] = np.arange(len(roots))
+        pairs = slot[touched[len(added):]].reshape(2, -1)
+        merged = roots[label_runs(len(roots), pairs[0], pairs[1])]
+        moved = merged != roots
+        parent[roots[moved]] = hook[roots[moved]] = merged[moved]
+
+        # Sets that were apart from the seed's set and are now part of it
+        now = find_roots(parent, [seed])[0]
+        joined[roots[(merged == now) & (roots != seed_root)]] = level
+
+    # Each pixel takes the value of the first set root above it that joined
+    marked = joined < beyond
+    target = np.where(marked, np.arange(size), hook)
+    while True:
+        jumped = target[target]
+        if np.array_equal(jumped, target):
+            break
+        target = jumped
+    result[box] = joined[target].reshape(height, width)
+    return result
+
+
+def to_mask_image(region):
+    """Convert a boolean map to an "L" mask with selected pixels at 255"""
+    return Image.fromarray(region.astype(np.uint8) * 255, "L")
@@ -0,0 +1,243 @@
+"""GrabCut-style foreground segmentation over superpixels.
+
+Foreground and background colors are each modelled by a Gaussian
+mixture. Every iteration labels the regions with a minimum s-t cut that
+trades off how well a region's color fits each model against cutting
+between similar neighbours, then refits the models to the new labelling.
+
+The graph has one node per superpixel (see superpixels.py), not per
+pixel, so a cut costs a few thousand nodes whatever the image size and
+the max-flow can be plain Python. Unary costs are scaled by region size
+and pairwise costs by the length of the shared border, so the energy is
+the pixel-level GrabCut energy with each region's pixels tied together.
+"""
+from collections import deque
+
+import numpy as np
+
+COMPONENTS = 5
+ITERATIONS = 5
+SMOOTHNESS = 50.0
+BOX_MARGIN = 0.05
+DISTINCT_COLOR = 40
+EPSILON = 1e-9
+
+
+class GaussianMixture:
+    """A Gaussian mixture over RGB colors, fitted to weighted samples"""
+
+    def __init__(self, samples, weights, components=COMPONENTS):
+        # Start from equal-weight slices of the samples sorted by brightness
+        order = np.argsort(samples.sum(axis=1))
+        cumulative = np.cumsum(weights[order]) / weights.sum()
+        assignment = np.empty(len(samples), dtype=np.int64)
+        assignment[order] = np.minimum((cumulative * components).astype(np.int64), components - 1)
+        self.components = components
+        self.fit(samples, weights, assignment)
+
+    def fit(self, samples, weights, assignment):
+        """Re-estimate weight, mean and covariance of every component"""
+        total = weights.sum()
+        self.weights = np.zeros(self.components)
+        self.means = np.zeros((self.components, 3))
+        self.inverses = np.tile(np.eye(3), (self.components, 1, 1))
+        self.log_norms = np.zeros(self.components)
+        for component in range(self.components):
+            member = assignment == component
+            weight = weights[member]
+            if weight.sum() <= 0:
+                continue
+            mean = np.average(samples[member], axis=0, weights=weight)
+            centered = samples[member] - mean
+            covariance = (centered * weight[:, None]).T @ centered / weight.sum() + np.eye(3) * 1.0
+            self.weights[component] = weight.sum() / total
+            self.means[component] = mean
+            self.inverses[component] = np.linalg.inv(covariance)
+            self.log_norms[component] = -0.5 * np.log(np.linalg.det(covariance)) - 1.5 * np.log(2 * np.pi)
+
+    def component_log_likelihoods(self, samples):
+        """(samples, components) log of weight times density"""
+        centered = samples[:, None, :] - self.means[None]
+        mahalanobis = np.einsum("nki,kij,nkj->nk", centered, self.inverses, centered)
+        with np.errstate(divide="ignore"):
+            return np.log(self.weights) + self.log_norms - 0.5 * mahalanobis
+
+    def assign(self, samples):
+        """Most likely component of every sample"""
+        return self.component_log_likelihoods(samples).argmax(axis=1)
+
+    def neg_log_likelihood(self, samples):
+        """-log p(sample) under the whole mixture"""
+        per_component = self.component_log_likelihoods(samples)
+        top = per_component.max(axis=1)
+        return -(top + np.log(np.exp(per_component - top[:, None]).sum(axis=1)))
+
+
+class FlowGraph:
+    """A directed graph with capacities, solved with Dinic's max-flow"""
+
+    def __init__(self, nodes):
+        self.head = [-1] * nodes
+        self.to = []
+        self.capacity = []
+        self.next = []
+
+    def add_edge(self, a, b, capacity, reverse_capacity=0.0):
+        """Edge a -> b; its paired edge b -> a gets reverse_capacity"""
+        for start, end, cap in ((a, b, capacity), (b, a, reverse_capacity)):
+            self.to.append(end)
+            self.capacity.append(cap)
+            self.next.append(self.head[start])
+            self.head[start] = len(self.to) - 1
+
+    def levels(self, source):
+        """Breadth-first distance from source over edges with capacity left"""
+        level = [-1] * len(self.head)
+        level[source] = 0
+        queue = deque([source])
+        while queue:
+            node = queue.popleft()
+            edge = self.head[node]
+            while edge != -1:
+                if self.capacity[edge] > EPSILON and level[self.to[edge]] < 0:
+                    level[self.to[edge]] = level[node] + 1
+                    queue.append(self.to[edge])
+                edge = self.next[edge]
+        return level
+
+    def max_flow(self, source, sink):
+        """Push as much flow as possible from source to sink; returns it"""
+        total = 0.0
+        capacity, to, next_edge = self.capacity, self.to, self.next
+        while True:
+            level = self.levels(source)
+            if level[sink] < 0:
+                return total
+            current = list(self.head)
+            path = []
+            node = source
+            # Depth-first search for shortest augmenting paths, iteratively
+            while True:
+                if node == sink:
+                    pushed = min(capacity[edge] for edge in path)
+                    for edge in path:
+                        capacity[edge] -= pushed
+                        capacity[edge ^ 1] += pushed
+                    total += pushed
+                    path = []
+                    node = source
+                    continue
+                edge = current[node]
+                while edge != -1 and (capacity[edge] <= EPSILON or level[to[edge]] != level[node] + 1):
+                    edge = next_edge[edge]
+                current[node] = edge
+                if edge != -1:
+                    path.append(edge)
+                    node = to[edge]
+                elif node == source:
+                    break
+                else:
+                    # Dead end: never come back here in this phase
+                    level[node] = -1
+                    node = to[path.pop() ^ 1]
+
+    def source_side(self, source):
+        """Boolean list of nodes still reachable from source after max_flow"""
+        return [level >= 0 for level in self.levels(source)]
+
+
+def smoothness_weights(regions):
+    """GrabCut's contrast-sensitive weights for every adjacent region pair"""
+    difference = ((regions.means[regions.upper] - regions.means[regions.lower]) ** 2).sum(axis=1)
+    mean_difference = np.average(difference, weights=regions.shared) if len(difference) else 0.0
+    beta = 1.0 / (2.0 * mean_difference) if mean_difference > 0 else 0.0
+    return SMOOTHNESS * regions.shared * np.exp(-beta * difference)
+
+
+def min_cut(foreground_costs, background_costs, upper, lower, weights, fixed_background):
+    """Label regions foreground (True) or background with a minimum cut
+
+    foreground_costs[i] is the cost of calling region i foreground, and so
+    on; fixed_background regions are forced to background.
+    """
+    count = len(foreground_costs)
+    source, sink = count, count + 1
+    graph = FlowGraph(count + 2)
+
+    # Cutting source -> i labels i background, cutting i -> sink foreground.
+    # Only the difference matters, so the smaller cost is pushed straight through.
+    shared = np.minimum(foreground_costs, background_costs)
+    to_source = background_costs - shared
+    to_sink = np.where(fixed_background, np.inf, foreground_costs - shared)
+    to_source[fixed_background] = 0.0
+    for region in range(count):
+        if to_source[region] > EPSILON:
+            graph.add_edge(source, region, float(to_source[region]))
+        if to_sink[region] > EPSILON:
+            graph.add_edge(region, sink, float(to_sink[region]))
+    for a, b, weight in zip(upper.tolist(), lower.tolist(), weights.tolist()):
+        graph.add_edge(a, b, weight, weight)
+
+    graph.max_flow(source, sink)
+    return np.array(graph.source_side(source)[:count])
+
+
+def default_box(regions):
+    """A box around whatever stands out from the image border
+
+    Regions whose mean color is far from every region touching the border
+    are the likely subject; the box is their bounding box plus a margin.
+    If nothing stands out, the whole image minus the margin.
+    """
+    labels = regions.labels
+    border = np.unique(np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]]))
+    distance = ((regions.means[:, None, :] - regions.means[None, border, :]) ** 2).sum(axis=2).min(axis=1)
+    distinct = np.isin(labels, np.flatnonzero(distance > DISTINCT_COLOR ** 2))
+
+    width, height = regions.image_size
+    margin_x, margin_y = width * BOX_MARGIN, height * BOX_MARGIN
+    if not distinct.any():
+        return (margin_x, margin_y, width - margin_x, height - margin_y)
+    rows, columns = np.flatnonzero(distinct.any(axis=1)), np.flatnonzero(distinct.any(axis=0))
+    scale_x, scale_y = width / regions.size[0], height / regions.size[1]
+    return (max(0, columns[0] * scale_x - margin_x), max(0, rows[0] * scale_y - margin_y),
+            min(width, (columns[-1] + 1) * scale_x + margin_x), min(height, (rows[-1] + 1) * scale_y + margin_y))
+
+
+def segment(regions, box=None, mask=None, iterations=ITERATIONS, progress=None):
+    """Find the foreground regions of a superpixels.SuperpixelIndex
+
+    Seeded from mask (an "L" selection) if given: selected regions start
+    as foreground, the rest as background. Otherwise from box (left, top,
+    right, bottom in image coordinates, default from default_box):
+    regions outside it are background for certain and the ones inside
+    start as foreground. Stops early when the labelling settles. Returns a
+    boolean map over regions.
+    """
+    if mask is not None:
+        foreground = regions.fraction_in(mask) >= 0.5
+        fixed_background = np.zeros(regions.count, dtype=bool)
+    else:
+        foreground = regions.fraction_inside(box or default_box(regions)) >= 0.5
+        fixed_background = ~foreground
+    if foreground.all() or not foreground.any():
+        return foreground
+
+    colors, sizes = regions.means, regions.sizes.astype(np.float64)
+    weights = smoothness_weights(regions)
+    foreground_model = GaussianMixture(colors[foreground], sizes[foreground])
+    background_model = GaussianMixture(colors[~foreground], sizes[~foreground])
+
+    for iteration in range(iterations):
+        if progress:
+            progress(iteration / iterations)
+        foreground_model.fit(colors[foreground], sizes[foreground], foreground_model.assign(colors[foreground]))
+        background_model.fit(colors[~foreground], sizes[~foreground], background_model.assign(colors[~foreground]))
+
+        labels = min_cut(sizes * foreground_model.neg_log_likelihood(colors),
+                         sizes * background_model.neg_log_likelihood(colors),
+                         regions.upper, regions.lower, weights, fixed_background)
+        if np.array_equal(labels, foreground) or labels.all() or not labels.any():
+            break
+        foreground = labels
+    return foreground
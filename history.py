@@ -0,0 +1,178 @@
+"""Multi-level undo/redo for image and selection edits.
+
+Nothing is stored as a full image copy. Image states are kept as
+zlib-compressed tiles of only the channels that differ from the base
+image (the loaded original, which is in memory anyway): applying a
+selection changes just the alpha channel, and a flat background color
+compresses to almost nothing. Selection states are the proxy-resolution
+mask, compressed, plus the operations that built it. The whole stack is
+trimmed from the oldest end to stay within a byte budget.
+"""
+import zlib
+
+import numpy as np
+from PIL import Image
+
+TILE_SIZE = 256
+DEFAULT_BUDGET = 64 * 1024 * 1024
+
+
+def rgba_bands(image):
+    """The image's R, G, B and A planes; a missing alpha reads as opaque"""
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    pixels = np.asarray(image)
+    bands = [pixels[..., band] for band in range(3)]
+    if image.mode == "RGBA":
+        bands.append(pixels[..., 3])
+    else:
+        bands.append(np.broadcast_to(np.uint8(255), pixels.shape[:2]))
+    return bands
+
+
+class ImageState:
+    """An image stored as compressed per-tile channel differences from a base"""
+
+    def __init__(self, image, base):
+        self.mode = image.mode
+        self.size = image.size
+        self.is_base = image is base
+        self.tiles = {}
+        if self.is_base:
+            return
+        if image.size != base.size:
+            raise ValueError("History only tracks edits that keep the image size")
+
+        starts_y = np.arange(0, image.height, TILE_SIZE)
+        starts_x = np.arange(0, image.width, TILE_SIZE)
+        for band, (pixels, base_pixels) in enumerate(zip(rgba_bands(image), rgba_bands(base))):
+            # Which tiles of this band differ at all, without a per-tile loop
+            changed = pixels != base_pixels
+            changed = np.logical_or.reduceat(changed, starts_y, axis=0)
+            changed = np.logical_or.reduceat(changed, starts_x, axis=1)
+            for row, column in zip(*np.nonzero(changed)):
+                y, x = starts_y[row], starts_x[column]
+                tile = np.ascontiguousarray(pixels[y:y + TILE_SIZE, x:x + TILE_SIZE])
+                self.tiles[(band, y, x)] = (tile.shape, zlib.compress(tile.tobytes(), 1))
+
+    @property
+    def nbytes(self):
+        return sum(len(data) for _, data in self.tiles.values())
+
+    def restore(self, base):
+        """Rebuild the image from the base plus the stored tiles"""
+        if self.is_base:
+            return base
+        bands = [np.array(pixels) for pixels in rgba_bands(base)]
+        for (band, y, x), (shape, data) in self.tiles.items():
+            bands[band][y:y + shape[0], x:x + shape[1]] = np.frombuffer(zlib.decompress(data), np.uint8).reshape(shape)
+
+        if self.mode == "RGB":
+            return Image.fromarray(np.dstack(bands[:3]), "RGB")
+        image = Image.fromarray(np.dstack(bands), "RGBA")
+        return image if self.mode == "RGBA" else image.convert(self.mode)
+
+
+class SelectionState:
+    """A compressed selection mask plus the operations that produced it"""
+
+    def __init__(self, operations, mask):
+        self.operations = list(operations)
+        self.size = mask.size if mask is not None else None
+        self.data = zlib.compress(mask.tobytes()) if mask is not None else None
+
+    @property
+    def nbytes(self):
+        return len(self.data) if self.data else 0
+
+    def restore(self):
+        """The (operations, mask) pair; mask is None for no selection"""
+        mask = Image.frombytes("L", self.size, zlib.decompress(self.data)) if self.data else None
+        return list(self.operations), mask
+
+
+class Edit:
+    """One undoable step: the states before and after it"""
+
+    def __init__(self, kind, before, after):
+        self.kind = kind  # "image" or "selection"
+        self.before = before
+        self.after = after
+
+    @property
+    def nbytes(self):
+        return self.before.nbytes + self.after.nbytes
+
+
+class History:
+    """Undo and redo stacks of edits within a memory budget"""
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.base = None
+        self.undo_stack = []
+        self.redo_stack = []
+        self.last_image_state = None
+
+    def reset(self, base):
+        """Forget all edits and diff future image states against base"""
+        self.base = base
+        self.undo_stack = []
+        self.redo_stack = []
+        self.last_image_state = None
+
+    @property
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    @property
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    @property
+    def nbytes(self):
+        return sum(edit.nbytes for edit in self.undo_stack + self.redo_stack)
+
+    def image_state(self, image):
+        # The previous edit's "after" is usually the next one's "before"
+        if self.last_image_state and self.last_image_state[0] is image:
+            return self.last_image_state[1]
+        state = ImageState(image, self.base)
+        self.last_image_state = (image, state)
+        return state
+
+    def record_image(self, before, after):
+        """Record an edit that replaced the image before with after"""
+        before_state = self.image_state(before)
+        self.push(Edit("image", before_state, self.image_state(after)))
+
+    def record_selection(self, before, after):
+        """Record a selection change; before and after are (operations, mask)"""
+        self.push(Edit("selection", SelectionState(*before), SelectionState(*after)))
+
+    def push(self, edit):
+        self.undo_stack.append(edit)
+        self.redo_stack = []
+        self.trim()
+
+    def trim(self):
+        """Drop the oldest edits until the stacks fit the budget"""
+        total = self.nbytes
+        while total > self.budget and len(self.undo_stack) > 1:
+            total -= self.undo_stack.pop(0).nbytes
+
+    def undo(self):
+        """Step back; returns the edit whose before state should be restored"""
+        if not self.undo_stack:
+            return None
+        edit = self.undo_stack.pop()
+        self.redo_stack.append(edit)
+        return edit
+
+    def redo(self):
+        """Step forward; returns the edit whose after state should be restored"""
+        if not self.redo_stack:
+            return None
+        edit = self.redo_stack.pop()
+        self.undo_stack.append(edit)
+        return edit
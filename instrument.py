@@ -0,0 +1,205 @@
+"""Timers and counters for the pipeline stages.
+
+Code marks its stages with the timed decorator or a stage() block:
+
+    @instrument.timed("fill")
+    def flood_fill(...):
+
+    with instrument.stage("decode"):
+        image.load()
+
+Instrumentation is off by default, and then both cost one flag check, so
+the marks stay in place in every build. Turned on with enable() (or the
+BG_REMOVER_TRACE environment variable: "1", or a file name for a JSON
+trace), each stage's calls, total, last and longest time are collected,
+together with counters such as cache hits. snapshot() returns them as a
+plain dict that the GUI status bar and the batch summary both format with
+summary(); with a trace file every finished stage is also appended as one
+JSON line. profile() adds cProfile and tracemalloc around a block.
+
+Stages may nest (composite includes matte); each is timed on its own.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+ENVIRONMENT_VARIABLE = "BG_REMOVER_TRACE"
+PROFILE_LINES = 25
+# Counters that hold a high-water mark, which merge() keeps the larger of
+PEAK_COUNTERS = ("peak bytes",)
+
+enabled = False
+_lock = threading.Lock()
+_stages = {}
+_counters = {}
+_trace = None
+_no_stage = nullcontext()
+
+
+def enable(trace_path=None):
+    """Start collecting; with trace_path, also append JSON lines there"""
+    global enabled, _trace
+    with _lock:
+        if _trace is not None:
+            _trace.close()
+        # Line buffered appends, so processes sharing the file never interleave lines
+        _trace = open(trace_path, "a", buffering=1) if trace_path else None
+        enabled = True
+
+
+def disable():
+    """Stop collecting; what was collected stays until reset()"""
+    global enabled, _trace
+    with _lock:
+        enabled = False
+        if _trace is not None:
+            _trace.close()
+            _trace = None
+
+
+def reset():
+    """Forget all collected timings and counters"""
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+
+def record(name, seconds):
+    """Add one finished call of stage name that took seconds"""
+    with _lock:
+        entry = _stages.get(name)
+        if entry is None:
+            _stages[name] = {"calls": 1, "seconds": seconds, "last": seconds, "max": seconds}
+        else:
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            entry["last"] = seconds
+            entry["max"] = max(entry["max"], seconds)
+        if _trace is not None:
+            _trace.write(json.dumps({"stage": name, "end": round(time.time(), 6), "seconds": round(seconds, 6),
+                                     "pid": os.getpid(), "thread": threading.current_thread().name}) + "\n")
+
+
+def count(name, amount=1):
+    """Add amount to counter name"""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+@contextmanager
+def _timed_stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def stage(name):
+    """Context manager timing a block as stage name"""
+    return _timed_stage(name) if enabled else _no_stage
+
+
+def timed(name):
+    """Decorator timing every call of a function as stage name"""
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+def snapshot():
+    """Collected timings and counters as a JSON-ready dict"""
+    with _lock:
+        return {"stages": {name: dict(entry) for name, entry in _stages.items()}, "counters": dict(_counters)}
+
+
+def merge(total, part):
+    """Add snapshot part into snapshot total, e.g. from a worker process"""
+    for name, entry in part["stages"].items():
+        mine = total["stages"].get(name)
+        if mine is None:
+            total["stages"][name] = dict(entry)
+        else:
+            mine["calls"] += entry["calls"]
+            mine["seconds"] += entry["seconds"]
+            mine["last"] = entry["last"]
+            mine["max"] = max(mine["max"], entry["max"])
+    for name, value in part["counters"].items():
+        if name in PEAK_COUNTERS:
+            total["counters"][name] = max(total["counters"].get(name, 0), value)
+        else:
+            total["counters"][name] = total["counters"].get(name, 0) + value
+    return total
+
+
+def format_seconds(seconds):
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.2f}s"
+
+
+def summary(data=None, last=False, limit=None):
+    """One line per stage, slowest first, for a status bar or a report
+
+    With last, each stage shows its most recent call instead of its total.
+    """
+    data = snapshot() if data is None else data
+    key = "last" if last else "seconds"
+    stages = sorted(data["stages"].items(), key=lambda item: -item[1][key])[:limit]
+    lines = [f"{name}: {format_seconds(entry[key])}" + ("" if last else f" in {entry['calls']:,} calls, "
+                                                        f"max {format_seconds(entry['max'])}")
+             for name, entry in stages]
+    lines += [f"{name}: {value:,}" for name, value in sorted(data["counters"].items())]
+    return "\n".join(lines)
+
+
+@contextmanager
+def profile(path=None, memory=False):
+    """cProfile (and with memory, tracemalloc) around a block
+
+    The profile is written to path for pstats/snakeviz, or printed (the
+    slowest functions by cumulative time) without one. The tracemalloc
+    peak, in bytes, goes to the "peak bytes" counter.
+    """
+    profiler = cProfile.Profile()
+    tracing = memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            with _lock:
+                _counters["peak bytes"] = max(_counters.get("peak bytes", 0), peak)
+        if tracing:
+            tracemalloc.stop()
+        if path:
+            profiler.dump_stats(path)
+        else:
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            print(output.getvalue())
+
+
+if os.environ.get(ENVIRONMENT_VARIABLE):
+    _setting = os.environ[ENVIRONMENT_VARIABLE]
+    enable(None if _setting == "1" else _setting)
@@ -1,9 +1,28 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, colorchooser
-from PIL import Image, ImageTk, ImageDraw, ImageFilter, ImageEnhance
+from PIL import Image, ImageTk
 import os
-import math
-from collections import deque
+
+import colorspace
+import engine
+import export
+import instrument
+import maskfile
+from overlay import SelectionOverlay
+from pyramid import PyramidCache
+from selection import Selection, Stroke, uses_regions
+from superpixels import SuperpixelCache
+from worker import TaskRunner
+from history import History
+
+CANVAS_SIZE = (800, 700)
+BRUSH_SIZE = 20
+TIMINGS_REFRESH_MS = 500
+TIMINGS_SHOWN = 6
+SAVE_POLL_MS = 100
+AUTO_PRESET = "auto"
+# Widgets where Backspace edits text instead of undoing
+TEXT_WIDGET_CLASSES = ("Entry", "TEntry", "Spinbox", "TSpinbox", "TCombobox")
 
 class SmartBackgroundRemover:
     def __init__(self, root):
@@ -14,8 +33,16 @@ class SmartBackgroundRemover:
         # Variables
         self.original_image = None
         self.processed_image = None
+        self.preview_image = None
         self.display_image = None
-        self.backup_image = None
+        self.cutout_image = None
+        self.history = History()
+        self.pyramids = PyramidCache()
+        self.superpixels = SuperpixelCache()
+        self.tasks = TaskRunner(root)
+        # Task id of the last Apply, cancelled if the selection changes under it
+        self.apply_task = None
+        self.exporter = export.Exporter()
         
         # Display scaling info
         self.scale_factor = 1.0
@@ -28,8 +55,15 @@ class SmartBackgroundRemover:
         self.selection_lines = []
         self.magic_wand_tolerance = 30
         
-        # Smart selection
+        # Smart selection (mask is at proxy resolution, see Selection)
+        self.selection = None
         self.selection_mask = None
+        self.tolerance_before = None
+        self.stroke = None
+        self.stroke_before = None
+        self.lasso_points = []
+        self.overlay = None
+        self.overlay_tiles = {}
         
         # Background color
         self.bg_color = (255, 255, 255)
@@ -80,9 +114,21 @@ class SmartBackgroundRemover:
         
         self.additive_mode = tk.BooleanVar(value=True)
         self.additive_check = ttk.Checkbutton(wand_mode_frame, text="✚ Add to selection", 
-                                             variable=self.additive_mode)
+                                             variable=self.additive_mode,
+                                             command=lambda: self.subtract_mode.set(False))
         self.additive_check.pack(side=tk.LEFT)
         
+        self.subtract_mode = tk.BooleanVar(value=False)
+        self.subtract_check = ttk.Checkbutton(wand_mode_frame, text="➖ Subtract", 
+                                             variable=self.subtract_mode,
+                                             command=lambda: self.additive_mode.set(False))
+        self.subtract_check.pack(side=tk.LEFT, padx=(5, 0))
+        
+        self.region_mode = tk.BooleanVar(value=False)
+        self.region_check = ttk.Checkbutton(wand_mode_frame, text="🧩 Snap to regions", 
+                                           variable=self.region_mode)
+        self.region_check.pack(side=tk.LEFT, padx=(5, 0))
+        
         self.wand_reset_btn = ttk.Button(wand_mode_frame, text="🗑️", width=3,
                                         command=self.reset_wand_selection, state="disabled")
         self.wand_reset_btn.pack(side=tk.RIGHT)
@@ -93,17 +139,25 @@ class SmartBackgroundRemover:
         
         ttk.Label(tolerance_frame, text="Sensitivity:").pack(side=tk.LEFT)
         self.tolerance_var = tk.IntVar(value=30)
-        tolerance_slider = ttk.Scale(tolerance_frame, from_=5, to=100, 
+        tolerance_slider = ttk.Scale(tolerance_frame, from_=5, to=engine.MAX_TOLERANCE, 
                                    variable=self.tolerance_var, orient=tk.HORIZONTAL)
         tolerance_slider.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(5, 0))
         self.tolerance_label = ttk.Label(tolerance_frame, text="30")
         self.tolerance_label.pack(side=tk.RIGHT, padx=(5, 0))
         
-        # Update tolerance display
+        # Color distance the magic wand measures tolerance in
+        self.metric_var = tk.StringVar(value=colorspace.DEFAULT_METRIC)
+        metric_combo = ttk.Combobox(tolerance_frame, textvariable=self.metric_var, values=colorspace.METRICS,
+                                    state="readonly", width=8)
+        metric_combo.pack(side=tk.RIGHT, padx=(5, 0))
+        
+        # Update tolerance display, and the last wand click with it
         def update_tolerance(*args):
             self.magic_wand_tolerance = self.tolerance_var.get()
             self.tolerance_label.config(text=str(self.magic_wand_tolerance))
+            self.adjust_wand_tolerance()
         self.tolerance_var.trace('w', update_tolerance)
+        tolerance_slider.bind("<ButtonRelease-1>", lambda event: self.record_tolerance_change())
         
         # Smart Object Detection
         self.smart_object_btn = ttk.Button(control_frame, text="🔍 Auto-Detect Main Object", 
@@ -115,38 +169,93 @@ class SmartBackgroundRemover:
                                          command=self.smart_edge_selection, state="disabled")
         self.edge_detect_btn.grid(row=7, column=0, columnspan=2, pady=5, sticky=(tk.W, tk.E))
         
-        # Manual selection (backup)
-        self.manual_btn = ttk.Button(control_frame, text="✏️ Manual Selection (Click Points)", 
+        # Manual selection (backup) and freehand tools
+        draw_frame = ttk.Frame(control_frame)
+        draw_frame.grid(row=8, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
+        
+        self.manual_btn = ttk.Button(draw_frame, text="✏️ Manual Selection (Click Points)", 
                                     command=self.activate_manual_selection, state="disabled")
-        self.manual_btn.grid(row=8, column=0, columnspan=2, pady=5, sticky=(tk.W, tk.E))
+        self.manual_btn.pack(fill=tk.X)
+        
+        brush_frame = ttk.Frame(draw_frame)
+        brush_frame.pack(fill=tk.X, pady=(5, 0))
+        
+        self.brush_btn = ttk.Button(brush_frame, text="🖌️ Brush", 
+                                   command=self.activate_brush, state="disabled")
+        self.brush_btn.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        
+        self.lasso_btn = ttk.Button(brush_frame, text="➰ Lasso", 
+                                   command=self.activate_lasso, state="disabled")
+        self.lasso_btn.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        
+        # Brush diameter in screen pixels
+        self.brush_size_var = tk.IntVar(value=BRUSH_SIZE)
+        ttk.Spinbox(brush_frame, from_=1, to=200, textvariable=self.brush_size_var, 
+                    width=4).pack(side=tk.RIGHT, padx=(5, 0))
         
         # Selection controls
         selection_control_frame = ttk.Frame(control_frame)
         selection_control_frame.grid(row=9, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=10)
         
-        self.clear_btn = ttk.Button(selection_control_frame, text="🗑️ Clear", 
+        edit_frame = ttk.Frame(selection_control_frame)
+        edit_frame.pack(fill=tk.X)
+        
+        self.clear_btn = ttk.Button(edit_frame, text="🗑️ Clear", 
                                    command=self.clear_selection, state="disabled")
         self.clear_btn.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
         
-        self.invert_btn = ttk.Button(selection_control_frame, text="🔄 Invert", 
+        self.invert_btn = ttk.Button(edit_frame, text="🔄 Invert", 
                                     command=self.invert_selection, state="disabled")
         self.invert_btn.pack(side=tk.RIGHT, fill=tk.X, expand=True)
         
+        # Selections saved to compact files (see maskfile.py) for later or for batch.py
+        stored_frame = ttk.Frame(selection_control_frame)
+        stored_frame.pack(fill=tk.X, pady=(5, 0))
+        
+        self.save_selection_btn = ttk.Button(stored_frame, text="💾 Save Selection", 
+                                            command=self.save_selection, state="disabled")
+        self.save_selection_btn.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        
+        self.load_selection_btn = ttk.Button(stored_frame, text="📂 Load Selection", 
+                                            command=self.load_selection, state="disabled")
+        self.load_selection_btn.pack(side=tk.RIGHT, fill=tk.X, expand=True)
+        
+        # Edge feather slider for apply
+        feather_frame = ttk.Frame(control_frame)
+        feather_frame.grid(row=10, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
+        
+        ttk.Label(feather_frame, text="Edge feather:").pack(side=tk.LEFT)
+        self.feather_var = tk.IntVar(value=0)
+        feather_slider = ttk.Scale(feather_frame, from_=0, to=10, 
+                                   variable=self.feather_var, orient=tk.HORIZONTAL)
+        feather_slider.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(5, 0))
+        self.feather_label = ttk.Label(feather_frame, text="0 px")
+        self.feather_label.pack(side=tk.RIGHT, padx=(5, 0))
+        
+        self.matte_mode = tk.BooleanVar(value=False)
+        self.matte_check = ttk.Checkbutton(feather_frame, text="🪶 Soft edges",
+                                          variable=self.matte_mode)
+        self.matte_check.pack(side=tk.RIGHT, padx=(5, 0))
+        
+        def update_feather(*args):
+            self.feather_label.config(text=f"{self.feather_var.get()} px")
+        self.feather_var.trace('w', update_feather)
+        
         self.apply_btn = ttk.Button(control_frame, text="✅ Apply Selection", 
                                    command=self.apply_selection, state="disabled")
-        self.apply_btn.grid(row=10, column=0, columnspan=2, pady=10, sticky=(tk.W, tk.E))
+        self.apply_btn.grid(row=11, column=0, columnspan=2, pady=10, sticky=(tk.W, tk.E))
         
         # Separator
-        ttk.Separator(control_frame, orient='horizontal').grid(row=11, column=0, columnspan=2,
+        ttk.Separator(control_frame, orient='horizontal').grid(row=12, column=0, columnspan=2,
                                                               sticky=(tk.W, tk.E), pady=15)
         
         # Background section
         bg_label = ttk.Label(control_frame, text="🎨 New Background", font=("Arial", 14, "bold"))
-        bg_label.grid(row=12, column=0, columnspan=2, sticky=tk.W, pady=(0, 10))
+        bg_label.grid(row=13, column=0, columnspan=2, sticky=tk.W, pady=(0, 10))
         
         # Quick color buttons
         color_frame = ttk.Frame(control_frame)
-        color_frame.grid(row=13, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
+        color_frame.grid(row=14, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
         
         self.white_btn = ttk.Button(color_frame, text="⚪", width=4,
                                    command=lambda: self.quick_color((255, 255, 255)), state="disabled")
@@ -170,45 +279,82 @@ class SmartBackgroundRemover:
         
         self.transparent_btn = ttk.Button(control_frame, text="🔳 Keep Transparent", 
                                          command=self.make_transparent, state="disabled")
-        self.transparent_btn.grid(row=14, column=0, columnspan=2, pady=5, sticky=(tk.W, tk.E))
+        self.transparent_btn.grid(row=15, column=0, columnspan=2, pady=5, sticky=(tk.W, tk.E))
         
         self.custom_color_btn = ttk.Button(control_frame, text="🎨 Custom Color", 
                                           command=self.choose_custom_color, state="disabled")
-        self.custom_color_btn.grid(row=15, column=0, columnspan=2, pady=5, sticky=(tk.W, tk.E))
+        self.custom_color_btn.grid(row=16, column=0, columnspan=2, pady=5, sticky=(tk.W, tk.E))
         
         # Color preview
         self.color_preview = tk.Frame(control_frame, width=60, height=30, 
                                      bg="white", relief="sunken", bd=2)
-        self.color_preview.grid(row=16, column=0, columnspan=2, pady=10)
+        self.color_preview.grid(row=17, column=0, columnspan=2, pady=10)
         
         # Separator
-        ttk.Separator(control_frame, orient='horizontal').grid(row=17, column=0, columnspan=2,
+        ttk.Separator(control_frame, orient='horizontal').grid(row=18, column=0, columnspan=2,
                                                               sticky=(tk.W, tk.E), pady=15)
         
         # Actions
         actions_label = ttk.Label(control_frame, text="💾 Save Result", font=("Arial", 14, "bold"))
-        actions_label.grid(row=18, column=0, columnspan=2, sticky=tk.W, pady=(0, 10))
+        actions_label.grid(row=19, column=0, columnspan=2, sticky=tk.W, pady=(0, 10))
         
         action_frame = ttk.Frame(control_frame)
-        action_frame.grid(row=19, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
+        action_frame.grid(row=20, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=5)
         
         self.undo_btn = ttk.Button(action_frame, text="↶ Undo", 
                                   command=self.undo, state="disabled")
         self.undo_btn.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
         
+        self.redo_btn = ttk.Button(action_frame, text="↷ Redo", 
+                                  command=self.redo, state="disabled")
+        self.redo_btn.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        
         self.reset_btn = ttk.Button(action_frame, text="🔄 Reset", 
                                    command=self.reset, state="disabled")
         self.reset_btn.pack(side=tk.RIGHT, fill=tk.X, expand=True)
         
-        self.save_btn = ttk.Button(control_frame, text="💾 Save Image", 
+        save_frame = ttk.Frame(control_frame)
+        save_frame.grid(row=21, column=0, columnspan=2, pady=10, sticky=(tk.W, tk.E))
+        
+        self.save_btn = ttk.Button(save_frame, text="💾 Save Image", 
                                   command=self.save_image, state="disabled")
-        self.save_btn.grid(row=20, column=0, columnspan=2, pady=10, sticky=(tk.W, tk.E))
+        self.save_btn.pack(fill=tk.X)
+        
+        # Encoder preset (auto picks by file extension) and cropping to the subject
+        save_options = ttk.Frame(save_frame)
+        save_options.pack(fill=tk.X, pady=(5, 0))
+        
+        self.export_preset_var = tk.StringVar(value=AUTO_PRESET)
+        self.export_preset_box = ttk.Combobox(save_options, textvariable=self.export_preset_var, width=13,
+                                             values=[AUTO_PRESET] + list(export.PRESETS), state="readonly")
+        self.export_preset_box.pack(side=tk.LEFT)
+        
+        self.crop_export_var = tk.BooleanVar(value=False)
+        self.crop_export_check = ttk.Checkbutton(save_options, text="✂️ Crop to subject", 
+                                                variable=self.crop_export_var)
+        self.crop_export_check.pack(side=tk.LEFT, padx=(10, 0))
         
         # Status
         self.status_label = ttk.Label(control_frame, text="🚀 Ready! Upload an image to start using smart tools", 
                                      font=("Arial", 10), foreground="blue",
                                      wraplength=250, justify=tk.LEFT)
-        self.status_label.grid(row=21, column=0, columnspan=2, pady=15)
+        self.status_label.grid(row=22, column=0, columnspan=2, pady=15)
+        
+        self.cancel_btn = ttk.Button(control_frame, text="✖ Cancel", 
+                                    command=self.cancel_task, state="disabled")
+        self.cancel_btn.grid(row=23, column=0, columnspan=2, pady=5, sticky=(tk.W, tk.E))
+        
+        # Per-stage timings of the latest operations (see instrument.py)
+        self.timings_mode = tk.BooleanVar(value=instrument.enabled)
+        self.timings_check = ttk.Checkbutton(control_frame, text="⏱ Show timings", 
+                                            variable=self.timings_mode, command=self.toggle_timings)
+        self.timings_check.grid(row=24, column=0, columnspan=2, sticky=tk.W)
+        
+        self.timings_label = ttk.Label(control_frame, text="", font=("Courier", 9), foreground="gray",
+                                      justify=tk.LEFT)
+        self.timings_label.grid(row=25, column=0, columnspan=2, sticky=tk.W)
+        if instrument.enabled:
+            self.update_timings()
         
         # Right panel - Image display
         image_frame = ttk.LabelFrame(main_frame, text="🖼️ Image Preview", padding="15")
@@ -228,9 +374,16 @@ class SmartBackgroundRemover:
         self.canvas.create_text(400, 350, text=help_text, 
                                font=("Arial", 14), fill="gray", justify=tk.CENTER)
         
+        # Undo/redo shortcuts
+        self.root.bind("<Control-z>", lambda event: self.undo())
+        self.root.bind("<Control-y>", lambda event: self.redo())
+        self.root.bind("<Control-Shift-Z>", lambda event: self.redo())
+        self.root.bind("<BackSpace>", self.on_backspace)
+        
         # Bind click events
         self.canvas.bind("<Button-1>", self.on_canvas_click)
         self.canvas.bind("<B1-Motion>", self.on_canvas_drag)
+        self.canvas.bind("<ButtonRelease-1>", self.on_canvas_release)
         self.canvas.bind("<Double-Button-1>", self.on_canvas_double_click)
         
         # Configure grid
@@ -257,8 +410,14 @@ class SmartBackgroundRemover:
     def load_image(self, filename):
         """Load an image file"""
         try:
-            self.original_image = Image.open(filename)
-            self.processed_image = self.original_image.copy()
+            # Large JPEGs show a reduced decode now; full pixels wait for a tool
+            self.original_image = engine.open_image(filename)
+            self.preview_image = engine.load_preview(filename, CANVAS_SIZE)
+            if self.preview_image is None:
+                self.original_image.load()
+            self.processed_image = self.original_image
+            self.pyramids.clear()
+            self.superpixels.clear()
             
             # Reset states
             self.reset_selection_state()
@@ -270,6 +429,9 @@ class SmartBackgroundRemover:
             self.smart_object_btn.config(state="normal")
             self.edge_detect_btn.config(state="normal")
             self.manual_btn.config(state="normal")
+            self.brush_btn.config(state="normal")
+            self.lasso_btn.config(state="normal")
+            self.load_selection_btn.config(state="normal")
             self.save_btn.config(state="normal")
             self.reset_btn.config(state="normal")
             
@@ -280,18 +442,26 @@ class SmartBackgroundRemover:
     
     def reset_selection_state(self):
         """Reset all selection-related state"""
+        self.cancel_task()
         self.selection_points = []
         self.selection_lines = []
+        self.selection = None
         self.selection_mask = None
-        self.backup_image = None
+        self.tolerance_before = None
+        self.stroke = None
+        self.lasso_points = []
+        self.canvas.delete("lasso")
+        self.cutout_image = None
+        self.history.reset(self.original_image)
         self.selection_mode = "none"
         self.canvas.config(cursor="")
         
         # Reset button states
         self.clear_btn.config(state="disabled")
         self.invert_btn.config(state="disabled")
+        self.save_selection_btn.config(state="disabled")
         self.apply_btn.config(state="disabled")
-        self.undo_btn.config(state="disabled")
+        self.update_history_buttons()
         self.wand_reset_btn.config(state="disabled")
         
         # Disable background options
@@ -301,11 +471,17 @@ class SmartBackgroundRemover:
     
     def reset_wand_selection(self):
         """Reset/clear magic wand selection only"""
+        self.cancel_task()
+        if self.selection_mask:
+            self.history.record_selection(self.selection_snapshot(), ([], None))
+            self.update_history_buttons()
+        self.selection = None
         self.selection_mask = None
         self.canvas.delete("overlay")
         
         self.clear_btn.config(state="disabled")
         self.invert_btn.config(state="disabled")
+        self.save_selection_btn.config(state="disabled")
         self.apply_btn.config(state="disabled")
         
         self.status_label.config(text="🗑️ Magic wand selection cleared! Click areas to start fresh.")
@@ -316,7 +492,9 @@ class SmartBackgroundRemover:
         self.canvas.config(cursor="target")
         self.wand_reset_btn.config(state="normal")
         
-        if self.additive_mode.get():
+        if self.subtract_mode.get():
+            self.status_label.config(text="🪄 Magic Wand active! ➖ SUBTRACT MODE\nClick areas to remove them from the selection.")
+        elif self.additive_mode.get():
             self.status_label.config(text="🪄 Magic Wand active! ✚ ADDITIVE MODE\nClick multiple areas to build selection.\nUncheck 'Add to selection' for single-click mode.")
         else:
             self.status_label.config(text="🪄 Magic Wand active! Single-click mode.\nCheck 'Add to selection' to build up selection.")
@@ -335,8 +513,208 @@ class SmartBackgroundRemover:
         self.clear_btn.config(state="normal")
         self.status_label.config(text="✏️ Manual mode: Click points around the object you want to KEEP.\nClick at least 3 points to form a shape.\nDouble-click to apply selection quickly!")
     
+    def activate_brush(self):
+        """Activate brush painting mode"""
+        self.selection_mode = "brush"
+        self.canvas.config(cursor="circle")
+        
+        if self.subtract_mode.get():
+            self.status_label.config(text="🖌️ Brush active! ➖ SUBTRACT MODE\nDrag to erase from the selection.")
+        else:
+            self.status_label.config(text="🖌️ Brush active! Drag to paint the selection.\nCheck 'Subtract' to erase; set the brush size next to Lasso.")
+    
+    def activate_lasso(self):
+        """Activate freehand lasso selection mode"""
+        self.selection_mode = "lasso"
+        self.canvas.config(cursor="pencil")
+        
+        if self.subtract_mode.get():
+            self.status_label.config(text="➰ Lasso active! ➖ SUBTRACT MODE\nDrag around an area to remove it from the selection.")
+        else:
+            self.status_label.config(text="➰ Lasso active! Drag around the area you want to KEEP.\nRelease to close the shape.")
+    
+    def wand_combine_mode(self):
+        """How a new magic wand region combines with the current selection"""
+        if self.subtract_mode.get():
+            return "subtract"
+        if self.additive_mode.get():
+            return "add"
+        return "replace"
+    
+    def current_selection(self):
+        """The selection for the current image, on a proxy that fits the canvas"""
+        if self.selection is None or self.selection.image is not self.processed_image:
+            display_size = (int(self.processed_image.width * self.scale_factor),
+                            int(self.processed_image.height * self.scale_factor))
+            proxy = self.pyramids.get(self.processed_image).level_for(display_size)
+            self.selection = Selection(self.processed_image, proxy)
+        return self.selection
+    
+    def selection_snapshot(self):
+        """The current (operations, proxy mask) pair, for the history"""
+        if self.selection is None or self.selection_mask is None:
+            return [], None
+        return list(self.selection.operations), self.selection.mask
+    
+    def cancel_apply(self):
+        """Cancel a running Apply before its selection is edited
+        
+        Its result would replace the image and reset the selection,
+        throwing the new edit away.
+        """
+        if self.tasks.busy and self.tasks.task_id == self.apply_task:
+            self.cancel_task()
+    
+    def perform_selection(self, operation, record=True):
+        """Run a quick selection operation on the proxy image
+        
+        Returns the proxy-space box that changed, or None for everything.
+        """
+        self.cancel_apply()
+        self.record_tolerance_change()
+        before = self.selection_snapshot()
+        dirty_box = self.current_selection().perform(operation)
+        self.selection_mask = self.selection.mask
+        if record:
+            self.history.record_selection(before, self.selection_snapshot())
+            self.update_history_buttons()
+        return dirty_box
+    
+    def restore_selection(self, operations, mask):
+        """Show an earlier selection state from the history"""
+        selection = self.current_selection()
+        if mask is not None and mask.size != selection.proxy.size:
+            mask = mask.resize(selection.proxy.size, Image.Resampling.NEAREST)
+        selection.restore(operations, mask)
+        self.selection_mask = mask
+        
+        state = "normal" if mask else "disabled"
+        self.clear_btn.config(state=state)
+        self.invert_btn.config(state=state)
+        self.save_selection_btn.config(state=state)
+        self.apply_btn.config(state=state)
+        if mask:
+            self.visualize_selection()
+        else:
+            self.canvas.delete("overlay")
+    
+    def run_task(self, message, work, on_done, error_message):
+        """Run work(progress) on the worker thread, then on_done(result) here
+        
+        Starting another task (or clearing/resetting) cancels this one and
+        its result is dropped.
+        """
+        def on_progress(fraction):
+            self.status_label.config(text=f"{message} {fraction:.0%}")
+        
+        def finish(result):
+            self.cancel_btn.config(state="disabled")
+            on_done(result)
+        
+        def on_error(error):
+            self.cancel_btn.config(state="disabled")
+            messagebox.showerror("Error", f"{error_message}: {str(error)}")
+        
+        self.status_label.config(text=message)
+        self.cancel_btn.config(state="normal")
+        self.tasks.start(work, finish, on_progress, on_error)
+    
+    def toggle_timings(self):
+        """Turn the stage timers on or off"""
+        if self.timings_mode.get():
+            instrument.reset()
+            instrument.enable()
+            self.update_timings()
+        else:
+            instrument.disable()
+            self.timings_label.config(text="")
+    
+    def update_timings(self):
+        """Show the latest time of the slowest stages, while timing is on"""
+        if not instrument.enabled:
+            return
+        self.timings_label.config(text=instrument.summary(last=True, limit=TIMINGS_SHOWN))
+        self.root.after(TIMINGS_REFRESH_MS, self.update_timings)
+    
+    def cancel_task(self):
+        """Cancel the running background operation, if any"""
+        if self.tasks.busy:
+            self.tasks.cancel()
+            self.status_label.config(text="✖ Operation cancelled.")
+        self.cancel_btn.config(state="disabled")
+    
+    def with_full_image(self, action):
+        """Call action once the full-resolution image has been decoded
+        
+        load_image only decodes a reduced preview of large JPEGs; the first
+        tool that needs real pixels decodes the rest on the worker thread.
+        """
+        if self.preview_image is None:
+            action()
+            return
+        
+        image = self.original_image
+        
+        def decode(progress):
+            with instrument.stage("decode"):
+                image.load()
+        
+        def finish(_):
+            self.preview_image = None
+            action()
+        
+        self.run_task("⏳ Decoding full-resolution image...", decode, finish, "Failed to decode image")
+    
+    def regions_ready(self):
+        """True once the current selection has its superpixel index"""
+        selection = self.current_selection()
+        if selection.regions is None:
+            selection.regions = self.superpixels.peek(selection.image)
+        return selection.regions is not None
+    
+    def with_regions(self, action):
+        """Build the superpixel index on the worker thread, then call action"""
+        selection = self.current_selection()
+        image = selection.image
+        
+        def finish(regions):
+            selection.regions = regions
+            action()
+        
+        self.run_task("🧩 Finding regions...", lambda progress: self.superpixels.get(image, progress), finish,
+                      "Region segmentation failed")
+    
+    def run_selection_task(self, operation, message, done_message, error_message):
+        """Run a slow selection operation in the background and show the result"""
+        if self.preview_image is not None:
+            self.with_full_image(lambda: self.run_selection_task(operation, message, done_message, error_message))
+            return
+        if uses_regions(operation) and not self.regions_ready():
+            self.with_regions(lambda: self.run_selection_task(operation, message, done_message, error_message))
+            return
+        
+        selection = self.current_selection()
+        
+        def finish(result):
+            mask, _ = result
+            before = self.selection_snapshot()
+            selection.commit(operation, mask)
+            self.selection_mask = selection.mask
+            self.history.record_selection(before, self.selection_snapshot())
+            self.update_history_buttons()
+            self.visualize_selection()
+            
+            self.clear_btn.config(state="normal")
+            self.invert_btn.config(state="normal")
+            self.save_selection_btn.config(state="normal")
+            self.apply_btn.config(state="normal")
+            
+            self.status_label.config(text=done_message)
+        
+        self.run_task(message, lambda progress: selection.preview(operation, progress), finish, error_message)
+    
     def magic_wand_selection(self, click_x, click_y):
-        """Perform magic wand selection at clicked point with additive support"""
+        """Perform magic wand selection at clicked point with additive/subtractive support"""
         try:
             # Convert canvas coordinates to image coordinates
             img_x = int((click_x - self.offset_x) / self.scale_factor)
@@ -344,47 +722,30 @@ class SmartBackgroundRemover:
             
             if not (0 <= img_x < self.processed_image.width and 0 <= img_y < self.processed_image.height):
                 return
+            if self.region_mode.get() and not self.regions_ready():
+                self.with_regions(lambda: self.magic_wand_selection(click_x, click_y))
+                return
             
-            # Get the target color
-            target_color = self.processed_image.getpixel((img_x, img_y))
-            if len(target_color) == 4:  # RGBA
-                target_color = target_color[:3]  # Use only RGB
-            
-            # Create new mask for this selection
-            new_mask = Image.new("L", self.processed_image.size, 0)
-            self.flood_fill(new_mask, img_x, img_y, target_color, self.magic_wand_tolerance)
-            
-            # Combine with existing selection if in additive mode
-            if self.additive_mode.get() and self.selection_mask:
-                # Combine masks (OR operation)
-                combined_mask = Image.new("L", self.processed_image.size, 0)
-                existing_pixels = self.selection_mask.load()
-                new_pixels = new_mask.load()
-                combined_pixels = combined_mask.load()
-                
-                for y in range(self.processed_image.height):
-                    for x in range(self.processed_image.width):
-                        # If either mask has a pixel selected, select it in combined mask
-                        combined_pixels[x, y] = max(existing_pixels[x, y], new_pixels[x, y])
-                
-                self.selection_mask = combined_mask
+            # Add to, subtract from or replace the existing selection
+            mode = self.wand_combine_mode()
+            if self.region_mode.get():
+                operation = ("region", img_x, img_y, self.magic_wand_tolerance, mode)
             else:
-                # Replace existing selection
-                self.selection_mask = new_mask
-            
-            self.visualize_selection()
+                operation = ("wand", img_x, img_y, self.magic_wand_tolerance, self.metric_var.get(), mode)
+            dirty_box = self.perform_selection(operation)
+            self.visualize_selection(dirty_box)
             
             self.clear_btn.config(state="normal")
             self.invert_btn.config(state="normal")
+            self.save_selection_btn.config(state="normal")
             self.apply_btn.config(state="normal")
             
             # Count selected areas for user feedback
-            mask_pixels = self.selection_mask.load()
-            selected_count = sum(1 for y in range(self.processed_image.height) 
-                               for x in range(self.processed_image.width) 
-                               if mask_pixels[x, y] > 0)
+            selected_count = self.selection.count_selected()
             
-            if self.additive_mode.get():
+            if mode == "subtract":
+                self.status_label.config(text=f"🪄 Magic wand removed area from selection!\nSelected: {selected_count:,} pixels")
+            elif mode == "add":
                 self.status_label.config(text=f"🪄 Magic wand added to selection!\nSelected: {selected_count:,} pixels\nKeep clicking to add more areas!")
             else:
                 self.status_label.config(text=f"🪄 Magic wand selected {selected_count:,} pixels!\nTolerance: {self.magic_wand_tolerance}")
@@ -392,247 +753,174 @@ class SmartBackgroundRemover:
         except Exception as e:
             messagebox.showerror("Error", f"Magic wand failed: {str(e)}")
     
-    def flood_fill(self, mask, start_x, start_y, target_color, tolerance):
-        """Flood fill algorithm for magic wand selection"""
-        visited = set()
-        queue = deque([(start_x, start_y)])
-        
-        img_pixels = self.processed_image.load()
-        mask_pixels = mask.load()
-        
-        width, height = self.processed_image.size
-        
-        while queue:
-            x, y = queue.popleft()
-            
-            if (x, y) in visited or x < 0 or x >= width or y < 0 or y >= height:
-                continue
-                
-            visited.add((x, y))
+    def adjust_wand_tolerance(self):
+        """Re-threshold the last magic wand click at the slider's tolerance"""
+        try:
+            if (self.selection_mode != "magic_wand" or self.selection is None or self.selection_mask is None
+                    or self.selection.image is not self.processed_image or not self.selection.adjustable
+                    or self.tasks.busy):
+                return
+            if self.selection.operations[-1][3] == self.magic_wand_tolerance:
+                return
+            if self.tolerance_before is None:
+                self.tolerance_before = self.selection_snapshot()
             
-            # Get current pixel color
-            current_color = img_pixels[x, y]
-            if len(current_color) == 4:  # RGBA
-                current_color = current_color[:3]  # Use only RGB
+            dirty_box = self.selection.adjust_tolerance(self.magic_wand_tolerance)
+            self.selection_mask = self.selection.mask
+            self.visualize_selection(dirty_box)
             
-            # Check if color is similar enough
-            if self.color_distance(current_color, target_color) <= tolerance:
-                mask_pixels[x, y] = 255  # Mark as selected
-                
-                # Add neighbors to queue
-                queue.extend([(x+1, y), (x-1, y), (x, y+1), (x, y-1)])
+            selected_count = self.selection.count_selected()
+            self.status_label.config(text=f"🪄 Tolerance {self.magic_wand_tolerance}: {selected_count:,} pixels selected")
+        except Exception as e:
+            messagebox.showerror("Error", f"Tolerance change failed: {str(e)}")
     
-    def color_distance(self, color1, color2):
-        """Calculate color distance between two RGB colors"""
-        return math.sqrt(sum((a - b) ** 2 for a, b in zip(color1, color2)))
+    def record_tolerance_change(self):
+        """Add a finished slider drag to the undo history as one step"""
+        if self.tolerance_before is None:
+            return
+        self.history.record_selection(self.tolerance_before, self.selection_snapshot())
+        self.tolerance_before = None
+        self.update_history_buttons()
     
     def smart_object_detection(self):
         """Automatically detect the main object in the image"""
-        try:
-            self.status_label.config(text="🔍 Analyzing image... Finding main object...")
-            self.root.update()
-            
-            # Create a copy for processing
-            img = self.processed_image.copy()
-            if img.mode == "RGBA":
-                img = img.convert("RGB")
-            
-            # Enhance contrast to help with detection
-            enhancer = ImageEnhance.Contrast(img)
-            img = enhancer.enhance(2.0)
-            
-            # Apply edge detection using PIL filters
-            edges = img.filter(ImageFilter.FIND_EDGES)
-            edges = edges.filter(ImageFilter.MedianFilter(size=3))
-            
-            # Convert to grayscale for processing
-            gray = edges.convert("L")
-            
-            # Find the center region (assume main object is somewhat centered)
-            width, height = gray.size
-            center_x, center_y = width // 2, height // 2
-            
-            # Create initial mask by finding connected regions from center
-            mask = Image.new("L", gray.size, 0)
-            
-            # Use multiple seed points around the center
-            seed_points = [
-                (center_x, center_y),
-                (center_x - width//6, center_y),
-                (center_x + width//6, center_y),
-                (center_x, center_y - height//6),
-                (center_x, center_y + height//6)
-            ]
-            
-            # For each seed point, select similar regions
-            for seed_x, seed_y in seed_points:
-                if 0 <= seed_x < width and 0 <= seed_y < height:
-                    target_color = img.getpixel((seed_x, seed_y))
-                    temp_mask = Image.new("L", img.size, 0)
-                    self.flood_fill_rgb_image(temp_mask, img, seed_x, seed_y, target_color, 40)
-                    
-                    # Combine with main mask
-                    mask_pixels = mask.load()
-                    temp_pixels = temp_mask.load()
-                    for y in range(height):
-                        for x in range(width):
-                            if temp_pixels[x, y] > 0:
-                                mask_pixels[x, y] = 255
-            
-            # Clean up the mask
-            mask = mask.filter(ImageFilter.MedianFilter(size=5))
-            
-            self.selection_mask = mask
-            self.visualize_selection()
-            
-            self.clear_btn.config(state="normal")
-            self.invert_btn.config(state="normal")
-            self.apply_btn.config(state="normal")
-            
-            self.status_label.config(text="🔍 Auto-detection complete!\nCheck the selection and click Apply,\nor use Invert if background was selected.")
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Auto-detection failed: {str(e)}")
-    
-    def flood_fill_rgb_image(self, mask, img, start_x, start_y, target_color, tolerance):
-        """Flood fill for RGB image"""
-        visited = set()
-        queue = deque([(start_x, start_y)])
-        
-        img_pixels = img.load()
-        mask_pixels = mask.load()
-        width, height = img.size
-        
-        while queue:
-            x, y = queue.popleft()
-            
-            if (x, y) in visited or x < 0 or x >= width or y < 0 or y >= height:
-                continue
-                
-            visited.add((x, y))
-            
-            current_color = img_pixels[x, y]
-            
-            if self.color_distance(current_color, target_color) <= tolerance:
-                mask_pixels[x, y] = 255
-                queue.extend([(x+1, y), (x-1, y), (x, y+1), (x, y-1)])
+        # Graph cut seeded from the current selection, or from what stands out
+        self.run_selection_task(("grabcut", None), "🔍 Analyzing image... Finding main object...",
+                                "🔍 Auto-detection complete!\nCheck the selection and click Apply,\nor use Invert if background was selected.",
+                                "Auto-detection failed")
     
     def smart_edge_selection(self):
         """Smart edge-based selection"""
-        try:
-            self.status_label.config(text="📐 Finding smart edges...")
-            self.root.update()
-            
-            img = self.processed_image.copy()
-            if img.mode == "RGBA":
-                img = img.convert("RGB")
-            
-            # Apply strong edge detection
-            edges = img.filter(ImageFilter.FIND_EDGES)
-            edges = edges.filter(ImageFilter.SMOOTH_MORE)
-            
-            # Convert to grayscale and enhance
-            gray = edges.convert("L")
-            enhancer = ImageEnhance.Contrast(gray)
-            gray = enhancer.enhance(3.0)
-            
-            # Create mask based on edge intensity
-            mask = Image.new("L", gray.size, 0)
-            gray_pixels = gray.load()
-            mask_pixels = mask.load()
-            
-            width, height = gray.size
-            threshold = 50  # Edge threshold
-            
-            # Find strong edges and fill connected regions
-            for y in range(height):
-                for x in range(width):
-                    if gray_pixels[x, y] > threshold:
-                        # This is an edge pixel, try to fill the region it bounds
-                        self.fill_bounded_region(mask, x, y, width, height)
-            
-            # Clean up the mask
-            mask = mask.filter(ImageFilter.MedianFilter(size=3))
-            
-            self.selection_mask = mask
-            self.visualize_selection()
-            
-            self.clear_btn.config(state="normal")
-            self.invert_btn.config(state="normal")
-            self.apply_btn.config(state="normal")
-            
-            self.status_label.config(text="📐 Edge selection complete!\nReview the selection and click Apply.")
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Edge detection failed: {str(e)}")
+        self.run_selection_task(("edge",), "📐 Finding smart edges...",
+                                "📐 Edge selection complete!\nReview the selection and click Apply.",
+                                "Edge detection failed")
     
-    def fill_bounded_region(self, mask, x, y, width, height):
-        """Fill a small region around edge pixels"""
-        mask_pixels = mask.load()
+    @instrument.timed("overlay")
+    def visualize_selection(self, dirty_box=None):
+        """Show the current selection on the canvas with improved visual feedback
         
-        # Fill a small area around the edge
-        for dy in range(-2, 3):
-            for dx in range(-2, 3):
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < width and 0 <= ny < height:
-                    mask_pixels[nx, ny] = 255
-    
-    def visualize_selection(self):
-        """Show the current selection on the canvas with improved visual feedback"""
+        dirty_box is the mask-space box that changed since the last call;
+        only the overlay tiles it touches are redrawn. None redraws all.
+        """
         if not self.selection_mask:
             return
         
-        # Create a visual overlay
-        display_width = int(self.processed_image.width * self.scale_factor)
-        display_height = int(self.processed_image.height * self.scale_factor)
-        
-        # Resize mask for display
-        display_mask = self.selection_mask.resize((display_width, display_height), Image.Resampling.NEAREST)
+        display_size = (int(self.processed_image.width * self.scale_factor),
+                        int(self.processed_image.height * self.scale_factor))
         
-        # Create overlay image with better visibility
-        if self.selection_mode == "magic_wand" and self.additive_mode.get():
-            # Use green for additive magic wand selections
-            overlay = Image.new("RGBA", (display_width, display_height), (0, 255, 0, 120))
+        # Use green for building selections up, red for the others
+        if self.selection_mode in ("magic_wand", "brush", "lasso") and self.wand_combine_mode() != "replace":
+            color = (0, 255, 0, 120)
         else:
-            # Use red for other selections
-            overlay = Image.new("RGBA", (display_width, display_height), (255, 0, 0, 100))
-        
-        # Apply mask to overlay
-        overlay_pixels = overlay.load()
-        mask_pixels = display_mask.load()
-        
-        for y in range(display_height):
-            for x in range(display_width):
-                if mask_pixels[x, y] == 0:  # Not selected
-                    overlay_pixels[x, y] = (0, 0, 0, 0)  # Transparent
+            color = (255, 0, 0, 100)
         
-        # Convert overlay to PhotoImage and display
-        self.overlay_image = ImageTk.PhotoImage(overlay)
-        
-        # Clear existing overlay and add new one
-        self.canvas.delete("overlay")
-        self.canvas.create_image(self.offset_x + display_width//2, 
-                                self.offset_y + display_height//2, 
-                                image=self.overlay_image, tags="overlay")
+        # Start over when the geometry or color changed or the canvas was cleared
+        if (self.overlay is None or not self.overlay.matches(self.selection_mask.size, display_size, color)
+                or not self.canvas.find_withtag("overlay")):
+            self.canvas.delete("overlay")
+            self.overlay = SelectionOverlay(self.selection_mask.size, display_size, color)
+            self.overlay_tiles = {}
+            dirty_box = None
+        
+        for key in self.overlay.update(self.selection_mask, dirty_box):
+            tile, (x, y) = self.overlay.tile(key)
+            photo = ImageTk.PhotoImage(tile)
+            if key in self.overlay_tiles:
+                item_id = self.overlay_tiles[key][0]
+                self.canvas.itemconfig(item_id, image=photo)
+            else:
+                item_id = self.canvas.create_image(self.offset_x + x, self.offset_y + y, anchor=tk.NW,
+                                                   image=photo, tags="overlay")
+            # Keep a reference so Tk does not drop the image
+            self.overlay_tiles[key] = (item_id, photo)
     
     def invert_selection(self):
         """Invert the current selection"""
         if self.selection_mask:
-            # Invert the mask
-            mask_pixels = self.selection_mask.load()
-            width, height = self.selection_mask.size
-            
-            for y in range(height):
-                for x in range(width):
-                    mask_pixels[x, y] = 255 - mask_pixels[x, y]
+            self.perform_selection(("invert",))
             
             self.visualize_selection()
             self.status_label.config(text="🔄 Selection inverted! Click Apply when ready.")
     
+    def save_selection(self):
+        """Save the current selection to a compact selection file"""
+        if not self.selection_mask:
+            messagebox.showwarning("Warning", "No selection to save!")
+            return
+        
+        filename = filedialog.asksaveasfilename(
+            title="Save selection",
+            defaultextension=maskfile.EXTENSION,
+            filetypes=[("Selection files", "*" + maskfile.EXTENSION)]
+        )
+        if filename:
+            self.write_selection(filename)
+    
+    def write_selection(self, filename):
+        """Write the selection, replayed at full resolution, to filename"""
+        if self.preview_image is not None:
+            self.with_full_image(lambda: self.write_selection(filename))
+            return
+        if self.selection.needs_regions and not self.regions_ready():
+            self.with_regions(lambda: self.write_selection(filename))
+            return
+        
+        selection = self.selection
+        
+        def work(progress):
+            return maskfile.save(filename, selection.full_mask(progress), selection.image)
+        
+        def finish(size):
+            self.status_label.config(text=f"💾 Selection saved: {os.path.basename(filename)} "
+                                          f"({export.format_bytes(size)})")
+        
+        self.run_task("💾 Saving selection at full resolution...", work, finish, "Failed to save selection")
+    
+    def load_selection(self):
+        """Load a saved selection onto the current image"""
+        if not self.processed_image:
+            return
+        
+        filename = filedialog.askopenfilename(
+            title="Load selection",
+            filetypes=[("Selection files", "*" + maskfile.EXTENSION), ("All files", "*.*")]
+        )
+        if not filename:
+            return
+        
+        try:
+            stored = maskfile.load(filename)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load selection: {str(e)}")
+            return
+        self.with_full_image(lambda: self.use_stored_selection(stored, filename))
+    
+    def use_stored_selection(self, stored, filename):
+        """Make a loaded selection the current one, or combine it in"""
+        image = self.processed_image
+        if stored.size != image.size:
+            note = f"\n⚠️ Made on a {stored.size[0]}x{stored.size[1]} image, scaled to fit."
+        elif not stored.matches(image):
+            note = "\n⚠️ Made on a different version of this image."
+        else:
+            note = ""
+        mode = self.wand_combine_mode() if self.selection_mask else "replace"
+        self.run_selection_task(("stored", stored, mode), "📂 Loading selection...",
+                                f"📂 Selection loaded: {os.path.basename(filename)}{note}",
+                                "Failed to load selection")
+    
     def clear_selection(self):
         """Clear current selection"""
+        self.cancel_task()
+        if self.selection_mask:
+            self.history.record_selection(self.selection_snapshot(), ([], None))
+            self.update_history_buttons()
+        self.selection = None
         self.selection_mask = None
         self.selection_points = []
+        self.stroke = None
+        self.lasso_points = []
+        self.canvas.delete("lasso")
         
         # Clear visual elements
         for line_id in self.selection_lines:
@@ -648,6 +936,7 @@ class SmartBackgroundRemover:
         
         self.clear_btn.config(state="disabled")
         self.invert_btn.config(state="disabled")
+        self.save_selection_btn.config(state="disabled")
         self.apply_btn.config(state="disabled")
         
         # Update status based on current mode
@@ -667,21 +956,27 @@ class SmartBackgroundRemover:
                 messagebox.showwarning("Warning", "No selection to apply!\n\nFor manual selection: Click at least 3 points around the object you want to keep.\nFor smart tools: Use magic wand, auto-detect, or edge detection first.")
                 return
             
-            # Save current state for undo
-            self.backup_image = self.processed_image.copy()
+            if self.preview_image is not None:
+                self.with_full_image(self.apply_selection)
+                return
+            if self.selection_mask and self.selection.needs_regions and not self.regions_ready():
+                self.with_regions(self.apply_selection)
+                return
+            
+            image = self.processed_image
+            feather = self.feather_var.get()
+            matte = self.matte_mode.get()
             
             # Create final mask
             if self.selection_mask:
-                # Use smart selection mask
-                final_mask = self.selection_mask
-                print("Using smart selection mask")  # Debug
+                # Refine the smart selection at full resolution
+                selection = self.selection
+                final_mask = selection.full_mask
             else:
                 # Use manual selection points
-                print(f"Creating manual selection with {len(self.selection_points)} points")  # Debug
-                final_mask = Image.new("L", self.processed_image.size, 0)
                 img_points = []
                 
-                for i, (canvas_x, canvas_y) in enumerate(self.selection_points):
+                for canvas_x, canvas_y in self.selection_points:
                     # Convert canvas coordinates to image coordinates
                     img_x = int((canvas_x - self.offset_x) / self.scale_factor)
                     img_y = int((canvas_y - self.offset_y) / self.scale_factor)
@@ -691,40 +986,37 @@ class SmartBackgroundRemover:
                     img_y = max(0, min(img_y, self.processed_image.height - 1))
                     
                     img_points.append((img_x, img_y))
-                    print(f"Point {i+1}: Canvas({canvas_x}, {canvas_y}) -> Image({img_x}, {img_y})")  # Debug
-                
-                print(f"Image size: {self.processed_image.size}")  # Debug
-                print(f"Scale factor: {self.scale_factor}, Offset: ({self.offset_x}, {self.offset_y})")  # Debug
                 
                 # Create polygon mask
                 if len(img_points) >= 3:
-                    ImageDraw.Draw(final_mask).polygon(img_points, fill=255)
-                    print("Polygon created successfully")  # Debug
+                    final_mask = lambda progress: engine.polygon_mask(image.size, img_points)
                 else:
                     messagebox.showwarning("Warning", "Need at least 3 points for manual selection!")
                     return
             
-            # Apply mask to create transparency
-            if self.processed_image.mode != "RGBA":
-                self.processed_image = self.processed_image.convert("RGBA")
+            # Apply mask to create transparency, off the main thread
+            def work(progress):
+                return engine.apply_mask(image, final_mask(progress), feather=feather, matte=matte,
+                                         progress=progress)
             
-            # Apply transparency based on mask
-            pixels = self.processed_image.load()
-            mask_pixels = final_mask.load()
+            def finish(result):
+                self.processed_image, pixels_removed, pixels_kept = result
+                self.cutout_image = self.processed_image
+                self.history.record_image(image, self.processed_image)
+                self.finish_apply(pixels_removed, pixels_kept)
             
-            pixels_removed = 0
-            pixels_kept = 0
+            self.run_task("✅ Applying selection at full resolution...", work, finish,
+                          "Failed to apply selection")
+            self.apply_task = self.tasks.task_id
             
-            for y in range(self.processed_image.height):
-                for x in range(self.processed_image.width):
-                    r, g, b, a = pixels[x, y]
-                    if mask_pixels[x, y] == 0:  # Not selected (remove)
-                        pixels[x, y] = (r, g, b, 0)  # Make transparent
-                        pixels_removed += 1
-                    else:
-                        pixels_kept += 1
-            
-            print(f"Pixels removed: {pixels_removed:,}, Pixels kept: {pixels_kept:,}")  # Debug
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to apply selection: {str(e)}")
+    
+    def finish_apply(self, pixels_removed, pixels_kept):
+        """Update the UI once a selection has been applied"""
+        try:
+            instrument.count("pixels removed", pixels_removed)
+            instrument.count("pixels kept", pixels_kept)
             
             # Update UI
             self.selection_mode = "none"
@@ -742,7 +1034,7 @@ class SmartBackgroundRemover:
                        self.green_btn, self.transparent_btn, self.custom_color_btn]:
                 btn.config(state="normal")
             
-            self.undo_btn.config(state="normal")
+            self.update_history_buttons()
             self.display_image_on_canvas()
             
             if pixels_removed > 0:
@@ -752,7 +1044,6 @@ class SmartBackgroundRemover:
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to apply selection: {str(e)}")
-            print(f"Apply selection error: {e}")  # Debug
     
     def on_canvas_double_click(self, event):
         """Handle double-click to complete manual selection"""
@@ -761,15 +1052,107 @@ class SmartBackgroundRemover:
     
     def on_canvas_click(self, event):
         """Handle canvas clicks based on current mode"""
+        self.cancel_apply()
         if self.selection_mode == "magic_wand":
-            self.magic_wand_selection(event.x, event.y)
+            self.with_full_image(lambda: self.magic_wand_selection(event.x, event.y))
         elif self.selection_mode == "manual":
             self.manual_selection_click(event)
+        elif self.selection_mode in ("brush", "lasso"):
+            self.begin_stroke(event)
     
     def on_canvas_drag(self, event):
-        """Handle canvas drag for manual selection"""
-        # Only for manual mode - could add brush selection here
-        pass
+        """Handle canvas drag for the brush and lasso"""
+        if self.stroke is not None or self.lasso_points:
+            self.continue_stroke(event)
+    
+    def on_canvas_release(self, event):
+        """Handle the end of a brush or lasso drag"""
+        if self.stroke is not None or self.lasso_points:
+            self.end_stroke()
+    
+    def canvas_to_image(self, canvas_x, canvas_y):
+        """Full-resolution image coordinates of a canvas point (not clamped)"""
+        return (int((canvas_x - self.offset_x) / self.scale_factor),
+                int((canvas_y - self.offset_y) / self.scale_factor))
+    
+    def brush_radius(self):
+        """Brush radius in full-resolution pixels"""
+        try:
+            size = self.brush_size_var.get()
+        except tk.TclError:
+            size = BRUSH_SIZE
+        return max(1, round(max(1, size) / 2 / self.scale_factor))
+    
+    def begin_stroke(self, event):
+        """Start a brush stroke or lasso at the pointer"""
+        if not self.processed_image:
+            return
+        if self.preview_image is not None:
+            # Strokes paint on a pyramid level, which needs the decoded pixels
+            self.with_full_image(lambda: None)
+            return
+        try:
+            self.record_tolerance_change()
+            mode = self.wand_combine_mode()
+            if self.selection_mode == "lasso":
+                self.lasso_points = [(event.x, event.y)]
+                return
+            
+            self.stroke_before = self.selection_snapshot()
+            self.stroke = Stroke(self.current_selection(), self.brush_radius(), mode)
+            self.selection_mask = self.stroke.mask
+            box = self.stroke.add(*self.canvas_to_image(event.x, event.y))
+            # A replacing stroke starts from an empty mask, so redraw it all once
+            self.visualize_selection(None if mode == "replace" else box)
+        except Exception as e:
+            self.stroke = None
+            messagebox.showerror("Error", f"Freehand selection failed: {str(e)}")
+    
+    def continue_stroke(self, event):
+        """Paint the segment to the pointer: into the mask for the brush, on the canvas for the lasso"""
+        try:
+            if self.stroke is not None:
+                self.visualize_selection(self.stroke.add(*self.canvas_to_image(event.x, event.y)))
+            else:
+                last_x, last_y = self.lasso_points[-1]
+                self.canvas.create_line(last_x, last_y, event.x, event.y, fill="red", width=2, tags="lasso")
+                self.lasso_points.append((event.x, event.y))
+        except Exception as e:
+            self.stroke = None
+            self.lasso_points = []
+            messagebox.showerror("Error", f"Freehand selection failed: {str(e)}")
+    
+    def end_stroke(self):
+        """Record the finished brush stroke, or fill the closed lasso"""
+        try:
+            stroke, self.stroke = self.stroke, None
+            points, self.lasso_points = self.lasso_points, []
+            self.canvas.delete("lasso")
+            mode = stroke.mode if stroke is not None else self.wand_combine_mode()
+            
+            if stroke is not None:
+                if stroke.selection is not self.selection:
+                    return
+                stroke.selection.commit(stroke.operation, stroke.mask)
+                self.selection_mask = self.selection.mask
+                self.history.record_selection(self.stroke_before, self.selection_snapshot())
+                self.update_history_buttons()
+            elif len(points) >= 3:
+                operation = ("polygon", [self.canvas_to_image(x, y) for x, y in points], mode)
+                self.visualize_selection(self.perform_selection(operation))
+            else:
+                return
+            
+            self.clear_btn.config(state="normal")
+            self.invert_btn.config(state="normal")
+            self.save_selection_btn.config(state="normal")
+            self.apply_btn.config(state="normal")
+            
+            selected_count = self.selection.count_selected()
+            action = "Erased from" if mode == "subtract" else "Added to" if mode == "add" else "Replaced"
+            self.status_label.config(text=f"{'🖌️' if stroke is not None else '➰'} {action} selection!\nSelected: {selected_count:,} pixels\nKeep drawing or click Apply.")
+        except Exception as e:
+            messagebox.showerror("Error", f"Freehand selection failed: {str(e)}")
     
     def manual_selection_click(self, event):
         """Handle manual selection clicks"""
@@ -808,9 +1191,10 @@ class SmartBackgroundRemover:
             if len(self.selection_points) >= 3:
                 self.apply_btn.config(state="normal")
                 self.invert_btn.config(state="normal")
+                self.save_selection_btn.config(state="normal")
                 
                 # Create preview of manual selection
-                self.create_manual_selection_preview()
+                self.with_full_image(self.create_manual_selection_preview)
                 
                 self.status_label.config(text=f"✏️ {len(self.selection_points)} points selected.\nClick more points to refine or click Apply to use selection.")
             else:
@@ -822,8 +1206,7 @@ class SmartBackgroundRemover:
             return
         
         try:
-            # Create a temporary mask for preview
-            temp_mask = Image.new("L", self.processed_image.size, 0)
+            # Create a preview mask on the proxy image
             img_points = []
             
             for canvas_x, canvas_y in self.selection_points:
@@ -833,15 +1216,21 @@ class SmartBackgroundRemover:
                 img_y = max(0, min(img_y, self.processed_image.height - 1))
                 img_points.append((img_x, img_y))
             
-            # Create polygon
-            ImageDraw.Draw(temp_mask).polygon(img_points, fill=255)
+            previous = self.selection.operations[-1:] if self.selection_mask else []
+            self.perform_selection(("polygon", img_points, "replace"), record=False)
             
-            # Store for visualization
-            self.selection_mask = temp_mask
-            self.visualize_selection()
+            # After the previous point's preview, old and new polygon both lie
+            # within the points' bounds, so only that part needs redrawing
+            dirty_box = None
+            if previous == [("polygon", img_points[:-1], "replace")]:
+                scale_x, scale_y = self.selection.proxy_scale
+                xs = [x * scale_x for x, _ in img_points]
+                ys = [y * scale_y for _, y in img_points]
+                dirty_box = (max(0, int(min(xs)) - 1), max(0, int(min(ys)) - 1), int(max(xs)) + 2, int(max(ys)) + 2)
+            self.visualize_selection(dirty_box)
             
         except Exception as e:
-            print(f"Preview creation failed: {e}")  # Debug
+            self.status_label.config(text=f"⚠️ Selection preview failed: {str(e)}")
     
     def quick_color(self, color):
         """Apply a quick background color"""
@@ -872,34 +1261,67 @@ class SmartBackgroundRemover:
             return
         
         try:
-            if self.backup_image is None:
-                self.backup_image = self.processed_image.copy()
+            # Recolor from the transparent cut-out, not an already flattened image
+            source = self.processed_image
+            if source.mode != "RGBA" and self.cutout_image is not None:
+                source = self.cutout_image
             
-            if self.processed_image.mode == "RGBA":
-                new_image = Image.new("RGB", self.processed_image.size, self.bg_color)
-                new_image.paste(self.processed_image, mask=self.processed_image.split()[-1])
-                self.processed_image = new_image
+            flattened = engine.flatten(source, self.bg_color)
+            if flattened is not self.processed_image:
+                self.history.record_image(self.processed_image, flattened)
+                self.processed_image = flattened
             
-            self.undo_btn.config(state="normal")
+            self.update_history_buttons()
             self.display_image_on_canvas()
             self.status_label.config(text=f"🎨 Background color applied! Save your result.")
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to apply background: {str(e)}")
     
+    def on_backspace(self, event):
+        """Backspace undoes, unless it is deleting text in an entry field"""
+        if event.widget.winfo_class() in TEXT_WIDGET_CLASSES:
+            return
+        self.undo()
+    
     def undo(self):
         """Undo last action"""
-        if self.backup_image:
-            self.processed_image = self.backup_image.copy()
-            self.backup_image = None
-            self.undo_btn.config(state="disabled")
-            self.display_image_on_canvas()
+        self.record_tolerance_change()
+        edit = self.history.undo()
+        if edit:
+            self.restore_history_state(edit, edit.before)
             self.status_label.config(text="⏪ Undone! Previous state restored.")
     
+    def redo(self):
+        """Redo the last undone action"""
+        edit = self.history.redo()
+        if edit:
+            self.restore_history_state(edit, edit.after)
+            self.status_label.config(text="⏩ Redone!")
+    
+    def restore_history_state(self, edit, state):
+        """Bring back the image or selection stored in a history state"""
+        self.cancel_task()
+        if edit.kind == "image":
+            self.processed_image = state.restore(self.history.base)
+            if self.processed_image is self.original_image:
+                self.cutout_image = None
+            elif self.processed_image.mode == "RGBA":
+                self.cutout_image = self.processed_image
+            self.display_image_on_canvas()
+        else:
+            self.restore_selection(*state.restore())
+        self.update_history_buttons()
+    
+    def update_history_buttons(self):
+        """Enable undo/redo only when there is something to step to"""
+        self.undo_btn.config(state="normal" if self.history.can_undo else "disabled")
+        self.redo_btn.config(state="normal" if self.history.can_redo else "disabled")
+    
     def reset(self):
         """Reset to original image"""
         if self.original_image:
-            self.processed_image = self.original_image.copy()
+            self.processed_image = self.original_image
             self.reset_selection_state()
             self.display_image_on_canvas()
             self.status_label.config(text="🔄 Reset to original. Ready for smart selection!")
@@ -909,11 +1331,17 @@ class SmartBackgroundRemover:
         if not self.processed_image:
             messagebox.showwarning("Warning", "No image to save!")
             return
+        if self.preview_image is not None:
+            self.with_full_image(self.save_image)
+            return
         
+        preset = self.export_preset_var.get()
+        preset = None if preset == AUTO_PRESET else preset
         if self.processed_image.mode == "RGBA":
             default_ext = ".png"
             file_types = [
                 ("PNG files (keeps transparency)", "*.png"),
+                ("WebP files (keeps transparency)", "*.webp"),
                 ("JPEG files (solid background)", "*.jpg"),
             ]
         else:
@@ -921,7 +1349,11 @@ class SmartBackgroundRemover:
             file_types = [
                 ("JPEG files", "*.jpg"),
                 ("PNG files", "*.png"),
+                ("WebP files", "*.webp"),
             ]
+        if preset:
+            default_ext = export.extension(preset)
+            file_types.sort(key=lambda file_type: file_type[1] != "*" + default_ext)
         
         filename = filedialog.asksaveasfilename(
             title="Save your smart-edited image",
@@ -930,20 +1362,38 @@ class SmartBackgroundRemover:
         )
         
         if filename:
+            crop = None
+            if self.crop_export_var.get():
+                # A flattened result has no alpha left; its cut-out has the same outline
+                source = self.processed_image
+                if source.mode != "RGBA" and self.cutout_image is not None:
+                    source = self.cutout_image
+                crop = export.alpha_box(source)
+            
+            # Encoding runs on the exporter's threads; the UI stays responsive meanwhile
             try:
-                if filename.lower().endswith(('.jpg', '.jpeg')) and self.processed_image.mode == "RGBA":
-                    rgb_image = Image.new("RGB", self.processed_image.size, (255, 255, 255))
-                    rgb_image.paste(self.processed_image, mask=self.processed_image.split()[-1])
-                    rgb_image.save(filename, quality=95)
-                    messagebox.showinfo("Saved!", f"Image saved as JPEG:\n{os.path.basename(filename)}")
-                else:
-                    self.processed_image.save(filename)
-                    messagebox.showinfo("Saved!", f"Image saved:\n{os.path.basename(filename)}")
-                
-                self.status_label.config(text=f"💾 Saved: {os.path.basename(filename)}")
-                
+                future = self.exporter.submit(self.processed_image, filename, preset, crop)
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to save: {str(e)}")
+                return
+            self.status_label.config(text=f"💾 Saving {os.path.basename(filename)}...")
+            self.root.after(SAVE_POLL_MS, lambda: self.finish_save(future, filename))
+    
+    def finish_save(self, future, filename):
+        """Report a background save once it is done"""
+        if not future.done():
+            self.root.after(SAVE_POLL_MS, lambda: self.finish_save(future, filename))
+            return
+        try:
+            report = future.result()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to save: {str(e)}")
+            self.status_label.config(text=f"❌ Could not save {os.path.basename(filename)}")
+            return
+        width, height = report["size"]
+        messagebox.showinfo("Saved!", f"Image saved:\n{os.path.basename(filename)}\n"
+                                      f"{width}x{height}, {export.describe(report)}")
+        self.status_label.config(text=f"💾 Saved: {os.path.basename(filename)} ({export.describe(report)})")
     
     def display_image_on_canvas(self):
         """Display the current image on canvas"""
@@ -954,8 +1404,7 @@ class SmartBackgroundRemover:
         self.canvas.delete("all")
         
         # Calculate display size
-        canvas_width = 800
-        canvas_height = 700
+        canvas_width, canvas_height = CANVAS_SIZE
         img_width, img_height = self.processed_image.size
         
         # Scale to fit canvas while maintaining aspect ratio
@@ -970,8 +1419,13 @@ class SmartBackgroundRemover:
         self.offset_x = (canvas_width - display_width) // 2
         self.offset_y = (canvas_height - display_height) // 2
         
-        # Resize image for display
-        display_img = self.processed_image.resize((display_width, display_height), Image.Resampling.LANCZOS)
+        # Resize image for display from the nearest pyramid level (cached per image)
+        if self.preview_image is not None and self.processed_image is self.original_image:
+            # Not decoded at full resolution yet; the reduced preview is enough
+            with instrument.stage("resize"):
+                display_img = self.preview_image.resize((display_width, display_height), Image.Resampling.LANCZOS)
+        else:
+            display_img = self.pyramids.get(self.processed_image).display((display_width, display_height))
         
         # Convert to PhotoImage
         self.display_image = ImageTk.PhotoImage(display_img)
@@ -0,0 +1,59 @@
+"""Selection mask algebra.
+
+Masks are "L" images where 255 marks selected pixels. Every operation
+here runs inside Pillow's C code, so combining selections costs a few
+milliseconds per megapixel instead of a Python loop over every pixel.
+"""
+from PIL import Image, ImageChops
+
+import instrument
+
+
+def union(mask_a, mask_b):
+    """Pixels selected in either mask"""
+    return ImageChops.lighter(mask_a, mask_b)
+
+
+def intersect(mask_a, mask_b):
+    """Pixels selected in both masks"""
+    return ImageChops.darker(mask_a, mask_b)
+
+
+def subtract(mask_a, mask_b):
+    """Pixels selected in mask_a but not in mask_b"""
+    return ImageChops.subtract(mask_a, mask_b)
+
+
+def xor(mask_a, mask_b):
+    """Pixels selected in exactly one of the masks"""
+    return ImageChops.difference(mask_a, mask_b)
+
+
+def invert(mask):
+    """Swap selected and unselected pixels"""
+    return ImageChops.invert(mask)
+
+
+def count_selected(mask):
+    """Number of selected (non-zero) pixels in a mask"""
+    return mask.width * mask.height - mask.histogram()[0]
+
+
+@instrument.timed("mask combine")
+def combine(mask, new_mask, mode):
+    """Combine a new selection into an existing one
+
+    mode is "replace", "add", "subtract" or "intersect". A missing
+    existing mask behaves like an empty selection.
+    """
+    if mode == "replace":
+        return new_mask
+    if mask is None:
+        mask = Image.new("L", new_mask.size, 0)
+    if mode == "add":
+        return union(mask, new_mask)
+    if mode == "subtract":
+        return subtract(mask, new_mask)
+    if mode == "intersect":
+        return intersect(mask, new_mask)
+    raise ValueError(f"Unknown selection mode: {mode}")
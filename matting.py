@@ -0,0 +1,183 @@
+"""Soft alpha for selection edges.
+
+A hard selection is turned into a trimap: pixels well inside stay opaque,
+pixels well outside stay transparent, and only a narrow unknown band
+along the boundary is solved. There, alpha comes from a color guided
+filter of the hard mask (the local linear model of closed-form matting,
+solved per window instead of globally), and foreground colors are
+decontaminated by removing the local background color they picked up.
+
+Only tiles that the boundary passes through are touched, gathered into
+stacks and processed together, so the cost grows with the length of the
+edge rather than the area of the image.
+"""
+import math
+
+import numpy as np
+from PIL import Image
+
+import fill
+import instrument
+import morphology
+
+BAND_RADIUS = 8
+EPSILON = 1e-4
+TILE_SIZE = 64
+TILES_PER_BATCH = 64
+MIN_ALPHA = 0.05
+# Results depend on pixels at most this far away (band, then the color means)
+REACH = 3 * BAND_RADIUS
+
+
+def box_mean(stack, radius):
+    """Mean over a (2 * radius + 1) square window for each (n, h, w) slice
+
+    Windows are clipped at the edges and normalised by their real size.
+    """
+    result = stack
+    for axis in (1, 2):
+        length = result.shape[axis]
+        padded = np.concatenate([np.zeros_like(result.take([0], axis=axis)), np.cumsum(result, axis=axis)], axis=axis)
+        upper = np.minimum(np.arange(length) + radius + 1, length)
+        lower = np.maximum(np.arange(length) - radius, 0)
+        shape = [1, 1, 1]
+        shape[axis] = length
+        result = (padded.take(upper, axis=axis) - padded.take(lower, axis=axis)) / (upper - lower).reshape(shape).astype(result.dtype)
+    return result
+
+
+def guided_filter(guide, source, radius, epsilon=EPSILON):
+    """He et al.'s color guided filter of source by guide, over a stack
+
+    guide is (n, h, w, 3) in [0, 1], source (n, h, w). The output follows
+    source but takes its edges from guide, which is what turns a hard
+    mask into fractional alpha along hair and soft boundaries.
+    """
+    channels = [guide[..., c] for c in range(3)]
+    mean_i = [box_mean(channel, radius) for channel in channels]
+    mean_p = box_mean(source, radius)
+    cov_ip = [box_mean(channel * source, radius) - mean * mean_p for channel, mean in zip(channels, mean_i)]
+
+    # Per-pixel 3x3 covariance of the guide, regularised, inverted by cofactors
+    var = {}
+    for a in range(3):
+        for b in range(a, 3):
+            var[a, b] = var[b, a] = box_mean(channels[a] * channels[b], radius) - mean_i[a] * mean_i[b]
+    for a in range(3):
+        var[a, a] = var[a, a] + epsilon
+    cofactor = {
+        (0, 0): var[1, 1] * var[2, 2] - var[1, 2] * var[1, 2],
+        (0, 1): var[0, 2] * var[1, 2] - var[0, 1] * var[2, 2],
+        (0, 2): var[0, 1] * var[1, 2] - var[0, 2] * var[1, 1],
+        (1, 1): var[0, 0] * var[2, 2] - var[0, 2] * var[0, 2],
+        (1, 2): var[0, 2] * var[0, 1] - var[0, 0] * var[1, 2],
+        (2, 2): var[0, 0] * var[1, 1] - var[0, 1] * var[0, 1],
+    }
+    for a, b in [(1, 0), (2, 0), (2, 1)]:
+        cofactor[a, b] = cofactor[b, a]
+    determinant = var[0, 0] * cofactor[0, 0] + var[0, 1] * cofactor[0, 1] + var[0, 2] * cofactor[0, 2]
+
+    slopes = [sum(cofactor[a, b] * cov_ip[b] for b in range(3)) / determinant for a in range(3)]
+    offset = mean_p - sum(slope * mean for slope, mean in zip(slopes, mean_i))
+    return sum(box_mean(slope, radius) * channel for slope, channel in zip(slopes, channels)) + box_mean(offset, radius)
+
+
+def boundary_tiles(selected, radius, tile_size=TILE_SIZE):
+    """(top, left) corners of the tiles within radius of the mask boundary
+
+    The mask is summarised in blocks of radius pixels, so a tile that is
+    uniform itself but close to an edge in its neighbour is still found.
+    """
+    height, width = selected.shape
+    block = math.gcd(tile_size, radius) or tile_size
+    reach = -(-radius // block)
+    rows, columns = -(-height // tile_size), -(-width // tile_size)
+    per_tile = tile_size // block
+    padded = np.pad(selected, ((0, rows * tile_size - height), (0, columns * tile_size - width)), mode="edge")
+    blocks = padded.reshape(rows * per_tile, block, columns * per_tile, block)
+    any_selected = morphology.dilate(blocks.any(axis=(1, 3)), reach)
+    any_unselected = morphology.dilate(~blocks.all(axis=(1, 3)), reach)
+    mixed = (any_selected & any_unselected).reshape(rows, per_tile, columns, per_tile).any(axis=(1, 3))
+    return [(row * tile_size, column * tile_size) for row, column in zip(*np.nonzero(mixed))]
+
+
+def tile_window(array, top, left, margin, size=TILE_SIZE):
+    """The tile at (top, left) with margin pixels around it, edges repeated
+
+    Only the window is copied, so gathering a tile costs its own size and
+    not the image's.
+    """
+    height, width = array.shape[:2]
+    rows = np.clip(np.arange(top - margin, top + size + margin), 0, height - 1)
+    columns = np.clip(np.arange(left - margin, left + size + margin), 0, width - 1)
+    return array[rows[:, None], columns]
+
+
+def solve_tiles(pixels, selected, radius):
+    """Alpha and decontaminated colors for a stack of tile windows
+
+    pixels is (n, h, w, 3) float in [0, 1], selected (n, h, w) bool.
+    Returns alpha (n, h, w) in [0, 1] and colors (n, h, w, 3).
+    """
+    inside = ~morphology.dilate_axis(morphology.dilate_axis(~selected, radius, 2), radius, 1)
+    outside = ~morphology.dilate_axis(morphology.dilate_axis(selected, radius, 2), radius, 1)
+    unknown = ~inside & ~outside
+
+    alpha = np.clip(guided_filter(pixels, selected.astype(np.float32), radius), 0.0, 1.0)
+    alpha = np.where(inside, 1.0, np.where(outside, 0.0, alpha))
+
+    # Local foreground and background colors from the sure regions nearby
+    def local_mean(weights):
+        total = box_mean(weights.astype(np.float32), 2 * radius)
+        means = [box_mean(pixels[..., c] * weights, 2 * radius) for c in range(3)]
+        return np.stack(means, axis=-1) / np.maximum(total, 1e-6)[..., None], total > 0
+
+    background, has_background = local_mean(outside)
+    foreground, has_foreground = local_mean(inside)
+    background = np.where(has_background[..., None], background, pixels)
+    foreground = np.where(has_foreground[..., None], foreground, pixels)
+
+    # I = alpha F + (1 - alpha) B solved for F, which is noisy where alpha is
+    # small, so faint pixels lean on the nearby foreground color instead
+    weight = alpha[..., None]
+    solved = np.clip((pixels - (1 - weight) * background) / np.maximum(weight, MIN_ALPHA), 0.0, 1.0)
+    colors = weight * solved + (1 - weight) * foreground
+    colors = np.where(unknown[..., None], colors, pixels)
+    return alpha, colors
+
+
+@instrument.timed("matte")
+def refine(image, mask, radius=BAND_RADIUS, progress=None):
+    """Soft alpha and decontaminated colors for a hard selection mask
+
+    Returns an "L" alpha image and an RGB image whose colors along the
+    boundary have had the background color removed. Away from the
+    boundary both match the hard mask and the original pixels. progress,
+    if given, is called with the fraction of boundary tiles done.
+    """
+    rgb = fill.as_rgb_array(image)
+    selected = np.asarray(mask) > 0
+    height, width = selected.shape
+    alpha = np.where(selected, 255, 0).astype(np.uint8)
+    colors = np.array(rgb)
+
+    # Each tile is solved in a window wide enough for the band and the filter
+    margin = 3 * radius
+
+    tiles = boundary_tiles(selected, radius)
+    for start in range(0, len(tiles), TILES_PER_BATCH):
+        if progress:
+            progress(start / len(tiles))
+        batch = tiles[start:start + TILES_PER_BATCH]
+        pixels = np.stack([tile_window(rgb, top, left, margin) for top, left in batch]).astype(np.float32) / 255
+        windows = np.stack([tile_window(selected, top, left, margin) for top, left in batch])
+        tile_alpha, tile_colors = solve_tiles(pixels, windows, radius)
+
+        core = slice(margin, margin + TILE_SIZE)
+        for index, (top, left) in enumerate(batch):
+            bottom, right = min(top + TILE_SIZE, height), min(left + TILE_SIZE, width)
+            rows, columns = bottom - top, right - left
+            alpha[top:bottom, left:right] = np.round(tile_alpha[index, core, core][:rows, :columns] * 255)
+            colors[top:bottom, left:right] = np.round(tile_colors[index, core, core][:rows, :columns] * 255)
+
+    return Image.fromarray(alpha, "L"), Image.fromarray(colors, "RGB")
@@ -0,0 +1,46 @@
+"""Binary morphology on boolean arrays.
+
+Dilation and erosion are separable: a square window is a row pass
+followed by a column pass, each an OR (or AND) of shifted slices, so the
+cost is linear in the pixel count for a fixed radius.
+"""
+import numpy as np
+
+import fill
+
+
+def dilate_axis(mask, radius, axis):
+    """Max filter of width 2 * radius + 1 along one axis"""
+    result = mask.copy()
+    length = mask.shape[axis]
+    for shift in range(1, min(radius, length - 1) + 1):
+        ahead = [slice(None)] * mask.ndim
+        behind = [slice(None)] * mask.ndim
+        ahead[axis], behind[axis] = slice(shift, None), slice(None, -shift)
+        result[tuple(behind)] |= mask[tuple(ahead)]
+        result[tuple(ahead)] |= mask[tuple(behind)]
+    return result
+
+
+def dilate(mask, radius):
+    """Grow a boolean mask by radius pixels (square window)"""
+    if radius <= 0:
+        return mask.copy()
+    return dilate_axis(dilate_axis(mask, radius, 1), radius, 0)
+
+
+def erode(mask, radius):
+    """Shrink a boolean mask by radius pixels (square window)"""
+    return ~dilate(~mask, radius)
+
+
+def fill_holes(mask):
+    """Select everything the mask encloses
+
+    Unselected regions that do not touch the image border are holes and
+    get filled in.
+    """
+    labels = fill.label_components(~mask)
+    border = np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]])
+    outside = np.isin(labels, np.unique(border[border > 0]))
+    return ~outside
@@ -0,0 +1,81 @@
+"""Incremental selection overlay rendering.
+
+The overlay is drawn at display resolution and split into square tiles.
+The selection mask, scaled to the display, is cached and used directly
+as each tile's alpha channel, so an update after a fill only rescales
+the part of the mask that changed and rebuilds the tiles it touches.
+"""
+from PIL import Image
+
+TILE_SIZE = 128
+
+
+class SelectionOverlay:
+    """Display-resolution overlay for a selection mask, updated tile by tile"""
+
+    def __init__(self, image_size, display_size, color):
+        self.image_size = image_size
+        self.display_size = display_size
+        self.color = color
+        self.scaled_mask = None
+
+        # Display pixels per image pixel; display size is int(image size * scale)
+        self.scale_x = display_size[0] / image_size[0]
+        self.scale_y = display_size[1] / image_size[1]
+
+        # Selected pixels get the color's alpha, everything else is clear
+        alpha = color[3]
+        self.alpha_lut = [0] + [alpha] * 255
+
+    def matches(self, image_size, display_size, color):
+        """Whether this overlay can be reused for the given geometry and color"""
+        return (self.image_size, self.display_size, self.color) == (image_size, display_size, color)
+
+    def display_box(self, box):
+        """Display-space box covering an image-space box"""
+        left, top, right, bottom = box
+        width, height = self.display_size
+        return (max(0, int(left * self.scale_x)),
+                max(0, int(top * self.scale_y)),
+                min(width, int(right * self.scale_x) + 1),
+                min(height, int(bottom * self.scale_y) + 1))
+
+    def update(self, mask, box=None):
+        """Refresh the cached display mask and return the dirty tile keys
+
+        box is the image-space bounding box that changed since the last
+        update; None redraws everything.
+        """
+        if box is None or self.scaled_mask is None:
+            self.scaled_mask = mask.resize(self.display_size, Image.Resampling.NEAREST)
+            return self.tiles_in((0, 0) + self.display_size)
+
+        dirty = self.display_box(box)
+        left, top, right, bottom = dirty
+        if left >= right or top >= bottom:
+            return []
+
+        # Resample only the changed region, on the same grid as a full resize
+        source_box = (left / self.scale_x, top / self.scale_y,
+                      right / self.scale_x, bottom / self.scale_y)
+        patch = mask.resize((right - left, bottom - top), Image.Resampling.NEAREST, box=source_box)
+        self.scaled_mask.paste(patch, (left, top))
+        return self.tiles_in(dirty)
+
+    def tiles_in(self, box):
+        """Keys (column, row) of the tiles that intersect a display box"""
+        left, top, right, bottom = box
+        return [(column, row)
+                for row in range(top // TILE_SIZE, (bottom - 1) // TILE_SIZE + 1)
+                for column in range(left // TILE_SIZE, (right - 1) // TILE_SIZE + 1)]
+
+    def tile(self, key):
+        """RGBA image for one tile and its top-left display position"""
+        column, row = key
+        x, y = column * TILE_SIZE, row * TILE_SIZE
+        width, height = self.display_size
+        box = (x, y, min(x + TILE_SIZE, width), min(y + TILE_SIZE, height))
+
+        tile = Image.new("RGBA", (box[2] - x, box[3] - y), self.color[:3] + (0,))
+        tile.putalpha(self.scaled_mask.crop(box).point(self.alpha_lut))
+        return tile, (x, y)
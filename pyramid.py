@@ -0,0 +1,94 @@
+"""Multi-resolution image pyramids for fast previews.
+
+Each level halves the one before it, so interactive tools can work on
+the level closest to the canvas size and the display image is resized
+from a small level instead of the full-resolution original.
+"""
+from collections import OrderedDict
+
+from PIL import Image
+
+import cache
+import instrument
+
+MIN_LEVEL_SIZE = 256
+REDUCIBLE_MODES = ("L", "LA", "RGB", "RGBA")
+
+
+@instrument.timed("resize")
+def reduce_levels(image, min_size=MIN_LEVEL_SIZE):
+    """Successively halved copies of image, largest first"""
+    levels = []
+    level = image if image.mode in REDUCIBLE_MODES else image.convert("RGBA")
+    while min(level.size) // 2 >= min_size:
+        level = level.reduce(2)
+        levels.append(level)
+    return levels
+
+
+class ImagePyramid:
+    """An image and successively halved copies of it"""
+
+    def __init__(self, image, min_size=MIN_LEVEL_SIZE, reduced=None):
+        self.levels = [image] + list(reduced if reduced is not None else reduce_levels(image, min_size))
+        self.displays = {}
+
+    @property
+    def image(self):
+        """The full-resolution level"""
+        return self.levels[0]
+
+    def level_for(self, size):
+        """Smallest level that is still at least size in both dimensions"""
+        width, height = size
+        for level in reversed(self.levels):
+            if level.width >= width and level.height >= height:
+                return level
+        return self.levels[0]
+
+    def display(self, size):
+        """High-quality resize to size, cached per size"""
+        if size not in self.displays:
+            with instrument.stage("resize"):
+                self.displays[size] = self.level_for(size).resize(size, Image.Resampling.LANCZOS)
+        return self.displays[size]
+
+
+class PyramidCache:
+    """Keeps pyramids for the few most recently used images
+
+    Images are looked up by identity, so handing back an earlier image
+    (undo, reset) reuses its pyramid and display renders instead of
+    rebuilding them. Behind that, the reduced levels are kept in the
+    shared content-addressed cache, so a reloaded copy of an image finds
+    them too.
+    """
+
+    def __init__(self, capacity=4):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+
+    def get(self, image):
+        """Pyramid for image, built on first use"""
+        key = id(image)
+        entry = self.entries.get(key)
+        if entry is None or entry.image is not image:
+            reduced = cache.default.cached("pyramid", image, (), lambda: self.build(image))
+            entry = ImagePyramid(image, reduced=reduced)
+            self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def build(image):
+        """Reduced levels of image, keyed as derived from it"""
+        levels = reduce_levels(image)
+        for index, level in enumerate(levels):
+            # Selections on a level then need no hashing of its pixels
+            cache.remember(level, cache.result_key("pyramid level", image, (index,)))
+        return tuple(levels)
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,242 @@
+"""Selections built from replayable operations.
+
+Interactive tools run on a proxy image (a pyramid level near the canvas
+size) so feedback is instant. Each operation is recorded in
+full-resolution image coordinates, and full_mask() replays the whole
+list on the original image when the selection is applied.
+
+Region operations work on a superpixel index of the full image
+(self.regions, set by the caller once built), which serves the proxy
+preview and the full-resolution replay alike.
+"""
+from PIL import Image, ImageDraw
+
+import engine
+import fill
+import graphcut
+import masks
+
+# Operations that throw away whatever was selected before them
+REPLACING = ("auto_detect", "edge")
+# Operations with a tolerance (always their fourth field) that can be re-run
+ADJUSTABLE = ("wand", "region")
+
+
+class Selection:
+    """A selection mask on a proxy image plus the operations that built it"""
+
+    def __init__(self, image, proxy=None):
+        self.image = image
+        self.proxy = proxy if proxy is not None else image
+        self.operations = []
+        self.mask = None
+        self.full = None
+        self.regions = None
+        # Mask before the last operation, for adjusting its tolerance;
+        # unknown after restore()
+        self.base = None
+        self.base_known = False
+
+    @property
+    def proxy_scale(self):
+        """(x, y) factors from full-resolution to proxy coordinates"""
+        return self.proxy.width / self.image.width, self.proxy.height / self.image.height
+
+    @property
+    def needs_regions(self):
+        """True if replaying the operations needs the superpixel index"""
+        return any(uses_regions(operation) for operation in self.operations)
+
+    def preview(self, operation, progress=None):
+        """Run an operation on the proxy without recording it
+
+        Safe to call from a worker thread. Returns the resulting mask and
+        the proxy-space box that changed (None if it all may have).
+        """
+        return run_operation(self.proxy, self.mask, operation, self.proxy_scale, progress, self.regions)
+
+    def commit(self, operation, mask):
+        """Record an operation and the proxy mask it produced"""
+        if operation[0] in REPLACING or operation[-1] == "replace":
+            self.operations = []
+        self.operations.append(operation)
+        self.base = self.mask
+        self.base_known = True
+        self.mask = mask
+
+    def restore(self, operations, mask):
+        """Go back to an earlier (operations, proxy mask) state"""
+        self.operations = list(operations)
+        self.mask = mask
+        self.base_known = False
+
+    @property
+    def adjustable(self):
+        """True if the last operation's tolerance can be changed in place"""
+        return self.base_known and bool(self.operations) and self.operations[-1][0] in ADJUSTABLE
+
+    def adjust_tolerance(self, tolerance):
+        """Re-run the last wand or region operation with a new tolerance
+
+        A magic wand click keeps a map of the tolerance at which each proxy
+        pixel joins its fill (engine.wand_distance), so this is a threshold
+        and a combine, not a new fill. Returns the proxy-space box that
+        changed, or None if the whole mask may have.
+        """
+        last = self.operations[-1]
+        operation = last[:3] + (tolerance,) + last[4:]
+        if last[0] == "wand":
+            scale_x, scale_y = self.proxy_scale
+            x = min(int(last[1] * scale_x), self.proxy.width - 1)
+            y = min(int(last[2] * scale_y), self.proxy.height - 1)
+            distance = engine.wand_distance(self.proxy, x, y, limit=engine.MAX_TOLERANCE, metric=last[4])
+            mask = masks.combine(self.base, fill.to_mask_image(distance <= tolerance), last[-1])
+            # Both the old and the new region lie inside the larger one
+            box = fill.to_mask_image(distance <= max(tolerance, last[3])).getbbox()
+        else:
+            mask, _ = run_operation(self.proxy, self.base, operation, self.proxy_scale, regions=self.regions)
+            box = None
+        self.operations[-1] = operation
+        self.mask = mask
+        return box
+
+    def perform(self, operation):
+        """Run an operation on the proxy and record it
+
+        Returns the proxy-space box that changed, or None if the whole
+        mask may have changed.
+        """
+        mask, box = self.preview(operation)
+        self.commit(operation, mask)
+        return box
+
+    def full_mask(self, progress=None):
+        """The selection at full resolution, replayed once and cached"""
+        if self.proxy is self.image:
+            return self.mask
+
+        # Snapshot the operations so a concurrent commit cannot mix states
+        operations = list(self.operations)
+        if self.full is None or self.full[0] != operations:
+            mask = None
+            for done, operation in enumerate(operations):
+                step = None
+                if progress:
+                    # Spread each operation's own progress over its share
+                    def step(fraction, done=done):
+                        progress((done + fraction) / len(operations))
+                    step(0)
+                mask, _ = run_operation(self.image, mask, operation, (1.0, 1.0), step, self.regions)
+            self.full = (operations, mask)
+        return self.full[1]
+
+    def count_selected(self):
+        """Approximate number of selected full-resolution pixels"""
+        scale_x, scale_y = self.proxy_scale
+        return round(masks.count_selected(self.mask) / (scale_x * scale_y))
+
+
+class Stroke:
+    """A brush drag on a selection, painted into a copy of its proxy mask
+
+    Each new point only draws the segment from the previous one, so a
+    mouse event costs the segment's area instead of the mask's. The
+    finished stroke is committed as one "brush" operation, whose replay
+    gives the same proxy mask.
+    """
+
+    def __init__(self, selection, radius, mode):
+        self.selection = selection
+        self.radius = radius
+        self.mode = mode
+        self.points = []
+        self.scale = selection.proxy_scale
+        self.proxy_radius = radius * self.scale[0]
+        # Masks may be shared with the result cache, so never paint into one
+        if mode == "replace" or selection.mask is None:
+            self.mask = Image.new("L", selection.proxy.size, 0)
+        else:
+            self.mask = selection.mask.copy()
+        self.draw = ImageDraw.Draw(self.mask)
+        self.value = 0 if mode == "subtract" else 255
+
+    @property
+    def operation(self):
+        """The recorded operation for the stroke so far"""
+        return ("brush", list(self.points), self.radius, self.mode)
+
+    def add(self, x, y):
+        """Extend the stroke to full-resolution (x, y)
+
+        Returns the proxy-space box that was painted.
+        """
+        scale_x, scale_y = self.scale
+        segment = [self.points[-1], (x, y)] if self.points else [(x, y)]
+        segment = [(px * scale_x, py * scale_y) for px, py in segment]
+        self.points.append((x, y))
+        engine.paint_stroke(self.draw, segment, self.proxy_radius, self.value)
+
+        reach = self.proxy_radius + 2
+        xs, ys = zip(*segment)
+        return (max(0, int(min(xs) - reach)), max(0, int(min(ys) - reach)),
+                min(self.mask.width, int(max(xs) + reach) + 1), min(self.mask.height, int(max(ys) + reach) + 1))
+
+
+def uses_regions(operation):
+    """True for operations that work on superpixel regions"""
+    return operation[0] in ("region", "grabcut")
+
+
+def run_operation(image, mask, operation, scale, progress=None, regions=None):
+    """Apply one recorded operation to mask on image
+
+    Coordinates in the operation are full-resolution and are multiplied by
+    scale. progress is passed on to the slow engine functions. regions is
+    the superpixel index that region operations need. Returns the new mask
+    and the box that changed (None for all).
+    """
+    scale_x, scale_y = scale
+    kind = operation[0]
+
+    def to_image(x, y):
+        return (min(int(x * scale_x), image.width - 1), min(int(y * scale_y), image.height - 1))
+
+    if kind == "wand":
+        _, x, y, tolerance, metric, mode = operation
+        region = engine.mask_from_seed(image, *to_image(x, y), tolerance, metric=metric)
+        box = region.getbbox() if mode != "replace" and mask is not None else None
+        return masks.combine(mask, region, mode), box
+    if kind == "region":
+        _, x, y, tolerance, mode = operation
+        region = regions.mask(regions.grow(regions.region_at(x, y), tolerance), image.size, image)
+        box = region.getbbox() if mode != "replace" and mask is not None else None
+        return masks.combine(mask, region, mode), box
+    if kind == "polygon":
+        _, points, mode = operation
+        region = engine.polygon_mask(image.size, [to_image(x, y) for x, y in points])
+        box = region.getbbox() if mode != "replace" and mask is not None else None
+        return masks.combine(mask, region, mode), box
+    if kind == "brush":
+        # Unclamped, so strokes running off the edge keep their shape
+        _, points, radius, mode = operation
+        region = engine.stroke_mask(image.size, [(x * scale_x, y * scale_y) for x, y in points], radius * scale_x)
+        box = region.getbbox() if mode != "replace" and mask is not None else None
+        return masks.combine(mask, region, mode), box
+    if kind == "stored":
+        # A maskfile.StoredSelection, scaled to whichever image is being replayed
+        _, stored, mode = operation
+        region = stored.mask_for(image.size)
+        box = region.getbbox() if mode != "replace" and mask is not None else None
+        return masks.combine(mask, region, mode), box
+    if kind == "auto_detect":
+        return engine.auto_detect(image, progress=progress), None
+    if kind == "grabcut":
+        # Seeded from a box if given, else from the selection so far
+        _, box = operation
+        selected = graphcut.segment(regions, box=box, mask=mask if box is None else None, progress=progress)
+        return regions.mask(selected, image.size, image), None
+    if kind == "edge":
+        return engine.edge_mask(image, progress=progress), None
+    if kind == "invert":
+        return masks.invert(mask), None
+    raise ValueError(f"Unknown selection operation: {kind}")
@@ -0,0 +1,303 @@
+"""Local HTTP server for background removal.
+
+Serves the headless engine to other programs on this machine:
+
+    python server.py --port 8080 -j 4
+    curl --data-binary @photo.jpg "http://localhost:8080/remove?bg=255,255,255&format=jpg" -o cutout.jpg
+
+POST /remove takes the image file as the request body and the recipe as
+query parameters: seed=x,y (repeatable; default auto-detect), tolerance,
+metric, bg=r,g,b (default keeps transparency), feather, matte=1,
+format=png|jpg|webp (default PNG when transparent, JPEG with bg) or
+preset (an export preset such as png-fast or webp-lossless), and crop=1
+to crop to the subject. GET /health reports the pool's load as JSON.
+
+Images are processed on a pool of worker processes. At most --queue
+requests wait for a free worker; beyond that the server answers 503 with
+Retry-After straight away, so callers back off instead of piling up.
+The body of a rejected request is read and dropped first if it is at
+most DRAIN_BYTES; a larger upload is cut off, and its client may see the
+connection reset instead of the 503.
+The worker encodes the whole result before it is sent, so responses
+carry a plain Content-Length rather than being streamed. Every response
+also has a Server-Timing header (upload, queue, decode, process, encode)
+and the encoded size in X-Image-Bytes.
+"""
+import argparse
+import io
+import json
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image, UnidentifiedImageError
+
+import batch
+import colorspace
+import engine
+import export
+
+MAX_UPLOAD_BYTES = 200 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# Unused request bodies up to this size are read before an error reply
+DRAIN_BYTES = 1024 * 1024
+RETRY_AFTER_SECONDS = 1
+
+
+class RequestError(Exception):
+    """A problem with the request itself, answered with status"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_recipe(query):
+    """(recipe, export preset name) from a parsed query string"""
+    def single(name, convert):
+        values = query.get(name)
+        return convert(values[-1]) if values else None
+
+    try:
+        recipe = {
+            "seeds": [batch.parse_point(value) for value in query.get("seed", [])] or None,
+            "tolerance": single("tolerance", int),
+            "bg_color": single("bg", batch.parse_color),
+            "feather": single("feather", int) or 0,
+            "matte": single("matte", lambda value: value.lower() in ("1", "true", "yes")) or False,
+            "metric": single("metric", str) or colorspace.DEFAULT_METRIC,
+            "crop": single("crop", lambda value: value.lower() in ("1", "true", "yes")) or False,
+        }
+    except (ValueError, argparse.ArgumentTypeError) as e:
+        raise RequestError(400, f"bad recipe: {e}")
+    if recipe["metric"] not in colorspace.METRICS:
+        raise RequestError(400, f"unknown metric {recipe['metric']!r}")
+
+    preset = single("preset", str.lower)
+    if preset is not None and preset not in export.PRESETS:
+        raise RequestError(400, f"unknown preset {preset!r}")
+    name = single("format", str.lower)
+    if name is not None:
+        if "." + name not in export.EXTENSION_PRESETS:
+            raise RequestError(400, f"unknown format {name!r}")
+        preset = export.preset_for("." + name, preset)
+    elif preset is None:
+        preset = "jpeg" if recipe["bg_color"] else "png"
+    return recipe, preset
+
+
+def render(data, recipe, preset, timeout):
+    """Worker: decode, run the recipe and encode; returns (bytes, size, timings)
+
+    timings holds the wall-clock start and the seconds spent per stage.
+    """
+    started = time.time()
+    use_alarm = timeout and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, batch.on_timeout)
+        signal.alarm(timeout)
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        decoded = time.time()
+        result = engine.remove_background(image, **recipe)
+        processed = time.time()
+        payload = export.encode(result, preset)[0]
+        encoded = time.time()
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+    timings = {"start": started, "decode": decoded - started, "process": processed - decoded,
+               "encode": encoded - processed}
+    return payload, image.size, timings
+
+
+class RemoverServer(ThreadingHTTPServer):
+    """HTTP server that owns the worker pool and the queue slots"""
+
+    daemon_threads = True
+
+    def __init__(self, address, workers=None, queue_size=None, timeout=120, cache_dir=None, trace=None):
+        super().__init__(address, RequestHandler)
+        self.workers = workers or os.cpu_count()
+        self.queue_size = self.workers if queue_size is None else queue_size
+        self.timeout = timeout
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=batch.init_worker,
+                                        initargs=(cache_dir, False, trace))
+        # One slot per worker plus one per queued request; no slot means 503
+        self.slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.served = 0
+        self.rejected = 0
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(cancel_futures=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/health":
+            self.send_json(404, {"error": "not found"})
+            return
+        server = self.server
+        with server.lock:
+            in_flight = server.in_flight
+        self.send_json(200, {"workers": server.workers, "queue_size": server.queue_size,
+                             "running": min(in_flight, server.workers),
+                             "queued": max(0, in_flight - server.workers),
+                             "served": server.served, "rejected": server.rejected})
+
+    def do_POST(self):
+        started = time.time()
+        url = urlsplit(self.path)
+        if url.path != "/remove":
+            self.send_json(404, {"error": "not found"})
+            return
+        server = self.server
+        if not server.slots.acquire(blocking=False):
+            with server.lock:
+                server.rejected += 1
+            self.drain_body()
+            self.close_connection = True
+            self.send_json(503, {"error": "busy, retry later"}, [("Retry-After", str(RETRY_AFTER_SECONDS)),
+                                                                  ("Connection", "close")])
+            return
+        with server.lock:
+            server.in_flight += 1
+        self.body_read = False
+        error = None
+        try:
+            payload, headers = self.remove(url, started)
+        except RequestError as e:
+            error = e
+        finally:
+            # Free the slot before replying, so a client's next request can have it
+            with server.lock:
+                server.in_flight -= 1
+            server.slots.release()
+
+        if error is not None:
+            if not self.body_read:
+                self.drain_body()
+            self.close_connection = True
+            self.send_json(error.status, {"error": str(error)}, [("Connection", "close")])
+            return
+        self.send_response(200)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        with server.lock:
+            server.served += 1
+
+    def drain_body(self):
+        """Read and drop an unused request body of at most DRAIN_BYTES
+
+        A client that is still sending when the reply comes and the
+        connection closes often sees a reset instead of the reply.
+        """
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            return
+        if length > DRAIN_BYTES:
+            return
+        while length > 0:
+            chunk = self.rfile.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+
+    def read_body(self):
+        """The request body, read in chunks"""
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            raise RequestError(411, "Content-Length required")
+        if length > MAX_UPLOAD_BYTES:
+            raise RequestError(413, f"upload larger than {MAX_UPLOAD_BYTES} bytes")
+        self.body_read = True
+        body = io.BytesIO()
+        while body.tell() < length:
+            chunk = self.rfile.read(min(CHUNK_SIZE, length - body.tell()))
+            if not chunk:
+                raise RequestError(400, "upload ended early")
+            body.write(chunk)
+        return body.getvalue()
+
+    def remove(self, url, started):
+        """Run a request's recipe; returns the result bytes and the reply headers"""
+        recipe, preset = parse_recipe(parse_qs(url.query))
+        data = self.read_body()
+        uploaded = time.time()
+
+        future = self.server.pool.submit(render, data, recipe, preset, self.server.timeout)
+        try:
+            payload, size, timings = future.result()
+        except TimeoutError:
+            raise RequestError(504, "processing timed out")
+        except UnidentifiedImageError:
+            raise RequestError(400, "not a readable image")
+        except OSError as e:
+            raise RequestError(400, f"cannot read image: {e}")
+        except Exception as e:
+            raise RequestError(500, f"{type(e).__name__}: {e}")
+        finished = time.time()
+
+        stages = [("upload", uploaded - started), ("queue", max(0.0, timings["start"] - uploaded)),
+                  ("decode", timings["decode"]), ("process", timings["process"]), ("encode", timings["encode"]),
+                  ("total", finished - started)]
+        return payload, [("Content-Type", export.CONTENT_TYPES[export.PRESETS[preset][0]]),
+                         ("Content-Length", str(len(payload))),
+                         ("Server-Timing", ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stages)),
+                         ("X-Image-Size", f"{size[0]}x{size[1]}"),
+                         ("X-Image-Bytes", str(len(payload)))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve background removal over HTTP on this machine.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on (0 picks a free one)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--queue", type=int, help="requests that may wait for a worker (default: one per worker)")
+    parser.add_argument("--timeout", type=int, default=120, help="seconds allowed per image (0 = no limit)")
+    parser.add_argument("--cache", metavar="DIR", help="keep selection masks here so repeated images skip the work")
+    parser.add_argument("--trace", metavar="FILE", help="append a JSON line per pipeline stage run to FILE")
+    args = parser.parse_args(argv)
+
+    trace = os.path.abspath(args.trace) if args.trace else None
+    server = RemoverServer((args.host, args.port), args.workers, args.queue, args.timeout, args.cache, trace)
+    host, port = server.server_address[:2]
+    print(f"Serving on http://{host}:{port}/remove with {server.workers} workers, {server.queue_size} queue slots")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
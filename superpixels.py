@@ -0,0 +1,332 @@
+"""Superpixel over-segmentation for region-level selection.
+
+A SLIC-style clustering splits the image into a few thousand compact
+regions of similar color whose borders follow real edges. The index keeps
+each region's mean color and a region adjacency graph, so the magic wand
+and the graph-cut auto-detect work on regions instead of millions of
+pixels: after the index is built once per image, a click costs the same
+at any resolution.
+
+Clustering runs on a reduced copy of at most WORK_PIXELS pixels; the
+label map is scaled to whatever mask size is asked for. Scaled up alone,
+a selection's border would be a staircase as wide as the reduction, so
+masks larger than the label map have the pixels along their border
+reassigned at full resolution (see SuperpixelIndex.refine_border).
+"""
+import math
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+import cache
+import fill
+
+DEFAULT_REGIONS = 2000
+WORK_PIXELS = 1_000_000
+COMPACTNESS = 20
+ITERATIONS = 6
+BITMAP_LIMIT = 64 * 1024 * 1024
+# Full-resolution rows refined at a time, to bound memory on large images
+REFINE_ROWS = 256
+
+
+def slic(pixels, count, compactness=COMPACTNESS, iterations=ITERATIONS, progress=None):
+    """Cluster pixels into about count compact regions of similar color
+
+    The image is cut into a grid of square cells, one cluster center per
+    cell, and each pixel is only compared with the centers of its own and
+    the eight neighbouring cells. Pixels are laid out cell by cell so those
+    comparisons broadcast per cell instead of gathering per pixel.
+    Returns an int32 label map.
+    """
+    height, width = pixels.shape[:2]
+    step = max(2, int(math.sqrt(height * width / count)))
+    grid_rows, grid_cols = math.ceil(height / step), math.ceil(width / step)
+    spatial_weight = (compactness / step) ** 2
+
+    # (grid_rows, grid_cols, step, step) cells, padded at the bottom/right edge
+    padded = np.pad(pixels[..., :3], ((0, grid_rows * step - height), (0, grid_cols * step - width), (0, 0)), mode="edge")
+    cells = padded.astype(np.float32).reshape(grid_rows, step, grid_cols, step, 3).transpose(4, 0, 2, 1, 3)
+    cells = np.ascontiguousarray(cells)
+    cell_y = (np.arange(grid_rows)[:, None] * step + np.arange(step)).astype(np.float32)[:, None, :, None]
+    cell_x = (np.arange(grid_cols)[:, None] * step + np.arange(step)).astype(np.float32)[None, :, None, :]
+    valid = (cell_y < height) & (cell_x < width)
+    valid = np.broadcast_to(valid, cells.shape[1:])
+
+    # Pixel values of the real (unpadded) pixels, for the center updates
+    flat_y = np.broadcast_to(cell_y, cells.shape[1:])[valid]
+    flat_x = np.broadcast_to(cell_x, cells.shape[1:])[valid]
+    flat_colors = [channel[valid] for channel in cells]
+
+    # Start from the cell centers
+    grid_y, grid_x = np.meshgrid(np.arange(grid_rows), np.arange(grid_cols), indexing="ij")
+    center_y = np.minimum(grid_y * step + step // 2, height - 1).ravel().astype(np.float32)
+    center_x = np.minimum(grid_x * step + step // 2, width - 1).ravel().astype(np.float32)
+    center_colors = [pixels[center_y.astype(int), center_x.astype(int), channel].astype(np.float32)
+                     for channel in range(3)]
+
+    labels = np.zeros(cells.shape[1:], dtype=np.int32)
+    best = np.empty(cells.shape[1:], dtype=np.float32)
+    for iteration in range(iterations):
+        if progress:
+            progress(iteration / iterations)
+        best.fill(np.inf)
+        for dy in (-1, 0, 1):
+            rows = np.clip(np.arange(grid_rows) + dy, 0, grid_rows - 1)
+            for dx in (-1, 0, 1):
+                cols = np.clip(np.arange(grid_cols) + dx, 0, grid_cols - 1)
+                candidate = (rows[:, None] * grid_cols + cols)[:, :, None, None]
+                distance = spatial_weight * ((cell_y - center_y[candidate]) ** 2 + (cell_x - center_x[candidate]) ** 2)
+                for channel, center in zip(cells, center_colors):
+                    distance += (channel - center[candidate]) ** 2
+                closer = distance < best
+                np.copyto(best, distance, where=closer)
+                np.copyto(labels, candidate, where=closer)
+
+        # Move every center to the mean of its pixels; empty ones stay put
+        flat_labels = labels[valid]
+        sizes = np.bincount(flat_labels, minlength=len(center_y))
+        occupied = sizes > 0
+        for values, center in zip([flat_y, flat_x] + flat_colors, [center_y, center_x] + center_colors):
+            sums = np.bincount(flat_labels, values, len(center_y))
+            center[occupied] = sums[occupied] / sizes[occupied]
+
+    labels = labels.transpose(0, 2, 1, 3).reshape(grid_rows * step, grid_cols * step)
+    return np.ascontiguousarray(labels[:height, :width])
+
+
+def split_disconnected(labels):
+    """Relabel so every region is 4-connected, numbering regions from 0
+
+    Works on runs of equal labels, like fill.label_components does on
+    runs of allowed pixels.
+    """
+    height, width = labels.shape
+    starts_here = np.ones((height, width), dtype=bool)
+    starts_here[:, 1:] = labels[:, 1:] != labels[:, :-1]
+    rows, starts = np.nonzero(starts_here)
+    ends = np.append(starts[1:], width)
+    ends[np.append(rows[1:] != rows[:-1], True)] = width
+
+    upper, lower = fill.link_runs(rows, starts, ends, width)
+    run_values = labels[rows, starts]
+    same = run_values[upper] == run_values[lower]
+    roots = fill.label_runs(len(rows), upper[same], lower[same])
+    _, regions = np.unique(roots, return_inverse=True)
+    return np.repeat(regions.astype(np.int32), ends - starts).reshape(height, width)
+
+
+def adjacency(labels, lengths=False):
+    """Unique (a, b) region pairs with a < b that share a pixel edge
+
+    With lengths, also returns how many pixel edges each pair shares.
+    """
+    count = int(labels.max()) + 1
+    pairs = []
+    for a, b in ((labels[:, :-1], labels[:, 1:]), (labels[:-1], labels[1:])):
+        differs = a != b
+        pairs.append(np.minimum(a, b)[differs].astype(np.int64) * count + np.maximum(a, b)[differs])
+    keys = np.concatenate(pairs)
+    if lengths:
+        keys, shared = np.unique(keys, return_counts=True)
+        return np.stack(np.divmod(keys, count), axis=1), shared
+    if count * count <= BITMAP_LIMIT:
+        # Few regions: marking a count x count bitmap beats sorting the pairs
+        seen = np.zeros(count * count, dtype=bool)
+        seen[keys] = True
+        keys = np.flatnonzero(seen)
+    else:
+        keys.sort()
+        keys = keys[np.append(True, keys[1:] != keys[:-1])]
+    return np.stack(np.divmod(keys, count), axis=1)
+
+
+def merge_small(labels, min_size):
+    """Fold regions smaller than min_size into a neighbour"""
+    for _ in range(4):
+        sizes = np.bincount(labels.ravel())
+        small = sizes < min_size
+        if not small.any():
+            break
+        edges = adjacency(labels)
+        # Each small region joins its largest neighbour, if that ranks above
+        # it by (size, label); ranks only go up, so chains end and never cycle
+        rank = sizes.astype(np.int64) * len(sizes) + np.arange(len(sizes))
+        target = np.arange(len(sizes))
+        for a, b in ((edges[:, 0], edges[:, 1]), (edges[:, 1], edges[:, 0])):
+            better = small[a] & (rank[b] > rank[a])
+            order = np.argsort(rank[b[better]])
+            target[a[better][order]] = b[better][order]
+        while True:
+            followed = target[target]
+            if np.array_equal(followed, target):
+                break
+            target = followed
+        renumber = np.zeros(len(sizes), dtype=np.int32)
+        kept = np.unique(target)
+        renumber[kept] = np.arange(len(kept))
+        labels = renumber[target][labels]
+    return labels
+
+
+class SuperpixelIndex:
+    """Superpixels of one image with their mean colors and adjacency"""
+
+    def __init__(self, image, count=DEFAULT_REGIONS, progress=None):
+        self.image_size = image.size
+        work = image if image.mode in ("RGB", "RGBA") else image.convert("RGB")
+        factor = max(1, math.ceil(math.sqrt(image.width * image.height / WORK_PIXELS)))
+        if factor > 1:
+            work = work.reduce(factor)
+        pixels = fill.as_rgb_array(work)
+
+        labels = slic(pixels, count, progress=progress)
+        labels = split_disconnected(labels)
+        step = math.sqrt(labels.size / count)
+        self.labels = merge_small(labels, max(1, int(step * step / 8)))
+        self.size = work.size
+        self.count = int(self.labels.max()) + 1
+
+        self.sizes = np.bincount(self.labels.ravel(), minlength=self.count)
+        flat = pixels.reshape(-1, 3)
+        self.means = np.stack([np.bincount(self.labels.ravel(), flat[:, channel], self.count) / self.sizes
+                               for channel in range(3)], axis=1)
+        edges, self.shared = adjacency(self.labels, lengths=True)
+        self.upper, self.lower = edges[:, 0], edges[:, 1]
+
+    @property
+    def nbytes(self):
+        """Memory held by the label map and per-region tables"""
+        return sum(array.nbytes for array in (self.labels, self.sizes, self.means, self.upper, self.lower, self.shared))
+
+    def region_at(self, x, y):
+        """Region under full-resolution image coordinates (x, y)"""
+        work_x = min(int(x * self.size[0] / self.image_size[0]), self.size[0] - 1)
+        work_y = min(int(y * self.size[1] / self.image_size[1]), self.size[1] - 1)
+        return int(self.labels[work_y, work_x])
+
+    def grow(self, region, tolerance, target_color=None):
+        """Boolean map over regions: those connected to region within tolerance
+
+        Like the pixel magic wand, but every step is a whole region and
+        colors are region means. target_color defaults to region's mean.
+        """
+        if target_color is None:
+            target_color = self.means[region]
+        allowed = ((self.means - np.asarray(target_color[:3], dtype=np.float64)) ** 2).sum(axis=1) <= tolerance * tolerance
+        allowed[region] = True
+        both = allowed[self.upper] & allowed[self.lower]
+        roots = fill.label_runs(self.count, self.upper[both], self.lower[both])
+        return allowed & (roots == roots[region])
+
+    def fraction_in(self, mask):
+        """Per region, the fraction of its pixels selected in an "L" mask"""
+        if mask.size != self.size:
+            mask = mask.resize(self.size, Image.Resampling.NEAREST)
+        selected = np.asarray(mask).ravel() > 0
+        return np.bincount(self.labels.ravel(), selected, self.count) / self.sizes
+
+    def fraction_inside(self, box):
+        """Per region, the fraction of its pixels inside a full-resolution box"""
+        scale_x, scale_y = self.size[0] / self.image_size[0], self.size[1] / self.image_size[1]
+        left, top, right, bottom = box
+        inside = self.labels[int(top * scale_y):math.ceil(bottom * scale_y), int(left * scale_x):math.ceil(right * scale_x)]
+        return np.bincount(inside.ravel(), minlength=self.count) / self.sizes
+
+    def mask(self, selected, size=None, image=None):
+        """ "L" mask of the selected regions, at size (default full resolution)
+
+        image, if given, is the image at size; a mask larger than the label
+        map then has its border refined on it (see refine_border).
+        """
+        size = size or self.image_size
+        lut = np.where(selected, 255, 0).astype(np.uint8)
+        mask = Image.fromarray(lut[self.labels], "L")
+        if mask.size == size:
+            return mask
+        mask = mask.resize(size, Image.Resampling.NEAREST)
+        if image is None or size[0] * size[1] <= self.labels.size:
+            return mask
+        return self.refine_border(selected, mask, image)
+
+    def refine_border(self, selected, mask, image):
+        """Snap the border of a scaled-up region mask to the edges in image
+
+        Label map pixels where the selection changes form a band two of
+        them wide. Each full-resolution pixel in the band goes to the
+        region, among those around it in the label map, whose mean color
+        is nearest its own, so the border moves to the real edge inside
+        the band. Pixels away from the border keep their region.
+        """
+        inside = selected[self.labels]
+        border = np.zeros(inside.shape, dtype=bool)
+        changes = inside[:, 1:] != inside[:, :-1]
+        border[:, 1:] |= changes
+        border[:, :-1] |= changes
+        changes = inside[1:] != inside[:-1]
+        border[1:] |= changes
+        border[:-1] |= changes
+        if not border.any():
+            return mask
+
+        # Candidate regions of each border pixel: its own and its 8 neighbours'
+        rows, columns = np.nonzero(border)
+        padded = np.pad(self.labels, 1, mode="edge")
+        candidates = np.stack([padded[rows + dy, columns + dx] for dy in range(3) for dx in range(3)], axis=1)
+        slot = np.full(self.labels.shape, -1, dtype=np.int32)
+        slot[rows, columns] = np.arange(len(rows))
+
+        # Label map pixel under each full-resolution row and column, as NEAREST picks it
+        width, height = mask.size
+        label_rows = np.minimum(((np.arange(height) + 0.5) * self.size[1] / height).astype(int), self.size[1] - 1)
+        label_columns = np.minimum(((np.arange(width) + 0.5) * self.size[0] / width).astype(int), self.size[0] - 1)
+        border_rows = border.any(axis=1)
+        lut = np.where(selected, 255, 0).astype(np.uint8)
+        pixels = np.array(mask)
+        for top in range(0, height, REFINE_ROWS):
+            bottom = min(top + REFINE_ROWS, height)
+            if not border_rows[label_rows[top:bottom]].any():
+                continue
+            slots = slot[label_rows[top:bottom]][:, label_columns]
+            band = slots >= 0
+            colors = fill.as_rgb_array(image.crop((0, top, width, bottom)))[band].astype(np.float64)
+            choices = candidates[slots[band]]
+            distance = ((self.means[choices] - colors[:, None, :]) ** 2).sum(axis=2)
+            nearest = choices[np.arange(len(choices)), distance.argmin(axis=1)]
+            pixels[top:bottom][band] = lut[nearest]
+        return Image.fromarray(pixels, "L")
+
+
+class SuperpixelCache:
+    """Superpixel indexes for the few most recently used images
+
+    Keyed by image identity like pyramid.PyramidCache, so each image is
+    segmented once no matter how many selections use it, and backed by the
+    shared content-addressed cache for copies of the same pixels.
+    """
+
+    def __init__(self, capacity=4):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+
+    def get(self, image, progress=None):
+        """Index for image, built on first use"""
+        key = id(image)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] is not image:
+            entry = (image, cache.default.cached("superpixels", image, (),
+                                                 lambda: SuperpixelIndex(image, progress=progress)))
+            self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return entry[1]
+
+    def peek(self, image):
+        """Index for image if it has been built, else None"""
+        entry = self.entries.get(id(image))
+        return entry[1] if entry and entry[0] is image else None
+
+    def clear(self):
+        self.entries.clear()
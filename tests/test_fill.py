@@ -0,0 +1,42 @@
+"""The wand's tolerance map must agree with the flood fill at every tolerance."""
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fill  # noqa: E402
+
+
+def comb(size):
+    """Dark teeth across a light field, so the fill winds back and forth"""
+    pixels = np.full((size, size, 3), 230, dtype=np.uint8)
+    for number, row in enumerate(range(2, size - 1, 4)):
+        if number % 2:
+            pixels[row, 1:] = 20
+        else:
+            pixels[row, :-1] = 20
+    pixels[..., 1] = (np.arange(size) * 7 % 60)[None, :]
+    return Image.fromarray(pixels, "RGB")
+
+
+def test_bottleneck_distance_thresholds_to_flood_fill():
+    rng = np.random.default_rng(0)
+    images = [comb(41), Image.fromarray((rng.integers(0, 256, (30, 40, 3)) // 48 * 48).astype(np.uint8), "RGB")]
+    for image in images:
+        for limit in (None, 60):
+            distance = fill.bottleneck_distance(image, 3, 5, limit=limit)
+            assert distance.dtype == np.uint16
+            for tolerance in (0, 10, 25, 40, 60):
+                assert np.array_equal(distance <= tolerance, fill.flood_fill(image, 3, 5, tolerance))
+            if limit is not None:
+                assert distance.max() <= limit + 1
+
+
+def test_flood_fill_outside_the_image_is_empty():
+    image = comb(9)
+    for x, y in ((9, 0), (0, 9), (-1, 0), (0, -1)):
+        region = fill.flood_fill(image, x, y, 30)
+        assert region.shape == (9, 9) and not region.any()
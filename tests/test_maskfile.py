@@ -0,0 +1,67 @@
+"""Selection files must give back the selection that produced the cut-out."""
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import engine  # noqa: E402
+import maskfile  # noqa: E402
+
+
+def soft_mask():
+    """An ellipse with a blurred edge, so it has values from 1 to 254"""
+    mask = Image.new("L", (120, 80), 0)
+    ImageDraw.Draw(mask).ellipse((20, 10, 100, 70), fill=255)
+    return mask.filter(ImageFilter.GaussianBlur(4))
+
+
+def test_round_trip_keeps_soft_edges_selected():
+    mask = soft_mask()
+    assert 0 < np.count_nonzero((np.asarray(mask) > 0) & (np.asarray(mask) < 128))
+    stored = maskfile.decode(maskfile.encode(mask))
+    assert np.array_equal(np.asarray(engine.coverage(stored.mask)), np.asarray(engine.coverage(mask)))
+
+
+def test_round_trip_empty_and_full():
+    for value in (0, 255):
+        mask = Image.new("L", (9, 7), value)
+        assert np.array_equal(np.asarray(maskfile.decode(maskfile.encode(mask)).mask), np.asarray(mask))
+
+
+def test_matches_the_source_image():
+    image = Image.new("RGB", (120, 80), (10, 20, 30))
+    stored = maskfile.decode(maskfile.encode(soft_mask(), image))
+    assert stored.matches(image)
+    assert not stored.matches(Image.new("RGB", (120, 80), (10, 20, 31)))
+
+
+def with_header(data, **changes):
+    """data with its JSON header fields changed"""
+    start = len(maskfile.MAGIC) + maskfile.HEADER_LENGTH.size
+    (length,) = maskfile.HEADER_LENGTH.unpack_from(data, len(maskfile.MAGIC))
+    header = json.loads(data[start:start + length])
+    header.update(changes)
+    encoded = json.dumps(header).encode()
+    return maskfile.MAGIC + maskfile.HEADER_LENGTH.pack(len(encoded)) + encoded + data[start + length:]
+
+
+@pytest.mark.parametrize("changes", [
+    {"box": None}, {"box": [-10, 10, 100, 70]}, {"box": [20, 10, 500, 70]}, {"box": [100, 10, 20, 70]},
+    {"size": [1 << 20, 1 << 20]}, {"size": "wide"}, {"encoding": "jpeg"},
+])
+def test_damaged_headers_are_refused(changes):
+    data = maskfile.encode(soft_mask())
+    with pytest.raises(maskfile.SelectionFileError):
+        maskfile.decode(with_header(data, **changes))
+
+
+def test_truncated_data_is_refused():
+    data = maskfile.encode(soft_mask())
+    for cut in (1, 10, len(data) // 2):
+        with pytest.raises(maskfile.SelectionFileError):
+            maskfile.decode(data[:-cut])
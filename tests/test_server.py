@@ -0,0 +1,76 @@
+"""The HTTP server, driven over localhost."""
+import http.client
+import io
+import os
+import sys
+import threading
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def remover():
+    instance = server.RemoverServer(("127.0.0.1", 0), workers=1, queue_size=0, timeout=60)
+    thread = threading.Thread(target=instance.serve_forever, daemon=True)
+    thread.start()
+    yield instance
+    instance.shutdown()
+    instance.server_close()
+    thread.join()
+
+
+def photo():
+    """PNG bytes of a red block on a light background"""
+    image = Image.new("RGB", (60, 40), (250, 250, 250))
+    image.paste((200, 30, 30), (20, 10, 40, 30))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def post(remover, query, body):
+    """(status, headers, body) of POST /remove?query"""
+    connection = http.client.HTTPConnection(*remover.server_address[:2], timeout=60)
+    try:
+        connection.request("POST", "/remove?" + query, body=body)
+        response = connection.getresponse()
+        return response.status, response.headers, response.read()
+    finally:
+        connection.close()
+
+
+def test_result_has_type_timing_and_size(remover):
+    status, headers, body = post(remover, "seed=30,20&format=png", photo())
+    assert status == 200
+    assert headers["Content-Type"] == "image/png"
+    assert "process;dur=" in headers["Server-Timing"]
+    assert int(headers["X-Image-Bytes"]) == len(body)
+    result = Image.open(io.BytesIO(body))
+    assert result.mode == "RGBA"
+    assert result.getpixel((0, 0))[3] == 0
+    assert result.getpixel((30, 20))[3] == 255
+
+
+def test_bad_requests_get_400(remover):
+    assert post(remover, "tolerance=lots", photo())[0] == 400
+    assert post(remover, "format=gif", photo())[0] == 400
+    assert post(remover, "", b"not an image")[0] == 400
+
+
+def test_busy_server_answers_503(remover):
+    slots = remover.workers + remover.queue_size
+    for _ in range(slots):
+        remover.slots.acquire()
+    try:
+        # Large enough that an unread body would fill the socket buffers
+        status, headers, _ = post(remover, "", b"\0" * (server.DRAIN_BYTES - 1))
+    finally:
+        for _ in range(slots):
+            remover.slots.release()
+    assert status == 503
+    assert headers["Retry-After"] == str(server.RETRY_AFTER_SECONDS)
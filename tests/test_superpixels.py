@@ -0,0 +1,32 @@
+"""Region selections on large images must follow the real edge, not the label map's grid."""
+import os
+import sys
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import superpixels  # noqa: E402
+
+SIZE = (1600, 1200)
+
+
+def disc():
+    """A noisy red disc on blue, larger than the clustering works on, and its true mask"""
+    truth = Image.new("L", SIZE, 0)
+    ImageDraw.Draw(truth).ellipse((400, 250, 1150, 1000), fill=255)
+    image = Image.composite(Image.new("RGB", SIZE, (200, 60, 40)), Image.new("RGB", SIZE, (40, 120, 210)), truth)
+    noise = np.random.default_rng(0).normal(0, 8, (SIZE[1], SIZE[0], 3))
+    return Image.fromarray(np.clip(np.asarray(image) + noise, 0, 255).astype(np.uint8)), np.asarray(truth) > 0
+
+
+def test_full_resolution_border_follows_the_edge():
+    image, truth = disc()
+    index = superpixels.SuperpixelIndex(image)
+    assert index.size[0] < image.width
+    selected = index.grow(index.region_at(775, 625), 30)
+    coarse = np.asarray(index.mask(selected, image.size)) > 0
+    refined = np.asarray(index.mask(selected, image.size, image)) > 0
+    assert (coarse != truth).sum() > 1000
+    assert (refined != truth).sum() < (coarse != truth).sum() // 20
@@ -0,0 +1,74 @@
+"""Source transparency must survive apply and composite for every mode with alpha."""
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import engine  # noqa: E402
+import export  # noqa: E402
+import tiled  # noqa: E402
+
+SIZE = (8, 6)
+
+
+def la_image():
+    """Gray with a fully transparent left half"""
+    alpha = Image.new("L", SIZE, 255)
+    alpha.paste(0, (0, 0, SIZE[0] // 2, SIZE[1]))
+    return Image.merge("LA", (Image.new("L", SIZE, 120), alpha))
+
+
+def palette_image():
+    """Palette image whose index 0 is transparent (tRNS), used on the left half"""
+    image = Image.new("P", SIZE, 1)
+    image.putpalette([0, 0, 0, 200, 30, 30] + [0] * 762)
+    image.paste(0, (0, 0, SIZE[0] // 2, SIZE[1]))
+    image.info["transparency"] = 0
+    return image
+
+
+def select_all():
+    return Image.new("L", SIZE, 255)
+
+
+@pytest.mark.parametrize("make", [la_image, palette_image])
+@pytest.mark.parametrize("matte", [False, True])
+def test_apply_mask_keeps_source_alpha(make, matte):
+    result, _, _ = engine.apply_mask(make(), select_all(), matte=matte)
+    alpha = np.asarray(result.getchannel("A"))
+    assert result.mode == "RGBA"
+    assert (alpha[:, :SIZE[0] // 2] == 0).all()
+    assert (alpha[:, SIZE[0] // 2:] == 255).all()
+
+
+@pytest.mark.parametrize("make", [la_image, palette_image])
+def test_composite_shows_background_through_source_alpha(make):
+    result, _, _ = engine.composite(make(), select_all(), (0, 0, 255))
+    pixels = np.asarray(result)
+    assert (pixels[:, :SIZE[0] // 2] == (0, 0, 255)).all()
+    assert (pixels[:, SIZE[0] // 2:] != (0, 0, 255)).any(axis=-1).all()
+
+
+@pytest.mark.parametrize("make", [la_image, palette_image])
+def test_tiled_matches_engine(make, tmp_path):
+    src, dst = tmp_path / "src.png", tmp_path / "dst.png"
+    make().save(src)
+    seeds = [(SIZE[0] - 1, 0)]
+    tiled.remove_background(str(src), str(dst), seeds=seeds, tolerance=10)
+    expected = engine.remove_background(Image.open(src), seeds=seeds, tolerance=10)
+    assert np.array_equal(np.asarray(Image.open(dst)), np.asarray(expected))
+    assert (np.asarray(expected.getchannel("A"))[:, :SIZE[0] // 2] == 0).all()
+
+
+@pytest.mark.parametrize("make", [la_image, palette_image])
+def test_jpeg_export_flattens_source_alpha(make):
+    assert export.alpha_box(make()) == (SIZE[0] // 2, 0) + SIZE
+    result = export.prepare(make(), "JPEG")
+    pixels = np.asarray(result)
+    assert result.mode == "RGB"
+    assert (pixels[:, :SIZE[0] // 2] == engine.JPEG_BACKGROUND).all()
+    assert (pixels[:, SIZE[0] // 2:] != engine.JPEG_BACKGROUND).any(axis=-1).all()
@@ -0,0 +1,410 @@
+"""Memory-bounded background removal for very large images.
+
+The in-memory engine holds the whole image (and several full-size
+intermediates) at once, which panoramas and print scans cannot afford.
+Here the image is processed in strips of full-width rows:
+
+- sources are read a strip at a time. Uncompressed formats (PPM, BMP,
+  uncompressed TIFF) are read straight from the file; compressed ones are
+  decoded once, spilled to a temporary file and freed;
+- the magic wand fill labels each strip separately and joins components
+  that touch across strip borders, so regions cross strips exactly as in
+  fill.flood_fill;
+- masks live in memory-mapped temporary files, and compositing and PNG
+  encoding stream strip by strip. Output is always PNG: Pillow has no
+  streaming encoder for the other formats.
+
+For uncompressed input, peak memory depends on the strip size
+(STRIP_PIXELS), not on the image. A compressed input (JPEG, PNG) is
+decoded whole before it is spilled, so it briefly needs its full decoded
+size once. Temporary files go to tempfile's directory (set TMPDIR to move
+them).
+"""
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+from PIL import Image, ImageChops, ImageFilter
+
+import colorspace
+import engine
+import export
+import fill
+import instrument
+import matting
+
+STRIP_PIXELS = 4 * 1024 * 1024
+RAW_BYTES_PER_PIXEL = {"L": 1, "RGB": 3, "BGR": 3, "RGBA": 4, "BGRA": 4, "RGBX": 4, "BGRX": 4}
+
+
+def strip_rows(width, strip_pixels=STRIP_PIXELS):
+    """Rows per strip so one strip holds about strip_pixels pixels"""
+    return max(1, strip_pixels // max(width, 1))
+
+
+class RawSource:
+    """An uncompressed image file read directly, a few rows at a time"""
+
+    def __init__(self, filename, image):
+        self.file = open(filename, "rb")
+        self.raw_mode = image.mode
+        self.size = image.size
+        self.mode = "RGBA" if image.mode == "RGBA" else "RGB"
+        self.tiles = []
+        for tile in sorted(image.tile, key=lambda tile: tile[1][1]):
+            rawmode, stride, orientation = raw_args(tile[3])
+            self.tiles.append((tile[1][1], tile[1][3], tile[2], rawmode,
+                               stride or image.width * RAW_BYTES_PER_PIXEL[rawmode], orientation))
+
+    @staticmethod
+    def supports(image):
+        """True if every tile is raw, full width, and in a known layout"""
+        if not image.tile or image.mode not in ("L", "RGB", "RGBA"):
+            return False
+        for codec, extents, _, args in image.tile:
+            if codec != "raw" or extents[0] != 0 or extents[2] != image.width:
+                return False
+            rawmode, _, orientation = raw_args(args)
+            if rawmode not in RAW_BYTES_PER_PIXEL or (orientation < 0 and len(image.tile) > 1):
+                return False
+        return True
+
+    def strip(self, top, bottom):
+        """Rows top to bottom as an RGB or RGBA image"""
+        parts = []
+        for tile_top, tile_bottom, offset, rawmode, stride, orientation in self.tiles:
+            y0, y1 = max(top, tile_top), min(bottom, tile_bottom)
+            if y0 >= y1:
+                continue
+            # Bottom-up files (BMP) store the last row first
+            first = tile_bottom - y1 if orientation < 0 else y0 - tile_top
+            self.file.seek(offset + first * stride)
+            data = self.file.read((y1 - y0) * stride)
+            parts.append(Image.frombytes(self.raw_mode, (self.size[0], y1 - y0), data,
+                                         "raw", rawmode, stride, orientation))
+
+        strip = parts[0] if len(parts) == 1 else stack_rows(parts)
+        return strip if strip.mode == self.mode else strip.convert(self.mode)
+
+    def close(self):
+        self.file.close()
+
+
+class SpilledSource:
+    """A compressed image decoded once into a memory-mapped temporary file"""
+
+    def __init__(self, image):
+        image.load()
+        self.mode = "RGBA" if engine.has_alpha(image) else "RGB"
+        self.size = image.size
+        width, height = image.size
+        self.file = tempfile.TemporaryFile()
+        self.pixels = np.memmap(self.file, dtype=np.uint8, mode="w+", shape=(height, width, len(self.mode)))
+        rows = strip_rows(width)
+        for top in range(0, height, rows):
+            part = image.crop((0, top, width, min(top + rows, height)))
+            self.pixels[top:top + part.height] = np.asarray(part.convert(self.mode))
+        image.close()
+
+    def strip(self, top, bottom):
+        """Rows top to bottom as an RGB or RGBA image"""
+        return Image.fromarray(np.ascontiguousarray(self.pixels[top:bottom]), self.mode)
+
+    def close(self):
+        del self.pixels
+        self.file.close()
+
+
+def raw_args(args):
+    """(rawmode, stride, orientation) from a raw tile's decoder arguments"""
+    if isinstance(args, str):
+        return args, 0, 1
+    args = tuple(args) + (0, 1)[len(args) - 1:]
+    return args[0], args[1], args[2]
+
+
+def stack_rows(parts):
+    """Join images of equal width top to bottom"""
+    result = Image.new(parts[0].mode, (parts[0].width, sum(part.height for part in parts)))
+    top = 0
+    for part in parts:
+        result.paste(part, (0, top))
+        top += part.height
+    return result
+
+
+def open_source(filename):
+    """Open an image for strip-wise reading without keeping it all decoded"""
+    image = Image.open(filename)
+    if RawSource.supports(image):
+        source = RawSource(filename, image)
+        image.close()
+        return source
+    return SpilledSource(image)
+
+
+class MaskStore:
+    """A full-size "L" mask kept in a memory-mapped temporary file"""
+
+    def __init__(self, size):
+        self.size = size
+        self.file = tempfile.TemporaryFile()
+        self.pixels = np.memmap(self.file, dtype=np.uint8, mode="w+", shape=(size[1], size[0]))
+
+    def strip(self, top, bottom):
+        return Image.fromarray(np.ascontiguousarray(self.pixels[top:bottom]), "L")
+
+    def write(self, top, mask):
+        self.pixels[top:top + mask.shape[0]] = mask
+
+    def close(self):
+        del self.pixels
+        self.file.close()
+
+
+class Strips:
+    """Strip-wise access to a source, optionally through a per-strip filter"""
+
+    def __init__(self, source, strip_pixels=STRIP_PIXELS, transform=None):
+        self.source = source
+        self.size = source.size
+        self.rows = strip_rows(source.size[0], strip_pixels)
+        self.transform = transform
+
+    def bounds(self):
+        height = self.size[1]
+        return [(top, min(top + self.rows, height)) for top in range(0, height, self.rows)]
+
+    def strip(self, top, bottom):
+        strip = self.source.strip(top, bottom)
+        return self.transform(strip) if self.transform else strip
+
+    def pixel(self, x, y):
+        return colorspace.as_array(self.strip(y, y + 1))[0, x]
+
+
+def flood_fill(strips, x, y, tolerance, target_color=None, mask=None, metric=colorspace.DEFAULT_METRIC):
+    """Magic wand over strips: select the region around (x, y) into mask
+
+    Components are labelled per strip; components touching across a strip
+    border are joined, so the result equals fill.flood_fill on the whole
+    image. The region is OR-ed into mask (a MaskStore, created if None),
+    which is returned.
+    """
+    width, height = strips.size
+    if mask is None:
+        mask = MaskStore(strips.size)
+    if not (0 <= x < width and 0 <= y < height):
+        return mask
+    if target_color is None:
+        target_color = strips.pixel(x, y)
+    return fill_points(strips, [(x, y)], tolerance, target_color, mask, metric)
+
+
+def flood_fill_many(strips, seeds, tolerance, mask=None, metric=colorspace.DEFAULT_METRIC):
+    """Strip-wise fill.flood_fill_many: the magic wand at every seed, into mask
+
+    Seeds under the same color share one labelling pass over the strips.
+    """
+    width, height = strips.size
+    if mask is None:
+        mask = MaskStore(strips.size)
+    groups = {}
+    for x, y in seeds:
+        if 0 <= x < width and 0 <= y < height:
+            groups.setdefault(tuple(int(v) for v in strips.pixel(x, y)), []).append((x, y))
+    for color, points in groups.items():
+        fill_points(strips, points, tolerance, color, mask, metric)
+    return mask
+
+
+@instrument.timed("fill")
+def fill_points(strips, points, tolerance, target_color, mask, metric):
+    """Select the regions within tolerance of target_color around any of points into mask"""
+    def labels_for(top, bottom):
+        pixels = colorspace.as_array(strips.strip(top, bottom))
+        return fill.label_components(fill.tolerance_mask(pixels, target_color, tolerance, metric))
+
+    # First pass: label every strip, keeping only its border rows
+    bounds = strips.bounds()
+    offsets, seed_labels = [], []
+    pairs, previous_bottom, offset = [], None, 0
+    for top, bottom in bounds:
+        labels = labels_for(top, bottom)
+        offsets.append(offset)
+        seed_labels += [offset + labels[y - top, x] for x, y in points if top <= y < bottom and labels[y - top, x]]
+        if previous_bottom is not None:
+            touching = (previous_bottom > 0) & (labels[0] > 0)
+            pairs.append(np.stack([previous_bottom[touching], labels[0][touching] + offset], axis=1))
+        previous_bottom = np.where(labels[-1] > 0, labels[-1] + offset, 0)
+        offset += int(labels.max()) + 1
+    if not seed_labels:
+        return mask
+
+    # Join components across strip borders; only border labels take part
+    selected = np.unique(seed_labels)
+    pairs = np.unique(np.concatenate(pairs), axis=0) if pairs else np.empty((0, 2), dtype=np.int64)
+    if len(pairs):
+        nodes = np.unique(pairs)
+        roots = fill.label_runs(len(nodes), np.searchsorted(nodes, pairs[:, 0]), np.searchsorted(nodes, pairs[:, 1]))
+        seed_nodes = np.minimum(np.searchsorted(nodes, selected), len(nodes) - 1)
+        on_border = nodes[seed_nodes] == selected
+        selected = np.union1d(selected, nodes[np.isin(roots, roots[seed_nodes[on_border]])])
+
+    # Second pass: paint the selected labels of each strip that has any
+    ends = offsets[1:] + [offset]
+    for (top, bottom), start, end in zip(bounds, offsets, ends):
+        local = selected[(selected > start) & (selected < end)] - start
+        if len(local):
+            region = np.isin(labels_for(top, bottom), local)
+            mask.pixels[top:bottom][region] = 255
+    return mask
+
+
+def contrast(strips, factor):
+    """Strips with ImageEnhance.Contrast applied using the whole-image mean"""
+    histogram = np.zeros(256, dtype=np.int64)
+    for top, bottom in strips.bounds():
+        histogram += strips.strip(top, bottom).convert("L").histogram()[:256]
+    mean = int((histogram * np.arange(256)).sum() / histogram.sum() + 0.5)
+
+    def enhance(strip):
+        strip = strip.convert("RGB")
+        return Image.blend(Image.new("RGB", strip.size, (mean,) * 3), strip, factor)
+
+    return Strips(strips.source, strips.rows * strips.size[0], enhance)
+
+
+def filter_mask(mask, image_filter, margin, rows):
+    """Run a neighbourhood filter over a MaskStore strip by strip
+
+    Each strip is read with margin extra rows above and below so the
+    filter sees the same neighbourhood it would on the whole mask.
+    """
+    width, height = mask.size
+    result = MaskStore(mask.size)
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        above, below = max(0, top - margin), min(height, bottom + margin)
+        filtered = mask.strip(above, below).filter(image_filter)
+        result.write(top, np.asarray(filtered)[top - above:top - above + bottom - top])
+    mask.close()
+    return result
+
+
+def auto_detect(strips, tolerance=engine.AUTO_DETECT_TOLERANCE, seed_points=None):
+    """Strip-wise engine.auto_detect; returns a MaskStore"""
+    enhanced = contrast(strips, 2.0)
+    if seed_points is None:
+        seed_points = engine.center_seed_points(strips.size)
+
+    mask = flood_fill_many(enhanced, seed_points, tolerance)
+    return filter_mask(mask, ImageFilter.MedianFilter(size=5), 2, strips.rows)
+
+
+def composite_strips(strips, mask, bg_color=None, feather=0, matte=False):
+    """Yield engine.composite results strip by strip
+
+    Feathering blurs the mask, so each strip's mask is read with enough
+    extra rows for the blur kernel. Matting looks a fixed distance around
+    every edge pixel, so with matte the image is read with those rows too
+    (results then match engine.composite to within float rounding).
+    """
+    width, height = strips.size
+    margin = 3 * feather + 1 if feather else 0
+    if matte:
+        margin += matting.REACH
+    for top, bottom in strips.bounds():
+        above, below = max(0, top - margin), min(height, bottom + margin)
+        core = (0, top - above, width, bottom - above)
+        if matte:
+            window = strips.strip(above, below)
+            alpha, colors = engine.soft_coverage(window, mask.strip(above, below), feather)
+            image = colors.crop(core)
+            if window.mode == "RGBA":
+                image.putalpha(window.getchannel("A").crop(core))
+        else:
+            image = strips.strip(top, bottom)
+            alpha = engine.coverage(mask.strip(above, below), feather)
+        yield apply_coverage(image, alpha.crop(core), bg_color)
+
+
+def apply_coverage(image, alpha, bg_color=None):
+    """Composite image over bg_color, or onto its alpha channel, by coverage"""
+    if image.mode == "RGBA":
+        alpha = ImageChops.multiply(image.getchannel("A"), alpha)
+    if bg_color:
+        result = Image.new("RGB", image.size, bg_color)
+        result.paste(image, mask=alpha)
+        return result
+    result = image.convert("RGB")
+    result.putalpha(alpha)
+    return result
+
+
+def png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def write_png(filename, size, mode, strips, level=6):
+    """Encode strips (images of one mode, top to bottom) as a PNG, streaming
+
+    Rows use the Sub filter, computed per strip with NumPy, and are fed to
+    a single zlib stream at level, so only one strip is ever held in memory.
+    """
+    width, height = size
+    channels = len(mode)
+    color_type = {"L": 0, "RGB": 2, "RGBA": 6}[mode]
+    compressor = zlib.compressobj(level)
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)))
+        for strip in strips:
+            rows = np.asarray(strip).reshape(strip.height, width * channels)
+            filtered = np.empty((strip.height, width * channels + 1), dtype=np.uint8)
+            filtered[:, 0] = 1  # Sub filter
+            filtered[:, 1:channels + 1] = rows[:, :channels]
+            filtered[:, channels + 1:] = rows[:, channels:] - rows[:, :-channels]
+            data = compressor.compress(filtered.tobytes())
+            if data:
+                f.write(png_chunk(b"IDAT", data))
+        f.write(png_chunk(b"IDAT", compressor.flush()))
+        f.write(png_chunk(b"IEND", b""))
+
+
+def png_preset(filename, preset=None):
+    """The PNG export preset filename is written with; other formats are refused"""
+    preset = export.preset_for(filename, preset)
+    if preset is None or export.PRESETS[preset][0] != "PNG":
+        raise ValueError(f"strip-wise output must be PNG: {filename}")
+    return preset
+
+
+def save(filename, size, mode, strips, preset=None):
+    """Stream strips to a PNG file with a PNG export preset"""
+    options = export.PRESETS[png_preset(filename, preset)][1]
+    write_png(filename, size, mode, strips, options.get("compress_level", 9))
+
+
+def remove_background(src, dst, seeds=None, tolerance=None, bg_color=None, feather=0, matte=False,
+                      metric=colorspace.DEFAULT_METRIC, strip_pixels=STRIP_PIXELS, preset=None):
+    """Strip-wise engine.remove_background from file src to PNG file dst, saved with an export preset"""
+    png_preset(dst, preset)
+    source = open_source(src)
+    try:
+        strips = Strips(source, strip_pixels)
+        if seeds:
+            if tolerance is None:
+                tolerance = engine.MAGIC_WAND_TOLERANCE
+            mask = flood_fill_many(strips, seeds, tolerance, metric=metric)
+        else:
+            mask = auto_detect(strips, engine.AUTO_DETECT_TOLERANCE if tolerance is None else tolerance)
+        try:
+            mode = "RGB" if bg_color else "RGBA"
+            save(dst, source.size, mode, composite_strips(strips, mask, bg_color, feather, matte), preset)
+        finally:
+            mask.close()
+    finally:
+        source.close()
+    return source.size
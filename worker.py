@@ -0,0 +1,110 @@
+"""Run long operations off the Tk main thread.
+
+Tasks run one at a time on a worker thread. Progress, results and errors
+come back through a queue that the main thread polls with root.after,
+so Tk widgets are only ever touched from the main thread. Starting a new
+task cancels the previous one, and anything a superseded task still
+reports is dropped.
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+POLL_INTERVAL_MS = 50
+
+
+class Cancelled(Exception):
+    """Raised inside a task when it has been cancelled"""
+
+
+class Progress:
+    """Handed to a running task to report progress and check for cancellation
+
+    Call it with a fraction between 0 and 1; it raises Cancelled once the
+    task has been cancelled, so every report is also a cancellation point.
+    """
+
+    def __init__(self, task_id, messages, cancelled):
+        self.task_id = task_id
+        self.messages = messages
+        self.cancelled = cancelled
+
+    def __call__(self, fraction):
+        if self.cancelled.is_set():
+            raise Cancelled()
+        self.messages.put((self.task_id, "progress", fraction))
+
+
+class TaskRunner:
+    """Runs one background task at a time on behalf of a Tk root"""
+
+    def __init__(self, root):
+        self.root = root
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.messages = queue.Queue()
+        self.task_id = 0
+        self.current = None
+        self.polling = False
+
+    @property
+    def busy(self):
+        return self.current is not None
+
+    def start(self, work, on_done, on_progress=None, on_error=None):
+        """Run work(progress) in the background
+
+        on_done(result), on_progress(fraction) and on_error(exception) are
+        called on the main thread, and only while this is still the
+        current task.
+        """
+        self.cancel()
+        self.task_id += 1
+        task_id = self.task_id
+        cancelled = threading.Event()
+        self.current = (task_id, cancelled, on_done, on_progress, on_error)
+
+        def run():
+            try:
+                result = work(Progress(task_id, self.messages, cancelled))
+                self.messages.put((task_id, "done", result))
+            except Cancelled:
+                pass
+            except Exception as e:
+                self.messages.put((task_id, "error", e))
+
+        self.executor.submit(run)
+        if not self.polling:
+            self.polling = True
+            self.root.after(POLL_INTERVAL_MS, self.poll)
+
+    def cancel(self):
+        """Cancel the current task; its results will never be delivered"""
+        if self.current is not None:
+            self.current[1].set()
+            self.current = None
+
+    def poll(self):
+        """Deliver queued messages from the worker (main thread only)"""
+        while True:
+            try:
+                task_id, kind, payload = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if self.current is None or self.current[0] != task_id:
+                continue  # Stale message from a superseded task
+
+            _, _, on_done, on_progress, on_error = self.current
+            if kind == "progress":
+                if on_progress:
+                    on_progress(payload)
+            else:
+                self.current = None
+                if kind == "done":
+                    on_done(payload)
+                elif on_error:
+                    on_error(payload)
+
+        if self.current is not None:
+            self.root.after(POLL_INTERVAL_MS, self.poll)
+        else:
+            self.polling = False